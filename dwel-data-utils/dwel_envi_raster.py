@@ -0,0 +1,167 @@
+"""
+Access ENVI raster images without GDAL by parsing the ENVI header file and
+memory-mapping the binary data file. Bands are returned as NumPy views of the
+file, so only the pixels actually indexed are read from disk. Images of other
+formats are read by GDAL if it is installed.
+
+Zhan Li, zhanli86@bu.edu
+"""
+
+import os
+
+import numpy as np
+
+try:
+    from osgeo import gdal
+    gdal.AllRegister()
+except ImportError:
+    gdal = None
+
+# ENVI data type code to NumPy data type
+_envi_dtype = {1:np.uint8, 2:np.int16, 3:np.int32, 4:np.float32, 5:np.float64, \
+               6:np.complex64, 9:np.complex128, 12:np.uint16, 13:np.uint32, \
+               14:np.int64, 15:np.uint64}
+
+def findEnviHeader(imgfile):
+    """
+    Find the ENVI header file of an image file, either imgfile.hdr or the
+    image file name with its extension replaced by .hdr. Return None if no
+    header file is found.
+    """
+    for hdrfile in [imgfile+".hdr", os.path.splitext(imgfile)[0]+".hdr"]:
+        if os.path.isfile(hdrfile):
+            return hdrfile
+    return None
+
+def readEnviHeader(hdrfile):
+    """
+    Read an ENVI header file into a dictionary. Keys are in lower case. Values
+    in braces are kept as strings without the braces.
+    """
+    hdr = {}
+    with open(hdrfile, 'r') as hdrfobj:
+        if hdrfobj.readline().strip() != "ENVI":
+            raise RuntimeError("Not an ENVI header file: {0:s}".format(hdrfile))
+        key = None
+        for line in hdrfobj:
+            if key is not None:
+                # continue a value in braces over multiple lines
+                hdr[key] += line
+                if line.find('}') > -1:
+                    hdr[key] = hdr[key].strip()[1:-1].strip()
+                    key = None
+                continue
+            if line.find('=') == -1:
+                continue
+            tmpkey, val = [ tok.strip() for tok in line.split('=', 1) ]
+            tmpkey = tmpkey.lower()
+            if val.find('{') == 0 and val.find('}') == -1:
+                key = tmpkey
+                hdr[key] = val + "\n"
+            elif val.find('{') == 0:
+                hdr[tmpkey] = val[1:-1].strip()
+            else:
+                hdr[tmpkey] = val
+    return hdr
+
+def openEnviRaster(imgfile, hdrfile=None):
+    """
+    Memory-map an ENVI image file.
+
+    Args:
+
+        imgfile (string): ENVI image file.
+
+        hdrfile (string): ENVI header file. If None, found by findEnviHeader.
+
+    Returns:
+
+        raster (3D numpy array, [bands, lines, samples]): read-only view of
+        the image file, regardless of the interleave of the file.
+    """
+    if hdrfile is None:
+        hdrfile = findEnviHeader(imgfile)
+        if hdrfile is None:
+            raise RuntimeError("No ENVI header file is found for {0:s}".format(imgfile))
+    hdr = readEnviHeader(hdrfile)
+
+    nsamples = int(hdr['samples'])
+    nlines = int(hdr['lines'])
+    nbands = int(hdr['bands'])
+    offset = int(hdr.get('header offset', 0))
+    dtype = np.dtype(_envi_dtype[int(hdr['data type'])])
+    if int(hdr.get('byte order', 0)) == 1:
+        dtype = dtype.newbyteorder('>')
+    else:
+        dtype = dtype.newbyteorder('<')
+    interleave = hdr.get('interleave', 'bsq').lower()
+
+    if interleave == 'bsq':
+        raster = np.memmap(imgfile, dtype=dtype, mode='r', offset=offset, \
+                           shape=(nbands, nlines, nsamples))
+    elif interleave == 'bil':
+        raster = np.memmap(imgfile, dtype=dtype, mode='r', offset=offset, \
+                           shape=(nlines, nbands, nsamples)).transpose(1, 0, 2)
+    elif interleave == 'bip':
+        raster = np.memmap(imgfile, dtype=dtype, mode='r', offset=offset, \
+                           shape=(nlines, nsamples, nbands)).transpose(2, 0, 1)
+    else:
+        raise RuntimeError("Unknown interleave of ENVI image: {0:s}".format(interleave))
+    return raster
+
+def getRasterSize(imgfile):
+    """
+    Number of bands, lines and samples of an image file, from its ENVI header
+    or by GDAL.
+    """
+    hdrfile = findEnviHeader(imgfile)
+    if hdrfile is not None:
+        hdr = readEnviHeader(hdrfile)
+        return int(hdr['bands']), int(hdr['lines']), int(hdr['samples'])
+    imgds = _gdalOpen(imgfile)
+    imgsize = (imgds.RasterCount, imgds.RasterYSize, imgds.RasterXSize)
+    imgds = None
+    return imgsize
+
+def readBand(imgfile, band, yoff=0, ysize=None):
+    """
+    Read a band of an image file. An ENVI image is memory-mapped and the band
+    is a view of the file without copy. Other images are read by GDAL.
+
+    Args:
+
+        imgfile (string): image file.
+
+        band (int): band index, with first being 1.
+
+        yoff (int): first line to read.
+
+        ysize (int): number of lines to read. If None, to the last line.
+
+    Returns:
+
+        data (2D numpy array, [lines, samples]): read-only for an ENVI image.
+    """
+    if findEnviHeader(imgfile) is not None:
+        raster = openEnviRaster(imgfile)
+        if band < 1 or band > raster.shape[0]:
+            raise RuntimeError("Band {0:d} is out of the {1:d} bands of {2:s}".format(band, raster.shape[0], imgfile))
+        if ysize is None:
+            ysize = raster.shape[1] - yoff
+        return raster[band-1, yoff:yoff+ysize, :]
+
+    imgds = _gdalOpen(imgfile)
+    imgband = imgds.GetRasterBand(band)
+    if ysize is None:
+        ysize = imgband.YSize - yoff
+    data = imgband.ReadAsArray(0, yoff, imgband.XSize, ysize)
+    imgds = None
+    return data
+
+def _gdalOpen(imgfile):
+    if gdal is None:
+        raise RuntimeError("No ENVI header file is found for {0:s} and GDAL is not available to read it".format(imgfile))
+    imgds = gdal.Open(imgfile, gdal.GA_ReadOnly)
+    if imgds is None:
+        raise RuntimeError("Failed to open image file {0:s}".format(imgfile))
+    return imgds
@@ -83,6 +83,8 @@ def getCmdArgs():
 
     p.add_argument("--pgap2dmaxrg", dest="pgap2dmaxrg", type=float, default=None, help="Maximum range up to which the Pgap 2D Zenith-Azimuth view is saved. Default: None and will use the range limit of the input data.")
     
+    p.add_argument("--nproc", dest="nproc", type=int, default=1, help="Number of processes to generate the 2D view of Pgap, each processing partitions of rows of SPD files. Default: 1")
+
     p.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False, help='Turn on verbosity')
     
     cmdargs = p.parse_args()
@@ -294,13 +296,15 @@ def main(cmdargs):
             nirprofileobj.genWaveformPgap2DView(cmdargs.fwhm[0], \
                                                     cmdargs.leafrho[0], leafIalim, \
                                                     cmdargs.woodrho[0], woodIalim, \
-                                                    cmdargs.plantrho[0], plantIalim)
+                                                    cmdargs.plantrho[0], plantIalim, \
+                                                    nproc=cmdargs.nproc)
 
         swirPgapZenAzView, swirPgapZenRgView, swirsensorheight = \
             swirprofileobj.genWaveformPgap2DView(cmdargs.fwhm[1], \
                                                     cmdargs.leafrho[1], leafIalim, \
                                                     cmdargs.woodrho[1], woodIalim, \
-                                                    None, None)
+                                                    None, None, \
+                                                    nproc=cmdargs.nproc)
 
     print "Getting Pgap profile along canopy height at different zenith angles ..."
     nirpgapprofiles = nirprofileobj.getPgapProfileClass(nirPgapZenRgView, nirsensorheight)
@@ -4,10 +4,13 @@ A new version of spdtlsfile module for Zhan Li's own test and use for DWEL data.
 Adapted from John Armston's original version.
 """
 
+import os
 import h5py
 import numpy as np
 np.seterr(all='ignore')
 import sys
+import threading
+import Queue
 
 from spdtlstools.spdtlserrors import *
 
@@ -43,16 +46,29 @@ class SPDFile:
     Some methods to read and write an SPD file
     """
 
-    def __init__(self,infile,resfactor=1,ybinsize=None,rowstart=0):
-        self.f = h5py.File(infile, 'a')
+    def __init__(self,infile,resfactor=1,ybinsize=None,rowstart=0,mode='a',indexsidecar=False):
+        """
+        Args:
+
+            indexsidecar: if True, readSPDIndex memory-maps the index from
+            .npy files next to the SPD file, written at the first read.
+        """
+        self.f = h5py.File(infile, mode)
+        self.infile = infile
         self.resfactor = resfactor
         self.yblockstart = 0
         self.rowstart = rowstart
-        if self.f['HEADER']["PULSE_INDEX_METHOD"][0] > 0:
+        # in-memory copies of the header fields and of the index datasets,
+        # read by readSPDIndex
+        self.header = self.readSPDHeader()
+        self.indexsidecar = indexsidecar
+        self.plsperbin = None
+        self.binoffsets = None
+        if self.header["PULSE_INDEX_METHOD"] > 0:
             if ybinsize is None:
-                ybinsize = self.f['HEADER']['BIN_SIZE'][0]
-            self.yblocksize = int(ybinsize / self.f['HEADER']['BIN_SIZE'][0])
-            self.nyblocks = int(np.ceil(self.f['HEADER']['NUMBER_BINS_Y'][0] / self.yblocksize))
+                ybinsize = self.header['BIN_SIZE']
+            self.yblocksize = int(ybinsize / self.header['BIN_SIZE'])
+            self.nyblocks = int(np.ceil(self.header['NUMBER_BINS_Y'] / self.yblocksize))
 
     
     def __iter__(self):           
@@ -121,7 +137,7 @@ class SPDFile:
         """
         
         self.yblockstart = self.rowstart + row * self.yblocksize
-        yblockend = min(self.yblockstart+self.yblocksize, self.f['HEADER']['NUMBER_BINS_Y'][0])     
+        yblockend = min(self.yblockstart+self.yblocksize, self.header['NUMBER_BINS_Y'])     
         if self.yblockstart >= yblockend:
             raise OutsideBoundsError("start block = %i; endblock = %i" % (self.yblockstart,yblockend))
         
@@ -164,7 +180,7 @@ class SPDFile:
             return None,None
 
 
-    def readSPDRowsList(self,row,recarray=True):
+    def readSPDRowsList(self,row,recarray=True,csr=False):
         """
         Read rows of pulse data and point data but group points in multiple
         lists according to their pulse ID.
@@ -172,17 +188,28 @@ class SPDFile:
         Actually here only read one row (defined by one ybinsize) of pulse and
         point data. But it could be multiple rows (defined by the binsize of SPD
         file itself) if ybinsize is larger than SPD file's binsize
+
+        If csr is True, points are not split into lists but returned as a
+        tuple (pointdata, ptsoffsets) in place of the lists, where pointdata
+        is the flat array of points of the row and points of pulse i are
+        pointdata[ptsoffsets[i]:ptsoffsets[i+1]].
         """
         
         self.yblockstart = self.rowstart + row * self.yblocksize
-        yblockend = min(self.yblockstart+self.yblocksize, self.f['HEADER']['NUMBER_BINS_Y'][0])     
+        yblockend = min(self.yblockstart+self.yblocksize, self.header['NUMBER_BINS_Y'])     
         if self.yblockstart >= yblockend:
             raise OutsideBoundsError("start block = %i; endblock = %i" % (self.yblockstart,yblockend))
 
-        cnt = self.f['INDEX']['PLS_PER_BIN'][self.yblockstart:yblockend]
+        if self.plsperbin is None:
+            cnt = self.f['INDEX']['PLS_PER_BIN'][self.yblockstart:yblockend]
+        else:
+            cnt = self.plsperbin[self.yblockstart:yblockend]
         if cnt.any():
             
-            idx = self.f['INDEX']['BIN_OFFSETS'][self.yblockstart:yblockend]
+            if self.binoffsets is None:
+                idx = self.f['INDEX']['BIN_OFFSETS'][self.yblockstart:yblockend]
+            else:
+                idx = self.binoffsets[self.yblockstart:yblockend]
             
             if idx.ndim == 1:
                 idx.shape = 1,idx.size
@@ -199,27 +226,217 @@ class SPDFile:
                 
             pointdata = self.f['DATA']['POINTS'][start:finish]
 
-            if self.resfactor > 1:
-                keep = (pulsedata['SCANLINE'] % self.resfactor == 0) & (pulsedata['SCANLINE_IDX'] % self.resfactor == 0)
-                pointdata = pointdata[np.repeat(keep, pulsedata['NUMBER_OF_RETURNS'])]
-                pulsedata = pulsedata[keep]
+            return self._splitRowPoints(pulsedata,pointdata,recarray,csr)
+
+        else:
+        
+            return None,None
 
-            if recarray:
-                pulsedatav = pulsedata.view(np.recarray)
-                pointdatav = pointdata.view(np.recarray)
+
+    def _splitRowPoints(self,pulsedata,pointdata,recarray=True,csr=False):
+        """
+        Reduce resolution and group points of a row by pulse, in lists or by
+        offsets if csr, for readSPDRowsList and iterSPDRowsList.
+        """
+        if self.resfactor > 1:
+            keep = (pulsedata['SCANLINE'] % self.resfactor == 0) & (pulsedata['SCANLINE_IDX'] % self.resfactor == 0)
+            pointdata = pointdata[np.repeat(keep, pulsedata['NUMBER_OF_RETURNS'])]
+            pulsedata = pulsedata[keep]
+
+        if recarray:
+            pulsedatav = pulsedata.view(np.recarray)
+            pointdatav = pointdata.view(np.recarray)
+        else:
+            pulsedatav = pulsedata
+            pointdatav = pointdata
+
+        ptsoffsets = np.zeros(len(pulsedata)+1, dtype=np.int_)
+        np.cumsum(pulsedata['NUMBER_OF_RETURNS'], out=ptsoffsets[1:])
+        if csr:
+            return pulsedatav,(pointdatav,ptsoffsets)
+
+        pointslist = np.split(pointdatav, ptsoffsets[1:-1])
+
+        return pulsedatav,np.array(pointslist)
+
+
+    def readSPDIndex(self):
+        """
+        Read the index datasets, pulses per bin and bin offsets, into memory
+        once, so rows are located without reading the index from the file.
+
+        With indexsidecar, the index is memory-mapped from the files
+        <infile>.PLS_PER_BIN.npy and <infile>.BIN_OFFSETS.npy, which are
+        written from the SPD file if missing or older than it, so that
+        processes reading the same file share one copy of the index.
+        """
+        if self.plsperbin is None:
+            if self.indexsidecar:
+                self.plsperbin = self._readIndexSidecar('PLS_PER_BIN')
+                self.binoffsets = self._readIndexSidecar('BIN_OFFSETS')
             else:
-                pulsedatav = pulsedata
-                pointdatav = pointdata
+                self.plsperbin = self.f['INDEX']['PLS_PER_BIN'][()]
+                self.binoffsets = self.f['INDEX']['BIN_OFFSETS'][()]
+            if self.plsperbin.ndim == 1:
+                self.plsperbin.shape = 1,self.plsperbin.size
+                self.binoffsets.shape = 1,self.binoffsets.size
+        return self.plsperbin,self.binoffsets
 
-            ptscnt = pulsedata['NUMBER_OF_RETURNS']
-            splitind = np.cumsum(ptscnt)[:-1]
-            pointslist = np.split(pointdatav, splitind)
 
-            return pulsedatav,np.array(pointslist)
+    def _readIndexSidecar(self,name):
+        """
+        Memory-map an index dataset from its sidecar .npy file, for
+        readSPDIndex.
+        """
+        npyfile = self.infile + '.' + name + '.npy'
+        dset = self.f['INDEX'][name]
+        if os.path.isfile(npyfile) and os.path.getmtime(npyfile) >= os.path.getmtime(self.infile):
+            data = np.load(npyfile, mmap_mode='r')
+            if data.shape == dset.shape and data.dtype == dset.dtype:
+                return data
+        try:
+            np.save(npyfile, dset[()])
+        except (IOError, OSError):
+            # not writable, e.g. a read-only directory
+            return dset[()]
+        return np.load(npyfile, mmap_mode='r')
+
+
+    def iterSPDRowsList(self,rowstart=0,rowend=None,blockrows=32,background=False,recarray=True,csr=False):
+        """
+        Iterate over rows and yield the same pulse data and lists of point
+        data as readSPDRowsList, but read pulses and points of blocks of many
+        rows per HDF5 call, with the index read only once by readSPDIndex.
+
+        Args:
+
+            rowstart, rowend: rows in [rowstart, rowend), in the same unit of
+            row (ybinsize) as readSPDRowsList. Default rowend is the last row.
 
+            blockrows: number of rows read at a time.
+
+            background: if True, blocks are read by a background thread ahead
+            of the rows being processed, at most two blocks in memory.
+
+            csr: if True, yield points as (pointdata, ptsoffsets) in place
+            of lists, see readSPDRowsList.
+
+        Yields:
+
+            (row, pulsedata, pointslist), pulsedata and pointslist are None if
+            the row has no pulse.
+        """
+        nbinsy = self.header['NUMBER_BINS_Y']
+        if rowend is None:
+            rowend = int(np.ceil((nbinsy - self.rowstart) / float(self.yblocksize)))
+        self.readSPDIndex()
+        blocks = [(r, min(r+blockrows, rowend)) for r in range(rowstart, rowend, blockrows)]
+
+        if not background:
+            for block in blocks:
+                for rowdata in self._splitBlockRows(self._readBlockRows(block[0], block[1]), recarray, csr):
+                    yield rowdata
+            return
+
+        queue = Queue.Queue(maxsize=2)
+        stop = threading.Event()
+        error = []
+        def run():
+            try:
+                for block in blocks:
+                    blockdata = self._readBlockRows(block[0], block[1])
+                    while not stop.is_set():
+                        try:
+                            queue.put(blockdata, timeout=0.1)
+                            break
+                        except Queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+            except Exception:
+                error.append(sys.exc_info())
+            queue.put(None)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                blockdata = queue.get()
+                if blockdata is None:
+                    if len(error) > 0:
+                        raise error[0][0], error[0][1], error[0][2]
+                    break
+                for rowdata in self._splitBlockRows(blockdata, recarray, csr):
+                    yield rowdata
+        finally:
+            stop.set()
+            thread.join()
+
+
+    def _readBlockRows(self,blockstart,blockend):
+        """
+        Read pulses and points of rows in [blockstart, blockend) with one HDF5
+        read of each. Returns a list of the rows and the pulse and point
+        ranges of each row in the block, as read by readSPDRowsList.
+        """
+        nbinsy = self.header['NUMBER_BINS_Y']
+        rows = []
+        for row in range(blockstart, blockend):
+            yblockstart = self.rowstart + row * self.yblocksize
+            yblockend = min(yblockstart+self.yblocksize, nbinsy)
+            if yblockstart >= yblockend:
+                raise OutsideBoundsError("start block = %i; endblock = %i" % (yblockstart,yblockend))
+            cnt = self.plsperbin[yblockstart:yblockend]
+            if cnt.any():
+                idx = self.binoffsets[yblockstart:yblockend]
+                rows.append([row, yblockstart, int(idx[0,0]), int(idx[-1,-1]+cnt[-1,-1])])
+            else:
+                rows.append([row, yblockstart, None, None])
+
+        plsrows = [r for r in rows if r[2] is not None]
+        if len(plsrows) == 0:
+            return rows, None, 0, None, 0
+        plsstart = min([r[2] for r in plsrows])
+        plsend = max([r[3] for r in plsrows])
+        pulses = self.f['DATA']['PULSES'][plsstart:plsend]
+
+        # point range of each row, from its first and last pulses
+        for r in plsrows:
+            if r[3] > r[2]:
+                start = int(pulses['PTS_START_IDX'][r[2]-plsstart])
+                finish = int(pulses['PTS_START_IDX'][r[3]-1-plsstart] + pulses['NUMBER_OF_RETURNS'][r[3]-1-plsstart])
+            else:
+                start = finish = 0
+            if start > finish:
+                finish = start
+            r += [start, finish]
+        ptsstart = min([r[4] for r in plsrows])
+        ptsend = max([r[5] for r in plsrows])
+        if (ptsend - ptsstart) > 2*sum([r[5]-r[4] for r in plsrows]) + 1024:
+            # rows far apart in the point data, read points row by row
+            points = None
         else:
-        
-            return None,None
+            points = self.f['DATA']['POINTS'][ptsstart:ptsend]
+        return rows, pulses, plsstart, points, ptsstart
+
+
+    def _splitBlockRows(self,blockdata,recarray=True,csr=False):
+        """
+        Yield rows of a block from _readBlockRows.
+        """
+        rows, pulses, plsstart, points, ptsstart = blockdata
+        for r in rows:
+            self.yblockstart = r[1]
+            if r[2] is None:
+                yield r[0], None, None
+                continue
+            pulsedata = pulses[r[2]-plsstart:r[3]-plsstart]
+            if points is None:
+                pointdata = self.f['DATA']['POINTS'][r[4]:r[5]]
+            else:
+                pointdata = points[r[4]-ptsstart:r[5]-ptsstart]
+            pulsedatav, pointslist = self._splitRowPoints(pulsedata, pointdata, recarray, csr)
+            yield r[0], pulsedatav, pointslist
 
         
     def readSPDRowCols(self,row,startCol,endCol,recarray=True):
@@ -240,7 +457,7 @@ class SPDFile:
         """
         
         self.yblockstart = self.rowstart + row * self.yblocksize
-        yblockend = min(self.yblockstart+self.yblocksize, self.f['HEADER']['NUMBER_BINS_Y'][0])     
+        yblockend = min(self.yblockstart+self.yblocksize, self.header['NUMBER_BINS_Y'])     
         if self.yblockstart >= yblockend:
             raise OutsideBoundsError("start block = %i; endblock = %i" % (self.yblockstart,yblockend))
 
@@ -297,7 +514,7 @@ class SPDFile:
         Read pulse and point data for a number of pulse data records from an offset
         """
         
-        finish = min(pulseidx+blocksize, self.f['HEADER']['NUMBER_OF_PULSES'][0])        
+        finish = min(pulseidx+blocksize, self.header['NUMBER_OF_PULSES'])        
         if pulseidx < finish:      
             
             pulsedata = self.f['DATA']['PULSES'][pulseidx:finish]
@@ -340,7 +557,7 @@ class SPDFile:
             data = [data]
                   
         self.yblockstart = self.rowstart + row * self.yblocksize
-        yblockend = min(self.yblockstart+self.yblocksize, self.f['HEADER']['NUMBER_BINS_Y'][0])     
+        yblockend = min(self.yblockstart+self.yblocksize, self.header['NUMBER_BINS_Y'])     
         if self.yblockstart >= yblockend:
             raise OutsideBoundsError("start block = %i; endblock = %i" % (self.yblockstart,yblockend))
         
@@ -380,7 +597,7 @@ class SPDFile:
             data = [data]
                   
         self.yblockstart = self.rowstart + row * self.yblocksize
-        yblockend = min(self.yblockstart+self.yblocksize, self.f['HEADER']['NUMBER_BINS_Y'][0])     
+        yblockend = min(self.yblockstart+self.yblocksize, self.header['NUMBER_BINS_Y'])     
         if self.yblockstart >= yblockend:
             raise OutsideBoundsError("start block = %i; endblock = %i" % (self.yblockstart,yblockend))
         
@@ -412,7 +629,7 @@ class SPDFile:
             field = [field]
             data = [data]
                    
-        finish = min(pulseidx+data[0].size,self.f['HEADER']['NUMBER_OF_PULSES'][0])
+        finish = min(pulseidx+data[0].size,self.header['NUMBER_OF_PULSES'])
         if pulseidx < finish:      
             
             pulsedata = self.f['DATA']['PULSES'][pulseidx:finish]
@@ -434,7 +651,7 @@ class SPDFile:
             field = [field]
             data = [data]
                    
-        finish = min(pulseidx+data[0].size,self.f['HEADER']['NUMBER_OF_PULSES'][0])
+        finish = min(pulseidx+data[0].size,self.header['NUMBER_OF_PULSES'])
         if pulseidx < finish:      
             
             pulsedata = self.f['DATA']['PULSES'][pulseidx:finish]
@@ -459,6 +676,7 @@ class SPDFile:
         Update an SPD header field
         """
         self.f['HEADER'][field][()] = value
+        self.header = self.readSPDHeader()
 
     
     @staticmethod
@@ -9,6 +9,7 @@ AUTHORS:
 import sys, os
 import time
 import warnings
+import multiprocessing
 
 import numpy as np
 
@@ -21,6 +22,31 @@ import nu_spdtlsfile as spdtlsfile
 from spddwelerrors import *
 from spdtlstools.spdtlserrors import *
 
+# profile object and parameters of classes shared with forked workers of
+# DWELClassProfile.genWaveformPgap2DView
+_parallel_args = None
+
+def _genWaveformPgap2DViewPartition(rows):
+    """
+    Worker of DWELClassProfile.genWaveformPgap2DView. Calculate the Pgap 2D
+    views of rows in [rows[0], rows[1]) with its own read-only SPD file
+    object, and return the slices of the views.
+    """
+    obj, fwhm, ngmodel, labelclass, rhoclass, Ialimclass = _parallel_args
+    spdobj = spdtlsfile.SPDFile(obj.inspdfile, resfactor=1, mode='r')
+    try:
+        azset = obj.genWaveformPgap2DViewRows(spdobj, rows[0], rows[1], fwhm, ngmodel, \
+                                              labelclass, rhoclass, Ialimclass)
+    finally:
+        spdobj.closeSPDFile()
+    viewslices = dict()
+    for name in rhoclass.keys():
+        viewslices[name] = (obj.PgapZenAzView[name][rows[0]:rows[1], :], \
+                            obj.PgapZenRgView[name][rows[0]:rows[1], :])
+    return azset, obj.PgapZenAzView['azimuth'][azset], \
+        obj.PgapZenAzView['zenith'][rows[0]:rows[1]], obj.PgapZenRgView['zenith'][rows[0]:rows[1]], \
+        obj._validrow[rows[0]:rows[1]], viewslices
+
 class DWELClassProfile:
     """
     Some methods to calculate Pgap and foliage profiles of leaves and woodies
@@ -37,8 +63,17 @@ class DWELClassProfile:
                      rglimit=100.0, rgres=0.075, \
                      savevar=False, tempprefix=None, \
                      pgap2dmaxrg=None, \
+                     wfengine="scatter", \
                      verbose=False):
-        
+        """
+        Args:
+
+            wfengine (string): engine of waveform synthesis from points,
+            "scatter" scatters points of all the pulses in a row into range
+            bins and convolves them with the pulse model at once, "interp"
+            interpolates the pulse model for each point.
+        """
+
         self.inspdfile = inspdfile
         self.bandlabel = bandlabel.lower()
         self.pgapmethod = pgapmethod
@@ -64,6 +99,10 @@ class DWELClassProfile:
 
         self.verbose = verbose
 
+        if wfengine not in ("scatter", "interp"):
+            raise RuntimeError("Unknown waveform synthesis engine: {0:s}".format(wfengine))
+        self.wfengine = wfengine
+
         self.ptsampscale = 1000.0 # scale of point intensity amplitude
         self.leaflabel = 10
         self.woodlabel = 11
@@ -346,18 +385,7 @@ class DWELClassProfile:
         
         kthetal = -np.log(pgapprofile)
         xtheta = 2 * np.tan(np.radians(zeniths)) / np.pi
-        PAIv = np.zeros(heights.size)
-        PAIh = np.zeros(heights.size)
-        residual = np.zeros(heights.size)
-        for i,h in enumerate(heights):
-            A = np.vstack([xtheta, np.ones(xtheta.size)]).T
-            y = kthetal[:,i]
-            if y.any():
-                solution = np.linalg.lstsq(A, y)
-                Lv, Lh = solution[0]
-                PAIv[i] = Lv
-                PAIh[i] = Lh
-                residual[i] = np.sqrt(solution[1][0])
+        PAIv, PAIh, residual = self.solveLinearPlantProfile(kthetal, xtheta)
         
         PAI = PAIv + PAIh
         PAVD = self.deriv(heights,PAI)
@@ -389,6 +417,38 @@ class DWELClassProfile:
 
         return profileview.copy()
 
+    def solveLinearPlantProfile(self, kthetal, xtheta):
+        """
+        Least-squares fit of the linear model, kthetal = PAIv*xtheta + PAIh,
+        at all heights at once. The design matrix [xtheta, 1] is the same at
+        every height, so its pseudo-inverse is computed once and applied to
+        all the heights by one matrix product.
+
+        Args:
+
+            kthetal (numpy array, float): -ln(Pgap), [n_zenith_bins, ...],
+            with any further dimensions, e.g. heights, classes or bootstrap
+            replicates of Pgap at the same zenith bins.
+
+            xtheta (1D numpy array, float): [n_zenith_bins].
+
+        Returns:
+
+            PAIv, PAIh, residual (numpy array, float): fitted slope,
+            intercept and root of sum of squared residuals, in the shape of
+            kthetal without the first dimension. All zeros where kthetal is
+            all zeros.
+        """
+        A = np.vstack([xtheta, np.ones(xtheta.size)]).T
+        y = kthetal.reshape((kthetal.shape[0], -1))
+        solution = np.dot(np.linalg.pinv(A), y)
+        residual = np.sqrt(np.sum((np.dot(A, solution) - y)**2, axis=0))
+        nofit = np.logical_not(y.any(axis=0))
+        solution[:, nofit] = 0.0
+        residual[nofit] = 0.0
+        outshape = kthetal.shape[1:]
+        return solution[0].reshape(outshape), solution[1].reshape(outshape), residual.reshape(outshape)
+
     def adjustPgapProfileClass(self, PgapProfileClass, U, P):
         """
         Adjust Pgap profile for each class stored in the
@@ -489,18 +549,37 @@ class DWELClassProfile:
         htmeshlist = np.split(htmesh, splitind, axis=0)
         pgapzenrgviewlist = np.split(pgapzenrgview, splitind, axis=0)
 
-        validzenind = np.where(np.array([len(ht)>0 for ht in htmeshlist], dtype=np.bool_))[0]
+        ringcnt = np.array([len(ht) for ht in htmeshlist], dtype=np.int_)
+        validzenind = np.where(ringcnt>0)[0]
 
-        htmeshlist = [htmeshlist[ind] for ind in validzenind]
-        pgapzenrgviewlist = [pgapzenrgviewlist[ind] for ind in validzenind]
-        
         pgapzenhtview = np.ones((len(self.midzeniths[validzenind]), len(self.heights)))
-        for i, ht in enumerate(self.heights):
-            # minimum height the lidar sees is sensor height
-            if ht >= sensorheight:
-                pgapzenviewlist = [ np.mean(self.getPgapZenView(ht, p, h)) \
-                                        for p, h in zip(pgapzenrgviewlist, htmeshlist) ]
-                pgapzenhtview[:, i] = np.array(pgapzenviewlist)
+        # minimum height the lidar sees is sensor height
+        htind = np.where(self.heights >= sensorheight)[0]
+        if len(validzenind) == 0 or len(htind) == 0:
+            return pgapzenhtview, self.midzeniths[validzenind]
+        hts = self.heights[htind]
+        if (htmesh[:, -1] < hts[-1]).any():
+            htbin = hts[np.where(hts > np.min(htmesh[:, -1]))[0][0]]
+            raise OutsideBoundsError("Height, %.3f m, requested for Pgap profile is outside available heights in the scan" % htbin)
+
+        # same as getPgapZenView at all the heights at once, the last range
+        # bin at or below each height in each zenith row, or Pgap of 1 if
+        # none. Heights increase with range for zenith below 90 degrees,
+        # otherwise the farthest range bin is the lowest.
+        nrg = htmesh.shape[1]
+        rgind = np.zeros((htmesh.shape[0], len(hts)), dtype=np.int_)
+        for i, h in enumerate(htmesh):
+            if h[-1] > h[0]:
+                rgind[i, :] = np.searchsorted(h, hts, side='right') - 1
+            else:
+                rgind[i, :] = np.where(h[-1] <= hts, nrg-1, -1)
+        pgapzenview = pgapzenrgview[np.arange(htmesh.shape[0])[:, np.newaxis], rgind]
+        pgapzenview[rgind < 0] = 1.0
+
+        # mean of each zenith ring
+        ringstart = np.cumsum(ringcnt) - ringcnt
+        pgapzenhtview[:, htind] = np.add.reduceat(pgapzenview, ringstart[validzenind], axis=0) \
+            / ringcnt[validzenind][:, np.newaxis]
 
         return pgapzenhtview, self.midzeniths[validzenind]
 
@@ -528,7 +607,8 @@ class DWELClassProfile:
     def genWaveformPgap2DView(self, fwhm, \
                                   leaf_rho, leaf_Ialim, \
                                   wood_rho, wood_Ialim, \
-                                  plant_rho=None, plant_Ialim=None):
+                                  plant_rho=None, plant_Ialim=None, \
+                                  nproc=1):
         """
         Synthesize waveforms of apparent reflectance from points of apparent
         reflectance. Then calculate Pgap using the method of Jupp et. al. (2009)
@@ -561,6 +641,11 @@ class DWELClassProfile:
             plant_Ialim (2-element sequence-like): [Ia_min, Ia_max] to scale Ia
             to Pgap of all foliage elements.
 
+            nproc (int): number of worker processes. If more than one, rows
+            are split into partitions processed in a pool of workers, each
+            with its own read-only SPD file object. The views are the same as
+            from one process.
+
         Returns:
 
             PgapZenAzView (2D numpy array): Pgap at furthest waveform range in
@@ -576,18 +661,18 @@ class DWELClassProfile:
         """
         # create a spd file object with ybin size as 1, i.e. one row in SPD file
         # is a row we read out.
-        spdobj = spdtlsfile.SPDFile(self.inspdfile, resfactor=1)
+        spdobj = spdtlsfile.SPDFile(self.inspdfile, resfactor=1, mode=('a' if nproc == 1 else 'r'))
 
         # get sensor height
-        if spdobj.f['HEADER']['DEFINED_HEIGHT'][0] == 0:
-            self.sensorheight = spdobj.f['HEADER']['SENSOR_HEIGHT'][0]
+        if spdobj.header['DEFINED_HEIGHT'] == 0:
+            self.sensorheight = spdobj.header['SENSOR_HEIGHT']
         else:
             self.sensorheight = None
 
-        self.PgapZenRgView = {'zenith':np.zeros(spdobj.f['HEADER']['NUMBER_BINS_Y'][0])-1, \
+        self.PgapZenRgView = {'zenith':np.zeros(spdobj.header['NUMBER_BINS_Y'])-1, \
                                   'range':self.waveformsynrange}
-        self.PgapZenAzView = {'zenith':np.zeros(spdobj.f['HEADER']['NUMBER_BINS_Y'][0])-1, \
-                                  'azimuth':np.zeros(spdobj.f['HEADER']['NUMBER_BINS_X'][0])-1}
+        self.PgapZenAzView = {'zenith':np.zeros(spdobj.header['NUMBER_BINS_Y'])-1, \
+                                  'azimuth':np.zeros(spdobj.header['NUMBER_BINS_X'])-1}
 
         labelclass = {'leaf_'+self.bandlabel:self.leaflabel, \
                           'wood_'+self.bandlabel:self.woodlabel}
@@ -601,20 +686,85 @@ class DWELClassProfile:
             Ialimclass['plant_'+self.bandlabel] = plant_Ialim
         for name in rhoclass.keys():
             self.PgapZenRgView[name] = np.zeros((spdobj.nyblocks, self.nrgbins))-1
-            self.PgapZenAzView[name] = np.zeros((spdobj.nyblocks, spdobj.f['HEADER']['NUMBER_BINS_X'][0]))-1
+            self.PgapZenAzView[name] = np.zeros((spdobj.nyblocks, spdobj.header['NUMBER_BINS_X']))-1
         self.PgapZenRgView['classname'] = list(rhoclass.keys())
         self.PgapZenAzView['classname'] = list(rhoclass.keys())
 
-        pgap2d = np.ones((spdobj.f['HEADER']['NUMBER_BINS_X'][0], len(self.waveformsynrange)))*-1
-
         ngmodel = self.gaussianNormPulse(fwhm)
-        validrow = np.zeros(spdobj.f['HEADER']['NUMBER_BINS_Y'][0], dtype=np.bool_)
-        for row in range(spdobj.f['HEADER']['NUMBER_BINS_Y'][0]):
+        nrows = spdobj.header['NUMBER_BINS_Y']
+        self._validrow = np.zeros(nrows, dtype=np.bool_)
+        if nproc == 1:
+            self.genWaveformPgap2DViewRows(spdobj, 0, nrows, fwhm, ngmodel, labelclass, rhoclass, Ialimclass)
+        else:
+            global _parallel_args
+            # workers open their own SPD file objects
+            spdobj.closeSPDFile()
+            # more partitions than processes for load balance, because the
+            # number of points varies a lot with zenith
+            edges = np.unique(np.linspace(0, nrows, 4*nproc+1).astype(int))
+            print "\tCalculating Pgap 2D view by {0:d} partitions of rows in {1:d} processes".format(len(edges)-1, nproc)
+            # workers are forked and inherit the object, no pickling of it
+            _parallel_args = (self, fwhm, ngmodel, labelclass, rhoclass, Ialimclass)
+            pool = multiprocessing.Pool(nproc)
+            try:
+                outlist = pool.map(_genWaveformPgap2DViewPartition, zip(edges[:-1], edges[1:]))
+            finally:
+                pool.close()
+                pool.join()
+                _parallel_args = None
+            # partitions in the order of rows, so that azimuth of a column is
+            # from its last row with pulses as in one process.
+            for (r0, r1), (azset, azimuth, azzenith, rgzenith, validrows, viewslices) in zip(zip(edges[:-1], edges[1:]), outlist):
+                self.PgapZenAzView['azimuth'][azset] = azimuth
+                self.PgapZenAzView['zenith'][r0:r1] = azzenith
+                self.PgapZenRgView['zenith'][r0:r1] = rgzenith
+                self._validrow[r0:r1] = validrows
+                for name in rhoclass.keys():
+                    self.PgapZenAzView[name][r0:r1, :] = viewslices[name][0]
+                    self.PgapZenRgView[name][r0:r1, :] = viewslices[name][1]
+        validrow = self._validrow
+
+        for name in rhoclass.keys():
+            self.PgapZenAzView[name] = self.PgapZenAzView[name][validrow, :]
+            self.PgapZenRgView[name] = self.PgapZenRgView[name][validrow, :]
+
+        self.PgapZenAzView['zenith'] = self.PgapZenAzView['zenith'][validrow]
+        self.PgapZenRgView['zenith'] = self.PgapZenRgView['zenith'][validrow]
 
-            pulsedata, pointslist = spdobj.readSPDRowsList(row)
+        sys.stdout.write("Calculating Pgap 2D view finished!\n")
+        sys.stdout.flush()
+
+        if self.savevar:
+            if self.pgap2dmaxrg is None:
+                outnpzfile = self.tempprefix + "_"+self.bandlabel.lower()+"_Pgap2DView.npz"
+            else:
+                outnpzfile = self.tempprefix + "_"+self.bandlabel.lower()+"_Pgap2DView_MaxRg{0:.2f}.npz".format(self.pgap2dmaxrg)
+            np.savez(outnpzfile, \
+                         PgapZenAzView=self.PgapZenAzView, \
+                         PgapZenRgView=self.PgapZenRgView, \
+                         sensorheight=self.sensorheight)
+        return self.PgapZenAzView, self.PgapZenRgView, self.sensorheight
+
+
+    def genWaveformPgap2DViewRows(self, spdobj, rowstart, rowend, fwhm, ngmodel, \
+                                      labelclass, rhoclass, Ialimclass):
+        """
+        Calculate Pgap 2D views of rows in [rowstart, rowend) of the SPD file
+        and store them in the views initialized by genWaveformPgap2DView.
+
+        Returns:
+
+            azset (1D numpy array): boolean, if azimuth of a column is set
+            from these rows.
+        """
+        pgap2d = np.ones((spdobj.header['NUMBER_BINS_X'], len(self.waveformsynrange)))*-1
+        azset = np.zeros(spdobj.header['NUMBER_BINS_X'], dtype=np.bool_)
+        # rows are read in blocks and the index is read once into memory
+        plsperbin, binoffsets = spdobj.readSPDIndex()
+        for row, pulsedata, pointslist in spdobj.iterSPDRowsList(rowstart, rowend, csr=True):
 
             if pulsedata is not None:
-                validrow[row] = True
+                self._validrow[row] = True
                 # an extra check to see if each pulse in a row of SPD file has
                 # the same zenith angle.
                 meanzen = np.mean(pulsedata['ZENITH'])
@@ -622,15 +772,30 @@ class DWELClassProfile:
                     print "Warning, row {0:d} has different zenith values, {1:6e}".format(row, np.max(pulsedata['ZENITH'] - meanzen))
                 self.PgapZenAzView['zenith'][row] = meanzen
                 self.PgapZenRgView['zenith'][row] = meanzen
-                cnt = spdobj.f['INDEX']['PLS_PER_BIN'][row,:]
+                cnt = plsperbin[row,:]
                 validind = np.where(cnt > 0)[0]
                 self.PgapZenAzView['azimuth'][validind] = pulsedata['AZIMUTH']
+                azset[validind] = True
                 if (cnt[validind]>1).any():
                     splitind = np.cumsum(cnt[validind])[:-1]
                 else:
                     splitind = None
                 npls = len(validind)
-                if npls > 0:
+                if npls > 0 and self.wfengine == "scatter":
+                    # waveforms and Pgap of all the classes from one pass
+                    # over points
+                    classnames = list(rhoclass.keys())
+                    waveform3d = self.scatterClassWaveform2DFromPointsList(pointslist, ngmodel, splitind, \
+                                                                           [labelclass[name] for name in classnames])
+                    pgap3d = self.calcClassWaveformPgap(waveform3d, fwhm, \
+                                                        [rhoclass[name] for name in classnames], \
+                                                        [Ialimclass[name] for name in classnames])
+                    azrgbin = -1 if self.pgap2dmaxrgbin is None else self.pgap2dmaxrgbin
+                    for i, name in enumerate(classnames):
+                        self.PgapZenAzView[name][row, :] = -1.0
+                        self.PgapZenAzView[name][row, validind] = pgap3d[i, :, azrgbin]
+                        self.PgapZenRgView[name][row, :] = np.mean(pgap3d[i], axis=0)
+                elif npls > 0:
                     for name in rhoclass.keys():
                         pgap2d[:] = -1.0
                         waveform2d = self.genWaveform2DFromPointsList(pointslist, ngmodel, splitind, classlabel=labelclass[name])
@@ -649,36 +814,27 @@ class DWELClassProfile:
                         self.PgapZenRgView[name][row, :] = 1.0
 
             if self.verbose:
-                sys.stdout.write("Calculating Pgap 2D view at zenith angle NO. {0:d} / {1:d}      \r".format(row, spdobj.f['HEADER']['NUMBER_BINS_Y'][0]))
+                sys.stdout.write("Calculating Pgap 2D view at zenith angle NO. {0:d} / {1:d}      \r".format(row, spdobj.header['NUMBER_BINS_Y']))
                 sys.stdout.flush()
 
-        for name in rhoclass.keys():
-            self.PgapZenAzView[name] = self.PgapZenAzView[name][validrow, :]
-            self.PgapZenRgView[name] = self.PgapZenRgView[name][validrow, :]
-
-        self.PgapZenAzView['zenith'] = self.PgapZenAzView['zenith'][validrow]
-        self.PgapZenRgView['zenith'] = self.PgapZenRgView['zenith'][validrow]
-
-        sys.stdout.write("Calculating Pgap 2D view finished!\n")
-        sys.stdout.flush()
-
-        if self.savevar:
-            if self.pgap2dmaxrg is None:
-                outnpzfile = self.tempprefix + "_"+self.bandlabel.lower()+"_Pgap2DView.npz"
-            else:
-                outnpzfile = self.tempprefix + "_"+self.bandlabel.lower()+"_Pgap2DView_MaxRg{0:.2f}.npz".format(self.pgap2dmaxrg)
-            np.savez(outnpzfile, \
-                         PgapZenAzView=self.PgapZenAzView, \
-                         PgapZenRgView=self.PgapZenRgView, \
-                         sensorheight=self.sensorheight)
-        return self.PgapZenAzView, self.PgapZenRgView, self.sensorheight
-
+        return azset
 
     def genWaveform2DFromPointsList(self, pointslist, ngmodel, splitind=None, classlabel=None):
         """
         Create a 2D array of waveforms synthesized from points from multiple
         pulses in a row.
+
+        Args:
+
+            pointslist: lists of points of pulses, or a tuple (pointdata,
+            ptsoffsets) of flat points and pulse offsets, as returned by
+            SPDFile.readSPDRowsList with csr=True.
         """
+        if self.wfengine == "scatter":
+            return self.scatterWaveform2DFromPointsList(pointslist, ngmodel, splitind, classlabel)
+
+        if isinstance(pointslist, tuple):
+            pointslist = np.split(pointslist[0], pointslist[1][1:-1])
         npls = len(pointslist)
         nband = len(self.waveformsynrange)
         Waveform2D = [self.genWaveformFromPoints(ptsdata, ngmodel, classlabel) for ptsdata in pointslist]
@@ -690,6 +846,99 @@ class DWELClassProfile:
             Waveform2D = [np.mean(wf, axis=0) for wf in Waveform2DList]
             return np.array(Waveform2D)
         
+    def scatterWaveform2DFromPointsList(self, pointslist, ngmodel, splitind=None, classlabel=None):
+        """
+        Same waveforms as genWaveform2DFromPointsList from the "interp"
+        engine, but synthesized for all the pulses in a row at once by
+        scatterClassWaveform2DFromPointsList.
+        """
+        return self.scatterClassWaveform2DFromPointsList(pointslist, ngmodel, splitind, [classlabel])[0]
+
+    def scatterClassWaveform2DFromPointsList(self, pointslist, ngmodel, splitind=None, classlabels=(None,)):
+        """
+        Create 2D arrays of waveforms of multiple classes synthesized from
+        points from multiple pulses in a row, in one pass over the points.
+
+        Linear interpolation of the pulse model at a point range equals
+        splitting the point amplitude between its two neighboring range bins
+        and convolving with the pulse model. Each point thus adds the pulse
+        model, interpolated at its offset within a range bin, to the bins
+        around it, and all the points of the row are added to a class x
+        waveform x range bin array by one bincount, a point to the outputs of
+        its class and of all the points. Pulses of the same waveform given by
+        splitind are added together and averaged.
+
+        Args:
+
+            pointslist: lists of points of pulses, or a tuple (pointdata,
+            ptsoffsets) as in genWaveform2DFromPointsList.
+
+            classlabels (list): class label of each output, None for all
+            the points.
+
+        Returns:
+
+            Waveform3D (3D numpy array): [len(classlabels), number of
+            waveforms, number of range bins].
+        """
+        nband = len(self.waveformsynrange)
+        if isinstance(pointslist, tuple):
+            pointdata, ptsoffsets = pointslist
+            ptscnt = np.diff(ptsoffsets)
+        else:
+            ptscnt = np.array([0 if ptsdata is None else len(ptsdata) for ptsdata in pointslist], dtype=np.int_)
+            pointdata = None
+        npls = len(ptscnt)
+        if splitind is None:
+            nwf = npls
+            plsind = np.arange(npls)
+        else:
+            plscnt = np.diff(np.hstack(([0], splitind, [npls])))
+            nwf = len(plscnt)
+            plsind = np.repeat(np.arange(nwf), plscnt)
+
+        if np.sum(ptscnt) == 0:
+            return np.zeros((len(classlabels), nwf, nband))
+        if pointdata is None:
+            pointdata = np.concatenate([ptsdata for ptsdata in pointslist if ptsdata is not None and len(ptsdata) > 0])
+        else:
+            pointdata = pointdata[ptsoffsets[0]:ptsoffsets[-1]]
+        wfind = np.repeat(plsind, ptscnt)
+
+        # output index of each point for each class, -1 if the point is not
+        # of the class
+        nclass = len(classlabels)
+        clsind = np.zeros((len(pointdata), nclass), dtype=np.int_) - 1
+        for i, label in enumerate(classlabels):
+            if label is None:
+                clsind[:, i] = i
+            else:
+                clsind[pointdata['CLASSIFICATION'] == label, i] = i
+        ptsind, clsind = np.nonzero(clsind >= 0)
+        pointdata = pointdata[ptsind]
+        wfind = wfind[ptsind] + clsind*nwf
+
+        amp = pointdata['AMPLITUDE_RETURN'].astype(np.float_)
+        rg = pointdata['RANGE'].astype(np.float_)
+        # a point at range rg puts the pulse model sample i at range bin
+        # i+q. m is the bin of sample 0 after rounding q up, phi the weight
+        # of the previous sample.
+        q = (rg + ngmodel['x'][0]) / self.rgres
+        m = np.ceil(q)
+        phi = m - q
+        # pulse model interpolated at the offset of each point, one bin
+        # longer than the model
+        ypad = np.hstack(([0.0], ngmodel['y'], [0.0]))
+        kernel = (1-phi)[:, np.newaxis]*ypad[np.newaxis, :-1] + phi[:, np.newaxis]*ypad[np.newaxis, 1:]
+        binind = m.astype(np.int_)[:, np.newaxis] - 1 + np.arange(len(ypad)-1)[np.newaxis, :]
+        inrange = np.logical_and(binind >= 0, binind < nband)
+        flatind = (wfind[:, np.newaxis]*nband + binind)[inrange]
+        Waveform3D = np.bincount(flatind, weights=(amp[:, np.newaxis]*kernel)[inrange], minlength=nclass*nwf*nband)
+        Waveform3D = Waveform3D.reshape((nclass, nwf, nband))
+        if splitind is not None:
+            Waveform3D /= plscnt[np.newaxis, :, np.newaxis]
+        return Waveform3D
+
     def gaussianNormPulse(self, fwhm):
         """
         Utility function for genWaveformFromPoints. It returns a normalized
@@ -737,6 +986,33 @@ class DWELClassProfile:
         return np.sum(np.array(wflist), axis=0)
 
 
+    def calcClassWaveformPgap(self, waveform3d, fwhm, rho_d, Ialim):
+        """
+        Calculate scaled Pgap from waveforms of multiple classes stored in a
+        nclass-by-nw-by-nband 3D numpy array, with one cumulative sum of all
+        the classes. Pgap of a class is the same as from calcWaveformPgap
+        and is scaled in place.
+
+        Args:
+
+            rho_d (list): rho_d of each class.
+
+            Ialim (list): Ialim of each class, None to normalize the Pgap of
+            the class rather than scaling.
+        """
+        Pgap = np.cumsum(waveform3d, axis=2)
+        for i in range(waveform3d.shape[0]):
+            if Ialim[i] is None:
+                Pgap[i] = self.calcWaveformPgap(waveform3d[i], fwhm, rho_d[i], None)
+            else:
+                # (1 - Phitapp - min_Ia) / (max_Ia - min_Ia), clipped to [0, 1]
+                min_Ia = Ialim[i][0]
+                max_Ia = Ialim[i][1]
+                Pgap[i] *= -self.rgres/self.ptsampscale/(fwhm*rho_d[i])/(max_Ia - min_Ia)
+                Pgap[i] += (1.0 - min_Ia) / (max_Ia - min_Ia)
+                np.clip(Pgap[i], 0.0, 1.0, out=Pgap[i])
+        return Pgap
+
     def calcWaveformPgap(self, waveform, fwhm, rho_d, Ialim):
         """
         Calculate scaled Pgap from one or multiple waveforms. If multiple
@@ -135,25 +135,7 @@ def sortPoints(points, nrows=3142, ncols=1022):
 
         shotind (1D numpy array, int)
     """
-    shotind = (points[:, 1:2]-1)*nrows + points[:, 2:3]
-    tmppts = np.hstack((shotind, points[:, 0:1]))
-    ptsview = tmppts.view(dtype=np.dtype([('shotind', tmppts.dtype), ('range', tmppts.dtype)]))
-    sortind = np.argsort(ptsview, order=('shotind', 'range'), axis=0).squeeze()
-    ptsview = ptsview[sortind]
-
-    ushotind, uinvind, ucount = np.unique(shotind.squeeze(), return_inverse=True, return_counts=True)
-    num_of_returns = ucount[uinvind][sortind]
-    return_num = np.zeros(len(ptsview), dtype=int)
-    i = 0
-    while i<len(ptsview):
-        tmpcount = num_of_returns[i]
-        return_num[i:i+tmpcount] = np.arange(tmpcount, dtype=int)+1
-        i += tmpcount
-    tmpflag = np.less(ptsview['range'], 1e-10).squeeze()
-    num_of_returns[tmpflag] = 0
-    return_num[tmpflag] = 0
-
-    return sortind, num_of_returns, return_num, shotind.squeeze()[sortind]
+    return dpu.updateReturnNum(points, nrows=nrows)
 
 def getSkipLines(ptsfile, skip_header=0, comments="//"):
     with open(ptsfile) as fobj:
@@ -7,6 +7,12 @@ import time
 
 import numpy as np
 
+# add parent folder to Python path
+addpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if addpath not in sys.path:
+    sys.path.append(addpath)
+import utils.dwel_points_utils as dpu
+
 def getCmdArgs():
     p = argparse.ArgumentParser(description='Assimilate classification of merged mix class using structure information with CANUPO alogrithm and generate a binary classification of a whole point cloud')
 
@@ -155,25 +161,7 @@ class MergeMixPure:
 
             shotind (1D numpy array, int)
         """
-        shotind = (points[:, 1:2]-1)*self.nrows + points[:, 2:3]
-        tmppts = np.hstack((shotind, points[:, 0:1]))
-        ptsview = tmppts.view(dtype=np.dtype([('shotind', tmppts.dtype), ('range', tmppts.dtype)]))
-        sortind = np.argsort(ptsview, order=('shotind', 'range'), axis=0).squeeze()
-        ptsview = ptsview[sortind]
-
-        ushotind, uinvind, ucount = np.unique(shotind.squeeze(), return_inverse=True, return_counts=True)
-        num_of_returns = ucount[uinvind][sortind]
-        return_num = np.zeros(len(ptsview), dtype=int)
-        i = 0
-        while i<len(ptsview):
-            tmpcount = num_of_returns[i]
-            return_num[i:i+tmpcount] = np.arange(tmpcount, dtype=int)+1
-            i += tmpcount
-        tmpflag = np.less(ptsview['range'], 1e-10).squeeze()
-        num_of_returns[tmpflag] = 0
-        return_num[tmpflag] = 0
-
-        return sortind, num_of_returns, return_num, shotind.squeeze()[sortind]
+        return dpu.updateReturnNum(points, nrows=self.nrows)
 
 
 def main(cmdargs):
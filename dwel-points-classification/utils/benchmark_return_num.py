@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Benchmark the array-based return numbering in dwel_points_utils against the
+previous per-shot loop on a synthetic point cloud.
+
+USAGE:
+
+    python benchmark_return_num.py [-n NPTS] [-r NROWS] [-c NCOLS]
+
+"""
+
+import sys
+import os
+import argparse
+import time
+
+import numpy as np
+
+# add parent folder to Python path
+addpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if addpath not in sys.path:
+    sys.path.append(addpath)
+import utils.dwel_points_utils as dpu
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Benchmark return numbering of points")
+
+    p.add_argument("-n", "--npts", dest="npts", type=int, default=10000000, help="Number of synthetic points. Default: 10000000")
+    p.add_argument("-r", "--nrows", dest="nrows", type=int, default=3142, help="Number of rows in AT projection. Default: 3142")
+    p.add_argument("-c", "--ncols", dest="ncols", type=int, default=1022, help="Number of columns in AT projection. Default: 1022")
+    p.add_argument("--seed", dest="seed", type=int, default=0, help="Random seed. Default: 0")
+
+    cmdargs = p.parse_args()
+    return cmdargs
+
+def loopReturnNum(points, nrows=3142):
+    """
+    The previous return numbering with a loop over shots, as the reference.
+    """
+    shotind = (points[:, 1:2]-1)*nrows + points[:, 2:3]
+    tmppts = np.hstack((shotind, points[:, 0:1]))
+    ptsview = tmppts.view(dtype=np.dtype([('shotind', tmppts.dtype), ('range', tmppts.dtype)]))
+    sortind = np.argsort(ptsview, order=('shotind', 'range'), axis=0).squeeze()
+    ptsview = ptsview[sortind]
+
+    ushotind, uinvind, ucount = np.unique(shotind.squeeze(), return_inverse=True, return_counts=True)
+    num_of_returns = ucount[uinvind][sortind]
+    return_num = np.zeros(len(ptsview), dtype=int)
+    i = 0
+    while i<len(ptsview):
+        tmpcount = num_of_returns[i]
+        return_num[i:i+tmpcount] = np.arange(tmpcount, dtype=int)+1
+        i += tmpcount
+    tmpflag = np.less(ptsview['range'], 1e-10).squeeze()
+    num_of_returns[tmpflag] = 0
+    return_num[tmpflag] = 0
+
+    return sortind, num_of_returns, return_num, shotind.squeeze()[sortind]
+
+def synthPoints(npts, nrows, ncols, seed=0):
+    """
+    Synthetic points, [npts, 3], range, sample, line, with a few returns per
+    shot and some zero-hit shots. Samples and lines are 1-based as in the
+    point files.
+    """
+    rs = np.random.RandomState(seed)
+    nshots = max(npts/3, 1)
+    shots = rs.randint(0, nrows*ncols, size=nshots)
+    shots = shots[rs.randint(0, nshots, size=npts)]
+    points = np.zeros((npts, 3))
+    points[:, 0] = rs.uniform(0.5, 100.0, size=npts)
+    points[:, 1] = shots / nrows + 1
+    points[:, 2] = shots % nrows + 1
+    points[rs.uniform(size=npts)<0.01, 0] = 0.0
+    return points
+
+def main(cmdargs):
+    points = synthPoints(cmdargs.npts, cmdargs.nrows, cmdargs.ncols, seed=cmdargs.seed)
+    print "{0:d} synthetic points".format(len(points))
+
+    t0 = time.time()
+    kernelout = dpu.updateReturnNum(points, nrows=cmdargs.nrows)
+    tkernel = time.time() - t0
+    print "\tArray kernel: {0:.3f} s".format(tkernel)
+
+    t0 = time.time()
+    loopout = loopReturnNum(points, nrows=cmdargs.nrows)
+    tloop = time.time() - t0
+    print "\tShot loop: {0:.3f} s".format(tloop)
+
+    # compare on sorted (shot, range) values as ties can be ordered
+    # differently by the two sorts.
+    same = np.array_equal(points[kernelout[0]], points[loopout[0]]) \
+        and np.array_equal(kernelout[1], loopout[1]) \
+        and np.array_equal(kernelout[2], loopout[2]) \
+        and np.array_equal(kernelout[3], loopout[3])
+    print "\tSame outputs: {0}".format(same)
+    print "\tSpeedup: {0:.1f}x".format(tloop/tkernel)
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
@@ -3,8 +3,6 @@ import warnings
 
 import numpy as np
 
-import canupo
-
 _dwel_points_ascii_scheme = {'skip_header':0, \
                              'delimiter':",", \
                              'comments':"//"}
@@ -31,6 +29,51 @@ def loadPoints(inptsfile, usecols=['x', 'y', 'z', \
         data = data.view(arr_dtype).reshape(data.shape+(-1,))
     return data
 
+def updateReturnNum(points, nrows=3142):
+    """
+    Sort points by shot and range, count the number of returns and update
+    return number of each point according to the shot location (line, column)
+    and range. All with array operations, no loop over shots.
+
+    Args:
+
+        points (2D numpy array, float): [npts, 3], range, sample, line
+
+        nrows (int): number of rows (lines) in the AT projection.
+
+    Returns:
+
+        sortind (1D numpy array, int): indices that will sort the points by
+        shot indices and then range.
+
+        num_of_returns (1D numpy array, int): of sorted points, 0 for zero-hit
+        points.
+
+        return_num (1D numpy array, int): of sorted points, 0 for zero-hit
+        points.
+
+        shotind (1D numpy array): shot indices of sorted points.
+    """
+    npts = len(points)
+    shotind = (points[:, 1]-1)*nrows + points[:, 2]
+    sortind = np.lexsort((points[:, 0], shotind))
+    shotind = shotind[sortind]
+
+    # start of each shot in the sorted points
+    segflag = np.ones(npts, dtype=np.bool_)
+    segflag[1:] = np.not_equal(shotind[1:], shotind[:-1])
+    segstart = np.where(segflag)[0]
+    ucount = np.diff(np.append(segstart, npts))
+
+    num_of_returns = np.repeat(ucount, ucount)
+    # rank in a shot, position in the sorted points minus start of the shot
+    return_num = np.arange(npts, dtype=int) - np.repeat(segstart, ucount) + 1
+    tmpflag = np.less(points[sortind, 0], 1e-10)
+    num_of_returns[tmpflag] = 0
+    return_num[tmpflag] = 0
+
+    return sortind, num_of_returns, return_num, shotind
+
 def openMSC(mscfile):
     """
     Open an MSC file and set up some attributes for the class
@@ -40,6 +83,10 @@ def openMSC(mscfile):
 
 class MSCFile:
     def __init__(self, mscfile):
+        # canupo is only needed to read MSC files, import it here so that the
+        # rest of the utilities work without it.
+        import canupo
+
         self.mscfile = mscfile
         self._mscfobj = canupo.MSCFile(mscfile)
         self.header = self._mscfobj.get_header()
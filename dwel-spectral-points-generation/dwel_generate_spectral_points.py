@@ -9,7 +9,8 @@ point intensity at the wavelength of no return.
 USAGE:
 
     dwel_spectral_points_generator.py --nir <string> --swir <string> -o <string>
-    [-r <float>]
+    [-r <float>] [--engine <string>] [--stream [--chunk <int>] [--write-thread]]
+    [--nproc <int>] [--sweep <string>] [--cache-dir <string> [--cache-size <int>]]
 
 OPTIONS:
 
@@ -26,6 +27,40 @@ OPTIONS:
     a threshold of range difference between the two wavelengths to determine if
     two points are common points from the same target. [default: 0.75 m]
 
+    --engine <string>
+    engine of point pairing, "loop" to pair points shot by shot, "vectorized"
+    to pair points of all shots at once with array operations. [default: loop]
+
+    --stream
+    read, pair and write points chunk by chunk of scan lines to keep memory
+    bounded. Points in both input files must be ordered by sample.
+
+    --chunk <int>
+    number of scan lines (samples) in each chunk of stream mode. [default: 16]
+
+    --write-thread
+    format and write points in a background thread in stream mode.
+
+    --sweep <string>
+    comma-separated list of range difference thresholds. If set, points are
+    paired at all the thresholds in one run and a summary table of pair counts
+    and union fill fraction at each threshold is written to the output file
+    instead of a point cloud.
+
+    --nproc <int>
+    number of processes to merge points in parallel by bands of lines. Not
+    used in stream mode. [default: 1]
+
+    --cache-dir <string>
+    folder of the cache of point pairing. Reruns on the same input files with
+    the same pairing parameters, e.g. with another NDI image for union, reuse
+    the point pairs from the cache instead of pairing points again. Not used
+    in stream mode or with --nproc larger than 1.
+
+    --cache-size <int>
+    upper bound of the size of the cache in MB. Least recently used entries
+    are removed first. [default: 2048]
+
 EXAMPLES:
 
 AUTHORS:
@@ -51,6 +86,20 @@ def getCmdArgs():
     p.add_argument("-c", "--cols", dest="ncols", type=int, default=1022, help="Number of columns (samples) in the AT projection where points are generated. [default: 1022]")
     p.add_argument("-r", "--rows", dest="nrows", type=int, default=3142, help="Number of rows (lines) in the AT projection where points are generated. [default: 3142]")
 
+    p.add_argument("--engine", dest="engine", default=None, choices=["loop", "vectorized"], help="Engine of point pairing, 'loop' pairs points shot by shot, 'vectorized' pairs points of all shots at once with array operations. [default: loop]")
+
+    p.add_argument("--stream", dest="stream", default=False, action="store_true", help="Read, pair and write points chunk by chunk of scan lines to keep memory bounded. Points in both input files must be ordered by sample. Cannot be used with --nproc or --cache-dir. Default: false")
+    p.add_argument("--chunk", dest="chunk_samples", type=int, default=16, help="Number of scan lines (samples) in each chunk of stream mode. [default: 16]")
+
+    p.add_argument("--write-thread", dest="write_thread", default=False, action="store_true", help="Format and write points in a background thread in stream mode. Default: false")
+
+    p.add_argument("--sweep", dest="sweep", default=None, help="Comma-separated list of range difference thresholds. If set, pair points at all the thresholds in one run and write a summary table of pair counts and union fill fraction to the output file instead of a point cloud. Pairing is by the vectorized engine, and it cannot be used with --engine, --stream, --nproc or --cache-dir.")
+
+    p.add_argument("--nproc", dest="nproc", type=int, default=1, help="Number of processes to merge points in parallel by bands of lines. Cannot be used with --stream or --cache-dir. [default: 1]")
+
+    p.add_argument("--cache-dir", dest="cache_dir", default=None, help="Folder of the cache of point pairing. Reruns on the same input files with the same pairing parameters reuse the point pairs from the cache. Cannot be used with --stream or --nproc larger than 1.")
+    p.add_argument("--cache-size", dest="cache_size", type=int, default=2048, help="Upper bound of the size of the cache in MB. Least recently used entries are removed first. [default: 2048]")
+
     p.add_argument("--union", dest="union", default=False, action="store_true", help="Add more points in the output spectral point cloud with union of two point clouds. Point intensity will be synthesized with shot-by-shot NDI for points which have return at one wavelength but no return at the other. If set, must provide an NDI image for intensity synthesis. Default: false")
     p.add_argument("--ndi", dest="ndiimgfile", default=None, help="Shot-by-shot NDI image file for point intensity synthesis")
     
@@ -68,6 +117,19 @@ def getCmdArgs():
         print "NDI image file is required for spectral point cloud from union of two point clouds"
         sys.exit()
 
+    if cmdargs.sweep is not None:
+        if cmdargs.engine is not None or cmdargs.stream or cmdargs.nproc > 1 or cmdargs.cache_dir is not None:
+            p.error("--sweep cannot be used with --engine, --stream, --nproc or --cache-dir")
+    if cmdargs.engine is None:
+        cmdargs.engine = "loop"
+
+    if cmdargs.stream:
+        if cmdargs.nproc > 1 or cmdargs.cache_dir is not None:
+            p.error("--stream cannot be used with --nproc or --cache-dir")
+
+    if cmdargs.nproc > 1 and cmdargs.cache_dir is not None:
+        p.error("--nproc larger than 1 cannot be used with --cache-dir")
+
     return cmdargs
 
 def main(cmdargs):
@@ -82,8 +144,22 @@ def main(cmdargs):
     ndiimgfile = cmdargs.ndiimgfile
 
     spectral_points_obj = DWELSpectralPoints(nirfile, swirfile, rdiff_thresh, \
-                                                 nrows=nrows, ncols=ncols, verbose=cmdargs.verbose)
-    spectral_points_obj.generateSpectralPoints(outfile, union=union, ndiimgfile=ndiimgfile)
+                                                 nrows=nrows, ncols=ncols, engine=cmdargs.engine, \
+                                                 cache_dir=cmdargs.cache_dir, \
+                                                 cache_size=cmdargs.cache_size*1024**2, \
+                                                 verbose=cmdargs.verbose)
+    if cmdargs.sweep is not None:
+        thresholds = [ float(t) for t in cmdargs.sweep.split(',') ]
+        summary, intersectout = spectral_points_obj.sweepRangeDiffThreshold(thresholds)
+        print ",".join(summary.dtype.names)
+        for rec in summary:
+            print "{0:.3f},{1:d},{2:d},{3:d},{4:d},{5:.6f}".format(*rec)
+        spectral_points_obj.writeSweepSummary(summary, outfile)
+        return
+
+    spectral_points_obj.generateSpectralPoints(outfile, union=union, ndiimgfile=ndiimgfile, \
+                                                   stream=cmdargs.stream, chunk_samples=cmdargs.chunk_samples, \
+                                                   nproc=cmdargs.nproc, write_thread=cmdargs.write_thread)
 
 if __name__ == "__main__":
     cmdargs = getCmdArgs()
@@ -16,6 +16,7 @@ AUTHORS:
 
 import sys, os, argparse
 import time
+import multiprocessing
 
 from osgeo import gdal
 
@@ -23,6 +24,12 @@ import numpy as np
 
 from sklearn import neighbors
 
+# add dwel-data-utils folder to Python path
+addpath = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "dwel-data-utils")
+if addpath not in sys.path:
+    sys.path.append(addpath)
+import dwel_envi_raster as envi
+
 # import matplotlib as mpl
 # mpl.use('TkAgg')
 # import matplotlib.pyplot as plt
@@ -37,8 +44,19 @@ def getCmdArgs():
     p.add_argument("-o", "--outimg", dest="outimg", default="/projectnb/echidna/lidar/DWEL_Processing/HF2014/tmp-test-data/HFHD_20140608_C_cube_bsfix_pxc_update_atp2_ptcl_pcinfo_ndi_gapfilled.img", help="AT projection of gap-filled NDI image")
 
     p.add_argument("-k", dest="knn", type=int, default=3, help="Number of nearest neighbors to fill the gap")
+    p.add_argument("--nproc", dest="nproc", type=int, default=1, help="Number of processes to fill gaps by tiles of rows. If larger than 1, gaps are filled in tiled mode with grid search, and --method grid must be given. [default: 1]")
+    p.add_argument("--tile-rows", dest="tile_rows", type=int, default=None, help="Number of rows in a tile. If set, gaps are filled tile by tile with grid search and the memory use is bounded by the tile size, and --method grid must be given. [default: 256 if nproc > 1, otherwise no tiling]")
+    p.add_argument("--range-weight", dest="range_weight", type=float, default=None, help="If set, fill gaps with neighbors searched by both pixel location and mean range of the shots, with this weight of range in pixels per meter. Gaps are then filled on the whole image in one process, and it cannot be used with --nproc, --tile-rows or --method. [default: not set, pixel location only]")
+    p.add_argument("--method", dest="method", default=None, choices=["sklearn", "grid"], help="Method of nearest neighbor search, 'sklearn' uses KNeighborsRegressor of scikit-learn on all hit pixels, 'grid' searches neighbors in the order of distance directly on the image grid and is faster, but may pick a different neighbor among equidistant ones. [default: sklearn]")
 
     cmdargs = p.parse_args()
+    if cmdargs.range_weight is not None:
+        if cmdargs.nproc > 1 or cmdargs.tile_rows is not None or cmdargs.method is not None:
+            p.error("--range-weight cannot be used with --nproc, --tile-rows or --method")
+    if cmdargs.method is None:
+        cmdargs.method = "sklearn"
+    if (cmdargs.nproc > 1 or cmdargs.tile_rows is not None) and cmdargs.method != "grid":
+        p.error("--nproc larger than 1 and --tile-rows fill gaps with grid search, give --method grid with them")
     if (cmdargs.nirimg is None) or (cmdargs.swirimg is None) or (cmdargs.outimg is None):
         p.print_help()
         print("Input image files and output image files must be set.")
@@ -54,10 +72,47 @@ def main(cmdargs):
     
     ndigapfillobj = dwelNDIImgGapFill(nirimg, swirimg, outimg)
     print "Filling NDI gaps ..."
-    ndigapfillobj.fillNDIGap(knn)
+    if cmdargs.range_weight is not None:
+        ndigapfillobj.fillNDIGapRange(knn, rgweight=cmdargs.range_weight)
+    elif cmdargs.nproc > 1 or cmdargs.tile_rows is not None:
+        tile_rows = cmdargs.tile_rows if cmdargs.tile_rows is not None else 256
+        ndigapfillobj.fillNDIGapTiled(knn, nproc=cmdargs.nproc, tilerows=tile_rows)
+    else:
+        ndigapfillobj.fillNDIGap(knn, method=cmdargs.method)
     print "Writing NDI to ENVI image"
     ndigapfillobj.writeNDI(outimg)
 
+def _fillNDIGapTile(args):
+    """
+    Worker of dwelNDIImgGapFill.fillNDIGapTiled. Fill gaps in rows [r0, r1)
+    from the NDI of rows [r0-halo, r1+halo).
+
+    Returns:
+
+        r0, r1 (int): rows of the tile.
+
+        ndi, mask (2D numpy array): of the rows of the tile.
+
+        xpend, ypend (1D numpy array, int): image rows and columns of gap
+        pixels not filled within the halo.
+    """
+    nirfile, swirfile, bands, nrows, r0, r1, halo, knn = args
+    obj = dwelNDIImgGapFill(nirfile, swirfile, None, \
+                            rhoband=bands[0], nhitsband=bands[1], maskband=bands[2])
+    e0 = max(r0-halo, 0)
+    e1 = min(r1+halo, nrows)
+    ndi, mask, hitmask, gapmask = obj.calcNDI(yoff=e0, ysize=e1-e0)
+    # only the gap pixels in the tile, whose neighbors within halo are all in
+    # the rows read
+    gapmask[:r0-e0, :] = False
+    gapmask[r1-e0:, :] = False
+    xgap, ygap = np.where(gapmask)
+    gapvalues, pendind = obj._knnSweep(hitmask, ndi, xgap, ygap, knn, halo)
+    ndi[gapmask] = gapvalues
+    mask[gapmask] = 2
+    return r0, r1, ndi[r0-e0:r1-e0, :], mask[r0-e0:r1-e0, :], \
+        xgap[pendind]+e0, ygap[pendind]
+
 class dwelNDIImgGapFill:
     """
     Generate gap-filled NDI image from DWEL scans using K-nearest-neighbors
@@ -65,11 +120,17 @@ class dwelNDIImgGapFill:
     none.
     """
     def __init__(self, nirfile, swirfile, outfile, \
-                     rhoband=2, nhitsband=1, maskband=13):
+                     rhoband=2, nhitsband=1, maskband=13, \
+                     rangeband=7, rangescale=100.0):
         """
         Args:
 
             rhoband: band index of apparent reflectance, with first being 1.
+
+            rangeband: band index of mean range of hits of a shot, used by
+            fillNDIGapRange.
+
+            rangescale: scale factor of mean range band to meter.
         """
         self.nirfile = nirfile
         self.swirfile = swirfile
@@ -78,19 +139,25 @@ class dwelNDIImgGapFill:
         self.rhoband = rhoband
         self.nhitsband = nhitsband
         self.maskband = maskband
+        self.rangeband = rangeband
+        self.rangescale = rangescale
 
         self.ndi = None
         self.mask = None
 
-    def readImage(self, imgfile, band):
+    def readImage(self, imgfile, band, yoff=0, ysize=None):
         """
-        Read a band from an image file
+        Read a band from an image file, all the rows or ysize rows from yoff.
+        An ENVI image is memory-mapped, so only the rows are read from disk.
         """
-        imgds = gdal.Open(imgfile, gdal.GA_ReadOnly)
-        imgband = imgds.GetRasterBand(band)
-        imgdata = imgband.ReadAsArray(0, 0, imgband.XSize, imgband.YSize)
-        imgds = None
-        return imgdata
+        return envi.readBand(imgfile, band, yoff=yoff, ysize=ysize)
+
+    def getImageSize(self, imgfile):
+        """
+        Number of rows and columns of an image file.
+        """
+        nbands, nrows, ncols = envi.getRasterSize(imgfile)
+        return nrows, ncols
 
     def fillGap(self, X, y, T, knn):
         """
@@ -100,33 +167,181 @@ class dwelNDIImgGapFill:
         knnobj = neighbors.KNeighborsRegressor(knn)
         return knnobj.fit(X, y).predict(T)
 
-    def fillNDIGap(self, knn):
+    def fillGapGrid(self, hitmask, hitimg, gapmask, knn, maxradius=16, maxwindow=1000):
         """
-        Main function of gap filling.
-        Cacluate NDI image, find gaps and fill them.
+        Fill gaps of an image with the mean of the knn nearest hit pixels, the
+        same as fillGap with KNN regressor on pixel locations, but neighbors are
+        searched directly on the image grid. Pixel offsets within maxradius are
+        visited in the order of distance for all gap pixels at once, and each
+        gap pixel takes the first knn hit pixels. Gap pixels without knn hit
+        pixels within maxradius are searched one by one in windows of growing
+        size by _knnWindow, or by fillGap if there are more than maxwindow of
+        them, i.e. hit pixels are sparse. Hit pixels at the same distance are
+        taken in the order of (row, column), except in fillGap.
+
+        Args:
+
+            hitmask (2D numpy array, bool): pixels with values.
+
+            hitimg (2D numpy array): values at hit pixels.
+
+            gapmask (2D numpy array, bool): pixels to fill.
+
+            knn (int): number of nearest neighbors.
+
+            maxradius (int): distance in pixels of the search for all gap
+            pixels at once.
+
+            maxwindow (int): maximum number of gap pixels to search one by
+            one after the search within maxradius.
 
         Returns:
 
-            ndi (2D numpy array): gap-filled NDI
+            gapvalues (1D numpy array, float): filled values at gap pixels in
+            the order of np.where(gapmask).
+        """
+        if np.sum(hitmask) < knn:
+            raise RuntimeError("Fewer hit pixels than {0:d} nearest neighbors to fill gaps".format(knn))
+        xgap, ygap = np.where(gapmask)
+        gapvalues, pendind = self._knnSweep(hitmask, hitimg, xgap, ygap, knn, maxradius)
+        if len(pendind) > 0:
+            gapvalues[pendind] = self._knnFar(hitmask, hitimg, xgap[pendind], ygap[pendind], \
+                                              knn, 2*maxradius, maxwindow)
+        return gapvalues
 
-            mask (2D numpy array): 0, invalid shot if both NIR and SWIR claim
-            invalid; 1, measured NDI; 2: filled NDI; 3: no-return but valid
-            shots
+    def _knnSweep(self, hitmask, hitimg, xgap, ygap, knn, maxradius):
+        """
+        Search the knn nearest hit pixels of all gap pixels at once by visiting
+        pixel offsets within maxradius in the order of distance.
+
+        Returns:
+
+            gapvalues (1D numpy array, float): mean of the knn nearest hit
+            pixels, of gap pixels found knn hit pixels within maxradius.
+
+            pendind (1D numpy array, int): indices to gap pixels with fewer
+            than knn hit pixels within maxradius, whose gapvalues are not set.
+        """
+        nrows, ncols = hitmask.shape
+        gapvalues = np.zeros(len(xgap))
+
+        # offsets within maxradius sorted by distance, then row, then column
+        dr, dc = np.mgrid[-maxradius:maxradius+1, -maxradius:maxradius+1]
+        dr = dr.ravel()
+        dc = dc.ravel()
+        d2 = dr**2 + dc**2
+        tmpflag = d2 <= maxradius**2
+        dr, dc, d2 = dr[tmpflag], dc[tmpflag], d2[tmpflag]
+        sortind = np.lexsort((dc, dr, d2))
+        dr, dc = dr[sortind], dc[sortind]
+
+        # pad the images so that offsets never go out of the image, and look up
+        # pixels by flat indices
+        pwidth = ncols + 2*maxradius
+        padhit = np.zeros((nrows+2*maxradius, pwidth), dtype=np.bool_)
+        padhit[maxradius:maxradius+nrows, maxradius:maxradius+ncols] = hitmask
+        padval = np.zeros(padhit.shape)
+        padval[maxradius:maxradius+nrows, maxradius:maxradius+ncols][hitmask] = hitimg[hitmask]
+        padhit = padhit.ravel()
+        padval = padval.ravel()
+        offsets = dr*pwidth + dc
+
+        # gap pixels still searching for neighbors
+        pendind = np.arange(len(xgap))
+        pendpos = (xgap+maxradius)*pwidth + (ygap+maxradius)
+        pendsum = np.zeros(len(xgap))
+        pendcnt = np.zeros(len(xgap), dtype=int)
+        for off in offsets:
+            if len(pendind) == 0:
+                break
+            tmppos = pendpos + off
+            pendsum += padval[tmppos]
+            pendcnt += padhit[tmppos]
+            doneflag = pendcnt >= knn
+            if doneflag.any():
+                gapvalues[pendind[doneflag]] = pendsum[doneflag] / knn
+                tmpflag = np.logical_not(doneflag)
+                pendind = pendind[tmpflag]
+                pendpos = pendpos[tmpflag]
+                pendsum = pendsum[tmpflag]
+                pendcnt = pendcnt[tmpflag]
+
+        return gapvalues, pendind
+
+    def _knnFar(self, hitmask, hitimg, xgap, ygap, knn, halfsize, maxwindow, \
+                    rgimg=None, rgweight=0.0):
         """
-        nirrho = self.readImage(self.nirfile, self.rhoband).astype(np.float_)
-        nirnhits = self.readImage(self.nirfile, self.nhitsband).astype(np.int)
-        nirmask = self.readImage(self.nirfile, self.maskband).astype(np.bool_)
+        Mean of the knn nearest hit pixels of gap pixels with too few hit pixels
+        nearby, one by one by _knnWindow, or by fillGap if there are more than
+        maxwindow of them. If rgimg is given, weighted range is a third
+        coordinate of pixels as in fillNDIGapRange.
+        """
+        if len(xgap) > maxwindow:
+            xhit, yhit = np.where(hitmask)
+            X = np.hstack((xhit.reshape(len(xhit), 1), yhit.reshape(len(yhit), 1))).astype(np.float32)
+            T = np.hstack((xgap.reshape(len(xgap), 1), ygap.reshape(len(ygap), 1))).astype(np.float32)
+            if rgimg is not None:
+                X = np.hstack((X, rgweight*rgimg[xhit, yhit].reshape(len(xhit), 1))).astype(np.float32)
+                T = np.hstack((T, rgweight*rgimg[xgap, ygap].reshape(len(xgap), 1))).astype(np.float32)
+            return self.fillGap(X, hitimg[hitmask], T, knn)
+        gapvalues = np.zeros(len(xgap))
+        for i in range(len(xgap)):
+            gapvalues[i] = self._knnWindow(hitmask, hitimg, xgap[i], ygap[i], knn, halfsize, \
+                                           rgimg=rgimg, rgweight=rgweight)
+        return gapvalues
+
+    def _knnWindow(self, hitmask, hitimg, row, col, knn, halfsize, \
+                       rgimg=None, rgweight=0.0):
+        """
+        Mean of the knn nearest hit pixels of one pixel, searched in a square
+        window around the pixel. The window is doubled until knn hit pixels are
+        within the distance of its half size, i.e. no hit pixel outside the
+        window can be nearer, or until it covers the image. If rgimg is given,
+        weighted range difference adds to the distance, which does not change
+        the stop rule as it only makes hit pixels outside the window farther.
+        """
+        nrows, ncols = hitmask.shape
+        while True:
+            r0, r1 = max(row-halfsize, 0), min(row+halfsize+1, nrows)
+            c0, c1 = max(col-halfsize, 0), min(col+halfsize+1, ncols)
+            xhit, yhit = np.where(hitmask[r0:r1, c0:c1])
+            xhit += r0
+            yhit += c0
+            d2 = (xhit-row)**2 + (yhit-col)**2
+            if rgimg is not None:
+                d2 = d2 + (rgweight*(rgimg[xhit, yhit]-rgimg[row, col]))**2
+            wholeimg = r0 == 0 and c0 == 0 and r1 == nrows and c1 == ncols
+            if wholeimg or np.sum(d2 <= halfsize**2) >= knn:
+                break
+            halfsize *= 2
+        sortind = np.lexsort((yhit, xhit, d2))[:knn]
+        return np.sum(hitimg[xhit[sortind], yhit[sortind]]) / knn
+
+    def calcNDI(self, yoff=0, ysize=None):
+        """
+        Cacluate NDI and mask of the rows [yoff, yoff+ysize) of the images, or
+        all the rows if ysize is None, and find gaps.
+
+        Returns:
+
+            ndi (2D numpy array): NDI, 0 at gaps.
+
+            mask (2D numpy array): mask as returned by fillNDIGap, 3 at gaps.
+
+            hitmask (2D numpy array, bool): pixels with measured NDI.
+
+            gapmask (2D numpy array, bool): pixels with returns at only one
+            wavelength, i.e. gaps to fill.
+        """
+        nirrho = self.readImage(self.nirfile, self.rhoband, yoff=yoff, ysize=ysize).astype(np.float_)
+        nirnhits = self.readImage(self.nirfile, self.nhitsband, yoff=yoff, ysize=ysize).astype(np.int)
+        nirmask = self.readImage(self.nirfile, self.maskband, yoff=yoff, ysize=ysize).astype(np.bool_)
         
-        swirrho = self.readImage(self.swirfile, self.rhoband).astype(np.float_)
-        swirnhits = self.readImage(self.swirfile, self.nhitsband).astype(np.int)
-        swirmask = self.readImage(self.swirfile, self.maskband).astype(np.bool_)
+        swirrho = self.readImage(self.swirfile, self.rhoband, yoff=yoff, ysize=ysize).astype(np.float_)
+        swirnhits = self.readImage(self.swirfile, self.nhitsband, yoff=yoff, ysize=ysize).astype(np.int)
+        swirmask = self.readImage(self.swirfile, self.maskband, yoff=yoff, ysize=ysize).astype(np.bool_)
 
         hitmask = np.logical_and(np.greater(nirnhits, 0), np.greater(swirnhits, 0))
-        if not hitmask.any():
-            # no valid hit at all!
-            print "Error, no shot has returns! Check your data"
-            sys.exit()
-        xhit, yhit = np.where(hitmask)
         nirrhohit = nirrho[hitmask]/nirnhits[hitmask]
         swirrhohit = swirrho[hitmask]/swirnhits[hitmask]
 
@@ -141,18 +356,53 @@ class dwelNDIImgGapFill:
         
         nirgapmask = np.logical_and(np.equal(nirnhits, 0), np.greater(swirnhits, 0))
         swirgapmask = np.logical_and(np.greater(nirnhits, 0), np.equal(swirnhits, 0))
+        gapmask = np.logical_or(nirgapmask, swirgapmask)
+
+        return ndi, mask, hitmask, gapmask
+
+    def fillNDIGap(self, knn, method="sklearn"):
+        """
+        Main function of gap filling.
+        Cacluate NDI image, find gaps and fill them.
+
+        Args:
+
+            knn (int): number of nearest neighbors to fill a gap.
+
+            method (string): "sklearn", by KNN regressor of scikit-learn in
+            fillGap, or "grid", search nearest neighbors on the image grid by
+            fillGapGrid. The two can pick different neighbors among
+            equidistant ones.
+
+        Returns:
+
+            ndi (2D numpy array): gap-filled NDI
+
+            mask (2D numpy array): 0, invalid shot if both NIR and SWIR claim
+            invalid; 1, measured NDI; 2: filled NDI; 3: no-return but valid
+            shots
+        """
+        ndi, mask, hitmask, gapmask = self.calcNDI()
+        if not hitmask.any():
+            # no valid hit at all!
+            print "Error, no shot has returns! Check your data"
+            sys.exit()
 
-        if (not nirgapmask.any()) and (not swirgapmask.any()):
+        if not gapmask.any():
             # no gap
             print "No fillable gap."
             return ndi, mask
 
-        gapmask = np.logical_or(nirgapmask, swirgapmask)
-        xgap, ygap = np.where(gapmask)
-
-        X = np.hstack((xhit.reshape(len(xhit), 1), yhit.reshape(len(yhit), 1))).astype(np.float32)
-        T = np.hstack((xgap.reshape(len(xgap), 1), ygap.reshape(len(ygap), 1))).astype(np.float32)
-        ndigap = self.fillGap(X, ndihit, T, knn)
+        if method == "grid":
+            ndigap = self.fillGapGrid(hitmask, ndi, gapmask, knn)
+        elif method == "sklearn":
+            xhit, yhit = np.where(hitmask)
+            xgap, ygap = np.where(gapmask)
+            X = np.hstack((xhit.reshape(len(xhit), 1), yhit.reshape(len(yhit), 1))).astype(np.float32)
+            T = np.hstack((xgap.reshape(len(xgap), 1), ygap.reshape(len(ygap), 1))).astype(np.float32)
+            ndigap = self.fillGap(X, ndi[hitmask], T, knn)
+        else:
+            raise RuntimeError("Unknown method of gap filling: {0:s}".format(method))
         ndi[gapmask] = ndigap
         mask[gapmask] = 2
 
@@ -161,6 +411,252 @@ class dwelNDIImgGapFill:
         
         return ndi, mask
 
+    def fillNDIGapTiled(self, knn, nproc=1, tilerows=256, halo=16, maxwindow=1000):
+        """
+        Tiled version of fillNDIGap with grid search. The images are split into
+        tiles of rows and each tile is read with halo rows above and below, so
+        that the grid search within halo of a gap pixel in the tile sees the
+        same hit pixels as on the whole image. Tiles are filled in a pool of
+        nproc processes and stitched together. The few gap pixels with fewer
+        than knn hit pixels within halo are filled afterwards on the stitched
+        image. The result is the same as fillNDIGap with method "grid" and
+        maxradius of halo, and the memory of a process is bounded by the tile
+        size.
+
+        Args:
+
+            knn (int): number of nearest neighbors to fill a gap.
+
+            nproc (int): number of processes.
+
+            tilerows (int): number of rows in a tile.
+
+            halo (int): number of extra rows on each side of a tile, and the
+            distance of the grid search in a tile.
+
+            maxwindow (int): see fillGapGrid.
+
+        Returns:
+
+            ndi (2D numpy array): gap-filled NDI
+
+            mask (2D numpy array): see fillNDIGap.
+        """
+        nrows, ncols = self.getImageSize(self.nirfile)
+        ndi = np.zeros((nrows, ncols))
+        mask = np.zeros((nrows, ncols), dtype=int)
+        bands = (self.rhoband, self.nhitsband, self.maskband)
+        tileargs = [ (self.nirfile, self.swirfile, bands, nrows, r0, min(r0+tilerows, nrows), halo, knn) \
+                     for r0 in range(0, nrows, tilerows) ]
+
+        print "\tFilling gaps in {0:d} tiles of {1:d} rows in {2:d} processes".format(len(tileargs), tilerows, nproc)
+        xpend = []
+        ypend = []
+        if nproc > 1:
+            pool = multiprocessing.Pool(nproc)
+            try:
+                tileout = pool.imap_unordered(_fillNDIGapTile, tileargs)
+                for r0, r1, tilendi, tilemask, tilexpend, tileypend in tileout:
+                    ndi[r0:r1, :] = tilendi
+                    mask[r0:r1, :] = tilemask
+                    xpend.append(tilexpend)
+                    ypend.append(tileypend)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for args in tileargs:
+                r0, r1, tilendi, tilemask, tilexpend, tileypend = _fillNDIGapTile(args)
+                ndi[r0:r1, :] = tilendi
+                mask[r0:r1, :] = tilemask
+                xpend.append(tilexpend)
+                ypend.append(tileypend)
+
+        hitmask = np.equal(mask, 1)
+        if not hitmask.any():
+            # no valid hit at all!
+            print "Error, no shot has returns! Check your data"
+            sys.exit()
+        xpend = np.hstack(xpend).astype(int)
+        ypend = np.hstack(ypend).astype(int)
+        if len(xpend) > 0:
+            if np.sum(hitmask) < knn:
+                raise RuntimeError("Fewer hit pixels than {0:d} nearest neighbors to fill gaps".format(knn))
+            ndi[xpend, ypend] = self._knnFar(hitmask, ndi, xpend, ypend, knn, 2*halo, maxwindow)
+
+        self.ndi = ndi
+        self.mask = mask
+
+        return ndi, mask
+
+    def calcMeanRange(self, yoff=0, ysize=None):
+        """
+        Mean range of hits of the shots in meter, the average of the two
+        wavelengths if both have hits, otherwise of the wavelength with hits.
+        Rows are selected as in calcNDI.
+        """
+        nirnhits = self.readImage(self.nirfile, self.nhitsband, yoff=yoff, ysize=ysize).astype(np.int)
+        nirrg = self.readImage(self.nirfile, self.rangeband, yoff=yoff, ysize=ysize).astype(np.float_)/self.rangescale
+        swirnhits = self.readImage(self.swirfile, self.nhitsband, yoff=yoff, ysize=ysize).astype(np.int)
+        swirrg = self.readImage(self.swirfile, self.rangeband, yoff=yoff, ysize=ysize).astype(np.float_)/self.rangescale
+
+        nirflag = np.greater(nirnhits, 0)
+        swirflag = np.greater(swirnhits, 0)
+        meanrg = np.zeros_like(nirrg)
+        tmpflag = np.logical_and(nirflag, swirflag)
+        meanrg[tmpflag] = (nirrg[tmpflag] + swirrg[tmpflag]) / 2.0
+        tmpflag = np.logical_and(nirflag, np.logical_not(swirflag))
+        meanrg[tmpflag] = nirrg[tmpflag]
+        tmpflag = np.logical_and(swirflag, np.logical_not(nirflag))
+        meanrg[tmpflag] = swirrg[tmpflag]
+        return meanrg
+
+    def fillNDIGapRange(self, knn, rgweight=1.0, maxradius=32, maxwindow=1000):
+        """
+        Fill NDI gaps with the mean NDI of the knn nearest hit pixels, where
+        the mean range of a shot is a third coordinate besides its row and
+        column, so that a gap shot does not take NDI from shots at very
+        different ranges. The distance between two shots is
+
+            sqrt(drow**2 + dcol**2 + (rgweight*drange)**2)
+
+        Neighbors are searched on the image grid as in fillGapGrid by
+        _knnSweepRange, and those gap pixels not found within maxradius by
+        _knnFar.
+
+        Args:
+
+            knn (int): number of nearest neighbors to fill a gap.
+
+            rgweight (float): weight of range difference, in pixels per meter.
+
+            maxradius (int): distance in pixels of the search for all gap
+            pixels at once.
+
+            maxwindow (int): see fillGapGrid.
+
+        Returns:
+
+            ndi (2D numpy array): gap-filled NDI
+
+            mask (2D numpy array): see fillNDIGap.
+        """
+        ndi, mask, hitmask, gapmask = self.calcNDI()
+        if not hitmask.any():
+            # no valid hit at all!
+            print "Error, no shot has returns! Check your data"
+            sys.exit()
+
+        if not gapmask.any():
+            # no gap
+            print "No fillable gap."
+            return ndi, mask
+
+        if np.sum(hitmask) < knn:
+            raise RuntimeError("Fewer hit pixels than {0:d} nearest neighbors to fill gaps".format(knn))
+        meanrg = self.calcMeanRange()
+        xgap, ygap = np.where(gapmask)
+        gapvalues, pendind = self._knnSweepRange(hitmask, ndi, meanrg, xgap, ygap, knn, \
+                                                 rgweight, maxradius)
+        if len(pendind) > 0:
+            gapvalues[pendind] = self._knnFar(hitmask, ndi, xgap[pendind], ygap[pendind], \
+                                              knn, 2*maxradius, maxwindow, \
+                                              rgimg=meanrg, rgweight=rgweight)
+        ndi[gapmask] = gapvalues
+        mask[gapmask] = 2
+
+        self.ndi = ndi
+        self.mask = mask
+
+        return ndi, mask
+
+    def _knnSweepRange(self, hitmask, hitimg, rgimg, xgap, ygap, knn, rgweight, maxradius):
+        """
+        Search the knn nearest hit pixels of all gap pixels at once with
+        weighted range as a third coordinate. Pixel offsets within maxradius
+        are visited in the order of pixel distance and each gap pixel keeps its
+        knn nearest hit pixels so far. As the full distance is never smaller
+        than the pixel distance, a gap pixel is done once its knn-th nearest
+        distance is not larger than the pixel distance of the next offset.
+
+        Returns:
+
+            gapvalues, pendind: see _knnSweep.
+        """
+        nrows, ncols = hitmask.shape
+        gapvalues = np.zeros(len(xgap))
+
+        # offsets within maxradius sorted by distance, then row, then column
+        dr, dc = np.mgrid[-maxradius:maxradius+1, -maxradius:maxradius+1]
+        dr = dr.ravel()
+        dc = dc.ravel()
+        d2 = dr**2 + dc**2
+        tmpflag = d2 <= maxradius**2
+        dr, dc, d2 = dr[tmpflag], dc[tmpflag], d2[tmpflag]
+        sortind = np.lexsort((dc, dr, d2))
+        dr, dc, d2 = dr[sortind], dc[sortind], d2[sortind]
+
+        pwidth = ncols + 2*maxradius
+        padhit = np.zeros((nrows+2*maxradius, pwidth), dtype=np.bool_)
+        padhit[maxradius:maxradius+nrows, maxradius:maxradius+ncols] = hitmask
+        padval = np.zeros(padhit.shape)
+        padval[maxradius:maxradius+nrows, maxradius:maxradius+ncols][hitmask] = hitimg[hitmask]
+        padrg = np.zeros(padhit.shape)
+        padrg[maxradius:maxradius+nrows, maxradius:maxradius+ncols] = rgweight*rgimg
+        padhit = padhit.ravel()
+        padval = padval.ravel()
+        padrg = padrg.ravel()
+        offsets = dr*pwidth + dc
+
+        # knn nearest distances and values so far of the gap pixels still
+        # searching for neighbors
+        pendind = np.arange(len(xgap))
+        pendpos = (xgap+maxradius)*pwidth + (ygap+maxradius)
+        pendrg = padrg[pendpos]
+        kdist = np.zeros((len(xgap), knn)) + np.inf
+        kval = np.zeros((len(xgap), knn))
+        # the farthest of the knn nearest and its position
+        kworst = np.zeros(len(xgap)) + np.inf
+        iworst = np.zeros(len(xgap), dtype=int)
+        for io, off in enumerate(offsets):
+            if len(pendind) == 0:
+                break
+            tmppos = pendpos + off
+            tmpind = np.where(padhit[tmppos])[0]
+            tmpdist = d2[io] + (padrg[tmppos[tmpind]]-pendrg[tmpind])**2
+            tmpflag = tmpdist < kworst[tmpind]
+            tmpind = tmpind[tmpflag]
+            if len(tmpind) > 0:
+                # replace the farthest of the knn nearest
+                kpos = tmpind*knn + iworst[tmpind]
+                kdist.flat[kpos] = tmpdist[tmpflag]
+                kval.flat[kpos] = padval[tmppos[tmpind]]
+                iworst[tmpind] = np.argmax(kdist[tmpind, :], axis=1)
+                kworst[tmpind] = kdist.flat[tmpind*knn + iworst[tmpind]]
+
+            # hit pixels not visited yet are farther than maxradius after the
+            # last offset
+            nextd2 = d2[io+1] if io+1 < len(offsets) else maxradius**2+1
+            doneflag = kworst <= nextd2
+            # done pixels are not changed by further offsets, so they are only
+            # removed when there are many of them
+            ndone = np.sum(doneflag)
+            if ndone > 0 and (4*ndone > len(pendind) or io+1 == len(offsets)):
+                gapvalues[pendind[doneflag]] = np.sum(kval[doneflag, :], axis=1) / knn
+                tmpflag = np.logical_not(doneflag)
+                pendind = pendind[tmpflag]
+                pendpos = pendpos[tmpflag]
+                pendrg = pendrg[tmpflag]
+                kdist = kdist[tmpflag, :]
+                kval = kval[tmpflag, :]
+                kworst = kworst[tmpflag]
+                iworst = iworst[tmpflag]
+
+        return gapvalues, pendind
+
     def writeNDI(self, outfile):
         """write gap-filled NDI to an ENVI image file"""
         if self.ndi is None or self.mask is None:
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Convert the two ASCII point cloud files of NIR and SWIR bands to binary point
+files (NumPy .npy with a .fmt file of column print formats) for the generation
+of dual-wavelength spectral point cloud. Binary point files are loaded without
+text parsing, so repeated runs of dwel_generate_spectral_points.py, e.g. with
+different range difference thresholds, are much faster.
+
+USAGE:
+
+    dwel_points_ascii2npy.py --nir <string> --swir <string> [--nirout <string>]
+    [--swirout <string>]
+
+OPTIONS:
+
+    --nir <string>
+    (required) name of input point cloud file of NIR band.
+
+    --swir <string>
+    (required) name of input point cloud file of SWIR band.
+
+    --nirout <string>
+    name of output binary point file of NIR band. [default: input file name
+    with extension .npy]
+
+    --swirout <string>
+    name of output binary point file of SWIR band. [default: input file name
+    with extension .npy]
+
+EXAMPLES:
+
+AUTHORS:
+
+    Zhan Li, zhanli86@bu.edu
+
+"""
+
+import sys
+import os
+import argparse
+
+from dwel_spectral_points import DWELSpectralPoints
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Convert ASCII point cloud files of NIR and SWIR bands to binary point files for spectral point generation")
+
+    p.add_argument("-n", "--nir", dest="nirfile", required=True, default=None, help="Input point cloud file of NIR band")
+    p.add_argument("-s", "--swir", dest="swirfile", required=True, default=None, help="Input point cloud file of SWIR band")
+    p.add_argument("--nirout", dest="nirout", default=None, help="Output binary point file of NIR band. [default: input file name with extension .npy]")
+    p.add_argument("--swirout", dest="swirout", default=None, help="Output binary point file of SWIR band. [default: input file name with extension .npy]")
+
+    cmdargs = p.parse_args()
+
+    if (cmdargs.nirfile is None) or (cmdargs.swirfile is None):
+        p.print_help()
+        print "Two input point cloud files are required"
+        sys.exit()
+
+    return cmdargs
+
+def main(cmdargs):
+    nirfile = cmdargs.nirfile
+    swirfile = cmdargs.swirfile
+    nirout = cmdargs.nirout
+    if nirout is None:
+        nirout = os.path.splitext(nirfile)[0] + ".npy"
+    swirout = cmdargs.swirout
+    if swirout is None:
+        swirout = os.path.splitext(swirfile)[0] + ".npy"
+
+    spectral_points_obj = DWELSpectralPoints(nirfile, swirfile, 0.0)
+    for ptsfile, binfile in zip([nirfile, swirfile], [nirout, swirout]):
+        print "Converting {0:s}\n\tto {1:s}".format(ptsfile, binfile)
+        npts = spectral_points_obj.convertPointsToBinary(ptsfile, binfile)
+        print "\t{0:d} points".format(npts)
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
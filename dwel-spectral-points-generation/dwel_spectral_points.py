@@ -1,11 +1,171 @@
 import sys
+import os
 import time
+import tempfile
 import warnings
+import multiprocessing
+import threading
+import Queue
+import re
+import hashlib
 
 import numpy as np
 
-from osgeo import gdal
-gdal.AllRegister()
+# add dwel-data-utils folder to Python path
+addpath = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "dwel-data-utils")
+if addpath not in sys.path:
+    sys.path.append(addpath)
+import dwel_envi_raster as envi
+# add dwel-points-classification folder to Python path
+addpath = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "dwel-points-classification")
+if addpath not in sys.path:
+    sys.path.append(addpath)
+import utils.dwel_points_utils as dpu
+
+# spectral points object and the two point clouds shared with forked workers of
+# DWELSpectralPoints.mergePointCloudsParallel
+_parallel_args = None
+
+def _mergePointCloudsPartition(lines):
+    """
+    Worker of DWELSpectralPoints.mergePointCloudsParallel. Merge points with
+    line in [lines[0], lines[1]).
+    """
+    obj, nirpoints, swirpoints = _parallel_args
+    lc = obj.ind_label.index('line')
+    nirmask = np.logical_and(nirpoints[:, lc] >= lines[0], nirpoints[:, lc] < lines[1])
+    swirmask = np.logical_and(swirpoints[:, lc] >= lines[0], swirpoints[:, lc] < lines[1])
+    return obj.mergePointClouds(nirpoints[nirmask, :], swirpoints[swirmask, :])
+
+def _digitMatrix(intvalues, ndigits=None):
+    """
+    Decimal digits of non-negative integers as characters.
+
+    Args:
+
+        intvalues (1D numpy array, int64): non-negative integers.
+
+        ndigits (int): if given, number of digits with leading zeros kept,
+        otherwise as many as the largest value and leading zeros are 0.
+
+    Returns:
+
+        strmat (2D numpy array, uint8): [nvalues, ndigits]
+    """
+    zeropad = ndigits is not None
+    if not zeropad:
+        ndigits = len(str(int(intvalues.max()))) if len(intvalues) > 0 else 1
+    pow10 = 10**np.arange(ndigits-1, -1, -1, dtype=np.int64)
+    strmat = (intvalues.reshape(-1, 1) // pow10 % 10 + ord('0')).astype(np.uint8)
+    if not zeropad:
+        leadflag = np.less(intvalues.reshape(-1, 1), pow10)
+        leadflag[:, -1] = False
+        strmat[leadflag] = 0
+    return strmat
+
+def _formatColumn(values, fmt):
+    """
+    Format a column of values at once with a printf-style format of a single
+    value, as np.savetxt would do value by value.
+
+    Formats "%d" and "%.<n>f" are converted with array operations. The rest,
+    and those values where rounding to n decimals may be a tie in double
+    precision, are formatted by Python.
+
+    Returns:
+
+        strmat (2D numpy array, uint8): [nvalues, width], characters of each
+        value. Unused characters are 0 and may be anywhere in a row.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    nval = len(values)
+    if nval == 0:
+        return np.zeros((0, 1), dtype=np.uint8)
+    fixmatch = re.match(r"^%\.(\d+)f$", fmt)
+    pyflag = np.logical_not(np.isfinite(values))
+    if fmt in ("%d", "%i"):
+        # %d truncates toward zero as int()
+        absvalues = np.fabs(values)
+        pyflag = np.logical_or(pyflag, np.greater_equal(absvalues, 2.0**62))
+        absvalues[pyflag] = 0
+        intvalues = absvalues.astype(np.int64)
+        sign = np.where(np.logical_and(np.less(values, 0), intvalues > 0), ord('-'), 0)
+        strmat = np.hstack((sign.astype(np.uint8).reshape(nval, 1), _digitMatrix(intvalues)))
+    elif fixmatch is not None:
+        ndec = int(fixmatch.group(1))
+        scale = 10**ndec
+        scaled = np.fabs(values) * float(scale)
+        scaled[pyflag] = 0
+        # rounding of the scaled value can be wrong only if it is close to a tie
+        pyflag = np.logical_or(pyflag, np.less_equal(np.fabs(scaled - np.floor(scaled) - 0.5), \
+                                                     4*np.spacing(scaled)))
+        pyflag = np.logical_or(pyflag, np.greater_equal(scaled, 2.0**52))
+        scaled[pyflag] = 0
+        intvalues = np.rint(scaled).astype(np.int64)
+        # %f keeps the sign of negative values rounded to zero
+        sign = np.where(np.signbit(values), ord('-'), 0).astype(np.uint8).reshape(nval, 1)
+        if ndec > 0:
+            dot = np.zeros((nval, 1), dtype=np.uint8) + ord('.')
+            strmat = np.hstack((sign, _digitMatrix(intvalues // scale), dot, \
+                                _digitMatrix(intvalues % scale, ndigits=ndec)))
+        else:
+            strmat = np.hstack((sign, _digitMatrix(intvalues)))
+    else:
+        pyflag[:] = True
+        strmat = np.zeros((nval, 1), dtype=np.uint8)
+
+    pyind = np.where(pyflag)[0]
+    if len(pyind) > 0:
+        pystr = [ fmt % v for v in values[pyind] ]
+        width = max(len(ps) for ps in pystr)
+        if width > strmat.shape[1]:
+            strmat = np.hstack((strmat, np.zeros((nval, width-strmat.shape[1]), dtype=np.uint8)))
+        strmat[pyind, :] = 0
+        strmat[pyind, :width] = np.array(pystr, dtype="S{0:d}".format(width)).view(np.uint8).reshape(-1, width)
+    return strmat
+
+def formatPoints(points, fmt, delimiter=','):
+    """
+    Format rows of points to text in the same way as np.savetxt, with one
+    format string per column, but column by column with array operations.
+
+    Returns:
+
+        text (string): lines of formatted points, each ending with a newline.
+    """
+    npts = len(points)
+    delim = np.tile(np.frombuffer(delimiter, dtype=np.uint8), (npts, 1))
+    newline = np.zeros((npts, 1), dtype=np.uint8) + ord('\n')
+    strmats = []
+    for i, colfmt in enumerate(fmt):
+        strmats.append(_formatColumn(points[:, i], colfmt))
+        strmats.append(delim if i < len(fmt)-1 else newline)
+    buf = np.hstack(strmats).ravel()
+    return buf[buf != 0].tostring()
+
+def isBinaryPointsFile(ptsfile):
+    """
+    If a point cloud file is a binary point file from
+    DWELSpectralPoints.convertPointsToBinary
+    """
+    return os.path.splitext(ptsfile)[1].lower() == ".npy"
+
+def readBinaryPointsFormat(binfile):
+    """
+    Read print formats of columns from the format file of a binary point file.
+
+    Returns:
+
+        col_dtype (dict): column name to format string
+    """
+    col_dtype = {}
+    with open(binfile+".fmt", 'r') as fmtfobj:
+        fmtfobj.readline()
+        for line in fmtfobj:
+            key, val = [ tok.strip() for tok in line.split('=', 1) ]
+            if key != "source":
+                col_dtype[key] = val
+    return col_dtype
 
 class DWELSpectralPoints:
     """
@@ -19,7 +179,22 @@ class DWELSpectralPoints:
 
     def __init__(self, nirptsfile, swirptsfile, rdiff_thresh, \
                      nrows=3142, ncols=1022, \
+                     engine="loop", \
+                     cache_dir=None, cache_size=2*1024**3, \
                      verbose=False):
+        """
+        Args:
+
+            engine (string): engine of point pairing in intersectPointClouds,
+            "loop", the original shot-by-shot loop, or "vectorized", the
+            array-based pairing of all shots at once.
+
+            cache_dir (string): folder of the cache of point pairing. If given,
+            generateSpectralPoints reuses the pairing of the same input files
+            and parameters from previous runs. None to disable the cache.
+
+            cache_size (int): upper bound of the cache size in bytes.
+        """
 
         self.nirfile = nirptsfile
         self.swirfile = swirptsfile
@@ -27,6 +202,15 @@ class DWELSpectralPoints:
         self.nrows = nrows
         self.ncols = ncols
 
+        if engine not in ("loop", "vectorized"):
+            raise RuntimeError("Unknown point pairing engine: {0:s}".format(engine))
+        self.engine = engine
+
+        if cache_dir is not None:
+            self.cache = DWELPairingCache(cache_dir, maxbytes=cache_size)
+        else:
+            self.cache = None
+
         self.verbose = verbose
 
         # ------------------------------------------------------------
@@ -54,53 +238,102 @@ class DWELSpectralPoints:
         self.tot_col = len(self.ind_label)
         self.arr_dtype = np.float32
 
+        # gap-filled NDI image opened by _lookupNDIImage
+        self._ndiimg = None
+
     def inferColDataType(self):
-        # infer the data type of columns in the ASCII data file
-        with open(self.nirfile, 'r') as nirptsfobj:
-            for i in range(self.headerlines):
-                nirptsfobj.readline()
-            line_cnt = 0
-            for nir_line in nirptsfobj:
-                if nir_line.lstrip().find(self.comments) == 0:
-                    continue
-                else:
-                    line_cnt = line_cnt + 1
-                if line_cnt >= 2:
-                    nir_col_str = nir_line.split(',')
-                    nir_col_dtype = [ self._inferDataType(ncs.strip()) for ncs in nir_col_str ]
-                    break
+        # infer the data type of columns in the point cloud files
+        nir_col_dtype = self._colDataType(self.nirfile)
+        swir_col_dtype = self._colDataType(self.swirfile)
+
+        for nm in self.ind_label:
+            if nir_col_dtype[nm] != swir_col_dtype[nm]:
+                warning_msg = "Detected different data types between NIR and SWIR in the columns of ASCII point cloud files\n" \
+                              + "Use detected data types of the columns in NIR ASCII point cloud file"
+                warnings.warn(warning_msg, RuntimeWarning)
+
+        return {nm:nir_col_dtype[nm] for nm in self.ind_label}
+
+    def _colDataType(self, ptsfile):
+        """
+        Print formats of all the columns in a point cloud file, from the format
+        file of a binary point file, or inferred from an ASCII file.
+
+        Returns:
+
+            col_dtype (dict): column name to format string
+        """
+        if isBinaryPointsFile(ptsfile):
+            return readBinaryPointsFormat(ptsfile)
 
-        with open(self.swirfile, 'r') as swirptsfobj:
+        # infer the data type of columns in the ASCII data file
+        with open(ptsfile, 'r') as ptsfobj:
             for i in range(self.headerlines):
-                swirptsfobj.readline()
+                ptsfobj.readline()
             line_cnt = 0
-            for swir_line in swirptsfobj:
-                if swir_line.lstrip().find(self.comments) == 0:
+            for pts_line in ptsfobj:
+                if pts_line.lstrip().find(self.comments) == 0:
                     continue
                 else:
                     line_cnt = line_cnt + 1
                 if line_cnt >= 2:
-                    swir_col_str = swir_line.split(',')
-                    swir_col_dtype = [ self._inferDataType(ncs.strip()) for ncs in swir_col_str ]
+                    pts_col_str = pts_line.split(',')
+                    pts_col_dtype = [ self._inferDataType(ncs.strip()) for ncs in pts_col_str ]
                     break
 
-        for ncd, scd in zip(nir_col_dtype, swir_col_dtype):
-            if ncd != scd:
-                warning_msg = "Detected different data types between NIR and SWIR in the columns of ASCII point cloud files\n" \
-                              + "Use detected data types of the columns in NIR ASCII point cloud file"
-                warnings.warn(warning_msg, RuntimeWarning)
-
-        testpoints = np.genfromtxt(self.nirfile, \
+        testpoints = np.genfromtxt(ptsfile, \
                                    delimiter=',', skip_header=self.headerlines, \
                                    filling_values=np.nan, usemask=False, \
                                    names=True, case_sensitive="lower", comments=self.comments, \
                                    max_rows=1)
-        ind = np.zeros(len(self.ind_label), dtype=int)
-        for i, nm in enumerate(self.ind_label):
-            ind[i] = np.where(np.in1d(testpoints.dtype.names, nm))[0][0]
 
-        return {nm:nir_col_dtype[i] for nm, i in zip(self.ind_label, ind)}
-                
+        return {nm:fmt for nm, fmt in zip(testpoints.dtype.names, pts_col_dtype)}
+
+    def loadPoints(self, ptsfile):
+        """
+        Load the columns in self.ind_label from a point cloud file, either an
+        ASCII file or a binary point file from convertPointsToBinary.
+
+        Returns:
+
+            points (2D numpy array, [npts, ncols]): columns in the order of
+            self.ind_label.
+        """
+        if isBinaryPointsFile(ptsfile):
+            binpoints = np.load(ptsfile, mmap_mode='r')
+            points = np.empty((len(binpoints), self.tot_col), dtype=self.arr_dtype)
+            for i, nm in enumerate(self.ind_label):
+                points[:, i] = binpoints[nm]
+            return points
+
+        points = np.genfromtxt(ptsfile, dtype=self.arr_dtype, usecols=self.ind_label, \
+                               delimiter=',', skip_header=self.headerlines, \
+                               filling_values=np.nan, usemask=False, \
+                               names=True, case_sensitive="lower", comments=self.comments)
+        return points.view(self.arr_dtype).reshape(points.shape+(-1,))
+
+    def convertPointsToBinary(self, ptsfile, binfile):
+        """
+        Convert an ASCII point cloud file to a binary point file, a NumPy .npy
+        file of a structured array with all the columns named as in the header
+        line, plus a format file (binfile + ".fmt") of the print format of each
+        column. Binary point files are read without text parsing and can be
+        used in place of ASCII files for the NIR and SWIR point clouds.
+        """
+        if not isBinaryPointsFile(binfile):
+            raise RuntimeError("Binary point file must have the extension .npy: {0:s}".format(binfile))
+        col_dtype = self._colDataType(ptsfile)
+        points = np.genfromtxt(ptsfile, dtype=self.arr_dtype, \
+                               delimiter=',', skip_header=self.headerlines, \
+                               filling_values=np.nan, usemask=False, \
+                               names=True, case_sensitive="lower", comments=self.comments)
+        np.save(binfile, points)
+        with open(binfile+".fmt", 'w') as fmtfobj:
+            fmtfobj.write("DWEL binary points\n")
+            fmtfobj.write("source = {0:s}\n".format(ptsfile))
+            for nm in points.dtype.names:
+                fmtfobj.write("{0:s} = {1:s}\n".format(nm, col_dtype[nm]))
+        return len(points)
 
     def _inferDataType(self, num_str):
         num_str = num_str.strip()
@@ -112,9 +345,26 @@ class DWELSpectralPoints:
             return "%.{0:d}f".format(n_sig)
                 
         
-    def generateSpectralPoints(self, outfile, union=False, ndiimgfile=None):
+    def generateSpectralPoints(self, outfile, union=False, ndiimgfile=None, \
+                                   stream=False, chunk_samples=16, nproc=1, \
+                                   write_thread=False):
         """
         Main function to generate spectral points
+
+        Args:
+
+            stream (bool): if True, read, pair and write points chunk by chunk
+            of scan lines instead of loading both point clouds at once. Points
+            in both input files must be ordered by sample.
+
+            chunk_samples (int): number of scan lines, i.e. samples (columns in
+            AT projection), in each chunk of stream mode.
+
+            nproc (int): number of worker processes to merge points by bands
+            of lines. Not used in stream mode.
+
+            write_thread (bool): if True, format and write points in a
+            background thread in stream mode.
         """
 
         if union and (ndiimgfile is None):
@@ -136,28 +386,237 @@ class DWELSpectralPoints:
         print "Info for converting sample and line to shot number: \n" \
             + "\tnumber of rows: {0:d}, number of columns: {1:d}".format(nrows, ncols)
 
-        # read points from text file
+        if stream:
+            self.generateSpectralPointsStream(outfile, chunk_samples, write_thread=write_thread)
+            return
+
+        # read points from text or binary file
         print "Loading points"
-        nirpoints = np.genfromtxt(nirfile, dtype=self.arr_dtype, usecols=self.ind_label, \
-                                  delimiter=',', skip_header=self.headerlines, \
-                                  filling_values=np.nan, usemask=False, \
-                                  names=True, case_sensitive="lower", comments=self.comments)
-        swirpoints = np.genfromtxt(swirfile, dtype=self.arr_dtype, usecols=self.ind_label, \
-                                   delimiter=',', skip_header=self.headerlines, \
-                                   filling_values=np.nan, usemask=False, \
-                                   names=True, case_sensitive="lower", comments=self.comments)
-        nirpoints = nirpoints.view(self.arr_dtype).reshape(nirpoints.shape+(-1,))
-        swirpoints = swirpoints.view(self.arr_dtype).reshape(swirpoints.shape+(-1,))
+        nirpoints = self.loadPoints(nirfile)
+        swirpoints = self.loadPoints(swirfile)
+
+        print "Generating spectral points ..."
+        if nproc > 1:
+            outpoints = self.mergePointCloudsParallel(nirpoints, swirpoints, nproc)
+        elif self.cache is not None:
+            intersectout = self.cachedIntersectPointClouds(nirpoints, swirpoints)
+            outpoints = self.mergePointClouds(nirpoints, swirpoints, intersectout=intersectout)
+        else:
+            outpoints = self.mergePointClouds(nirpoints, swirpoints)
+
+        headerstr = self._outputHeader()
+        fmtstr = self._outputFormat()
 
+        outpoints = self.addColorComposite(outpoints)
+
+        print "Saving dual-wavelength points: "+str(len(outpoints))
+
+        writer = DWELPointsWriter(outfile, fmtstr, delimiter=',', header=headerstr.rstrip())
+        writer.write(outpoints)
+        writer.close()
+
+    def generateSpectralPointsStream(self, outfile, chunk_samples, write_thread=False):
+        """
+        Generate spectral points in stream mode. Points of a chunk of scan lines
+        are read from both point clouds, paired and merged, and the merged
+        points are kept in a temporary binary file next to the output. The
+        reflectance bounds for clipping and color composite are then found from
+        the temporary file and the output is written chunk by chunk. Memory is
+        bounded by the points in a chunk, not the size of the scan.
+
+        If write_thread, points of a chunk are formatted and written in a
+        background thread while the next chunk is colored.
+        """
+        print "Streaming points by chunks of {0:d} scan lines".format(chunk_samples)
+        readers = []
+        for ptsfile in [self.nirfile, self.swirfile]:
+            if isBinaryPointsFile(ptsfile):
+                readers.append(DWELBinaryPointsChunkReader(ptsfile, self.ind_label, 'sample', \
+                                                           dtype=self.arr_dtype))
+            else:
+                readers.append(DWELPointsChunkReader(ptsfile, self.ind_label, 'sample', \
+                                                     headerlines=self.headerlines, comments=self.comments, \
+                                                     dtype=self.arr_dtype))
+        nirreader, swirreader = readers
+
+        headerstr = self._outputHeader()
+        fmtstr = self._outputFormat()
+        noutcol = len(fmtstr) - 3
+
+        tmpfd, tmpfile = tempfile.mkstemp(suffix=".bin", prefix=".dwel_spectral_points_", \
+                                          dir=os.path.dirname(os.path.abspath(outfile)))
+        try:
+            # first pass, pair and merge points chunk by chunk
+            chunkrows = []
+            nhit = 0
+            sample_end = 1
+            with os.fdopen(tmpfd, 'wb') as tmpfobj:
+                while not (nirreader.exhausted() and swirreader.exhausted()):
+                    sample_end += chunk_samples
+                    nirpoints = nirreader.readUntil(sample_end)
+                    swirpoints = swirreader.readUntil(sample_end)
+                    if len(nirpoints) == 0 and len(swirpoints) == 0:
+                        continue
+                    outpoints = self.mergePointClouds(nirpoints, swirpoints)
+                    outpoints.astype(np.float64).tofile(tmpfobj)
+                    chunkrows.append(len(outpoints))
+                    nhit += np.sum(outpoints[:, 6].astype(int) > 0)
+                    if self.verbose:
+                        sys.stdout.write("Merged points up to sample {0:d}: {1:d}      \r".format(sample_end-1, sum(chunkrows)))
+                        sys.stdout.flush()
+            nirreader.close()
+            swirreader.close()
+
+            # reflectance bounds of all hit points, same as np.percentile in
+            # addColorComposite
+            if nhit > 0:
+                qind = np.array([2, 98])/100.0*(nhit-1)
+                qlo = np.floor(qind).astype(int)
+                qhi = np.ceil(qind).astype(int)
+                qw = qind - qlo
+                ranks = np.unique(np.hstack((qlo, qhi)))
+                stats = self._orderStats(tmpfile, noutcol, chunkrows, [3, 4], ranks)
+                bound = np.zeros(2)
+                colorbound = np.zeros((2, 3))
+                for i, col in enumerate([3, 4]):
+                    vlo = np.array([stats[col][r] for r in qlo])
+                    vhi = np.array([stats[col][r] for r in qhi])
+                    bound[i] = (vlo*(1-qw) + vhi*qw)[1]
+                    if bound[i] < self.i_scale:
+                        bound[i] = self.i_scale
+                    # color composite is from clipped reflectance, the order
+                    # statistics of which are the clipped order statistics.
+                    vlo[vlo>bound[i]] = bound[i]
+                    vhi[vhi>bound[i]] = bound[i]
+                    # red from SWIR, green from NIR
+                    colorbound[:, 1-i] = vlo*(1-qw) + vhi*qw
+            else:
+                bound = np.zeros(2) + self.i_scale
+                colorbound = np.zeros((2, 3))
+
+            # second pass, write points
+            print "Saving dual-wavelength points: "+str(sum(chunkrows))
+            writer = DWELPointsWriter(outfile, fmtstr, delimiter=',', header=headerstr.rstrip(), \
+                                      background=write_thread)
+            try:
+                for outpoints in self._readTmpChunks(tmpfile, noutcol, chunkrows):
+                    writer.write(self.addColorComposite(outpoints, bound=bound, colorbound=colorbound))
+            finally:
+                writer.close()
+        finally:
+            os.remove(tmpfile)
+
+    def _readTmpChunks(self, tmpfile, ncol, chunkrows):
+        """
+        Read back chunks of merged points from the temporary binary file of
+        stream mode.
+        """
+        with open(tmpfile, 'rb') as tmpfobj:
+            for nrow in chunkrows:
+                yield np.fromfile(tmpfobj, dtype=np.float64, count=nrow*ncol).reshape(nrow, ncol)
+
+    def _orderStats(self, tmpfile, ncol, chunkrows, cols, ranks):
+        """
+        Find order statistics (the k-th smallest values, k from 0) of hit
+        points in given columns of the temporary binary file of stream mode
+        without loading the columns at once.
 
+        Reflectance values are single precision. They are mapped to unsigned
+        32-bit keys of the same order and selected exactly by two passes of
+        16-bit histograms, high half first, then low half.
+
+        Returns:
+
+            stats (dict): stats[col][k], the k-th smallest value in column col
+        """
+        signbit = np.uint32(0x80000000)
+        def tokeys(values):
+            bits = values.astype(np.float32).view(np.uint32)
+            return np.where(bits >= signbit, np.invert(bits), bits | signbit)
+
+        hist = { col:np.zeros(65536, dtype=np.int64) for col in cols }
+        for outpoints in self._readTmpChunks(tmpfile, ncol, chunkrows):
+            hitmask = outpoints[:, 6].astype(int) > 0
+            for col in cols:
+                hist[col] += np.bincount(tokeys(outpoints[hitmask, col]) >> 16, minlength=65536)
+        highbin = {}
+        for col in cols:
+            cumhist = np.cumsum(hist[col])
+            for k in ranks:
+                hb = np.searchsorted(cumhist, k, side='right')
+                highbin[(col, k)] = (hb, k - (cumhist[hb-1] if hb > 0 else 0))
+
+        hist = { ck:np.zeros(65536, dtype=np.int64) for ck in highbin.keys() }
+        for outpoints in self._readTmpChunks(tmpfile, ncol, chunkrows):
+            hitmask = outpoints[:, 6].astype(int) > 0
+            for col in cols:
+                keys = tokeys(outpoints[hitmask, col])
+                for k in ranks:
+                    tmpkeys = keys[(keys >> 16) == highbin[(col, k)][0]]
+                    hist[(col, k)] += np.bincount(tmpkeys & 0xFFFF, minlength=65536)
+        stats = { col:{} for col in cols }
+        for (col, k), (hb, klow) in highbin.items():
+            lb = np.searchsorted(np.cumsum(hist[(col, k)]), klow, side='right')
+            key = np.array([(hb << 16) | lb], dtype=np.uint32)
+            bits = np.where(key >= signbit, key ^ signbit, np.invert(key))
+            stats[col][k] = float(bits.view(np.float32)[0])
+        return stats
+
+    def _outputHeader(self):
+        """
+        Header lines of the output spectral point cloud file
+        """
+        headerstr = "{0:s} x,y,z,d_I_nir,d_I_swir,return_number,number_of_returns,shot_number,range,theta,phi,sample,line,".format(self.comments) \
+                    + ",".join([ il+"_nir" for il in self.ind_label[self.man_col:self.tot_col] ]) + "," \
+                    + ",".join([ il+"_swir" for il in self.ind_label[self.man_col:self.tot_col] ]) + "," \
+                    + "qa,r,g,b\n" \
+                    + "{0:s} [DWEL Dual-wavelength Point Cloud Data by {1:s}]\n".format(self.comments, "Union" if self.union else "Intersect") \
+                    + "{0:s} Run made at: {1:s} using NIR ({2:s}) + SWIR ({3:s})\n".format(self.comments, time.strftime("%c"), self.nirfile, self.swirfile)
+        return headerstr
+
+    def _outputFormat(self):
+        """
+        Format strings of the columns in the output spectral point cloud file
+        """
+        if self.man_col < self.tot_col:
+            col_dtype = self.inferColDataType()
+            fmtstr = "%.3f "*5 + "%d "*3 + "%.3f "*3 + "%d "*2 \
+                     + " ".join([ col_dtype[ci] for ci in self.ind_label[self.man_col:self.tot_col] ]) + " " \
+                     + " ".join([ col_dtype[ci] for ci in self.ind_label[self.man_col:self.tot_col] ]) + " " \
+                     + "%d "*4
+        else:
+            col_dtype = self.inferColDataType()
+            fmtstr = "%.3f "*5 + "%d "*3 + "%.3f "*3 + "%d "*2 \
+                     + "%d "*4            
+        return fmtstr.strip().split(" ")
+
+    def mergePointClouds(self, nirpoints, swirpoints, intersectout=None):
+        """
+        Pair points of the two point clouds and merge them into spectral points
+        by intersection, or by union if self.union.
+
+        Args:
+
+            nirpoints, swirpoints (2D numpy array, [npts, ncols]): points with
+            columns in the order of self.ind_label.
+
+            intersectout (tuple): returns of intersectPointClouds on the same
+            points, e.g. from the pairing cache. If None, points are paired
+            here.
+
+        Returns:
+
+            outpoints (2D numpy array, [npts, ncols]): spectral points sorted by
+            shot and return number, without RGB columns.
+        """
         # update column index in loaded array
         cind = { il:i for i, il in enumerate(self.ind_label) }
         
         # index the columns that are used in searching common points
         ind = [cind['range'], cind['sample'], cind['line']]
 
-        print "Generating spectral points ..."
-        intersectout = self.intersectPointClouds(nirpoints[:,ind], swirpoints[:,ind])
+        if intersectout is None:
+            intersectout = self.intersectPointClouds(nirpoints[:,ind], swirpoints[:,ind])
         nir_ind = intersectout[0]
         swir_ind = intersectout[1]
         return_type = intersectout[2]
@@ -197,137 +656,188 @@ class DWELSpectralPoints:
                                    return_type.reshape((nreturn, 1)) \
             ))            
         
-        headerstr = "{0:s} x,y,z,d_I_nir,d_I_swir,return_number,number_of_returns,shot_number,range,theta,phi,sample,line,".format(self.comments) \
-                    + ",".join([ il+"_nir" for il in self.ind_label[self.man_col:self.tot_col] ]) + "," \
-                    + ",".join([ il+"_swir" for il in self.ind_label[self.man_col:self.tot_col] ]) + "," \
-                    + "qa,r,g,b\n" \
-                    + "{0:s} [DWEL Dual-wavelength Point Cloud Data by {1:s}]\n".format(self.comments, "Union" if self.union else "Intersect") \
-                    + "{0:s} Run made at: {1:s} using NIR ({2:s}) + SWIR ({3:s})\n".format(self.comments, time.strftime("%c"), nirfile, swirfile)
-        # format string
-        if self.man_col < self.tot_col:
-            col_dtype = self.inferColDataType()
-            fmtstr = "%.3f "*5 + "%d "*3 + "%.3f "*3 + "%d "*2 \
-                     + " ".join([ col_dtype[ci] for ci in self.ind_label[self.man_col:self.tot_col] ]) + " " \
-                     + " ".join([ col_dtype[ci] for ci in self.ind_label[self.man_col:self.tot_col] ]) + " " \
-                     + "%d "*4
-        else:
-            col_dtype = self.inferColDataType()
-            fmtstr = "%.3f "*5 + "%d "*3 + "%.3f "*3 + "%d "*2 \
-                     + "%d "*4            
-        fmtstr = fmtstr.strip().split(" ")
-        
         if not(self.union):
             # spectral points by intersect
-            # exclude zero-hit points from rgb generation
-            rgbpoints = np.zeros((outpoints.shape[0], 3))
-            hitmask = outpoints[:, 6].astype(int) > 0
-            # fix extremely large reflectance values
-            bound = np.percentile(outpoints[:, 3:5][hitmask, :], 98, axis=0)
-            bound[bound<self.i_scale] = self.i_scale
-            outpoints[outpoints[:, 3]>bound[0], 3] = bound[0]
-            outpoints[outpoints[:, 4]>bound[1], 4] = bound[1]
-            # generate pseudo-color composite
-            rgbpoints[hitmask, :] = self.colorComposite(np.hstack((outpoints[:, 4:5][hitmask, :], \
-                                                           outpoints[:, 3:4][hitmask, :], \
-                                                           np.zeros_like(outpoints[:, 3:4][hitmask, :]) \
-                                                           )))
-            outpoints = np.hstack((outpoints, rgbpoints))
+            return outpoints
+
+        # spectral points by union
+        nir_unpind = intersectout[6]
+        swir_unpind = intersectout[7]
+        nir_unp_nu_shotnum = intersectout[8]
+        swir_unp_nu_shotnum = intersectout[9]
+        ind = [cind['d_i'], cind['sample'], cind['line']]
+        print "\tMatching more point pairs between NIR and SWIR for union approach"
+        unionout = self.unionPointClouds(nirpoints[np.ix_(nir_unpind, ind)], \
+                                             swirpoints[np.ix_(swir_unpind, ind)], \
+                                             self.ndiimgfile)
+        nir2swir_amp = unionout[0]
+        nir2swir_qa = unionout[1]
+        swir2nir_amp = unionout[2]
+        swir2nir_qa = unionout[3]
+
+        tmpflag = np.equal(nir2swir_qa, int('111', 2))
+        if np.greater(nirpoints[nir_unpind[tmpflag], cind['d_i']], 1e-10).any():
+            warnings.warn("Some no-return shots give non-zero NIR reflectance", RuntimeWarning)
+            nirpoints[nir_unpind[tmpflag], cind['d_i']] = 0.0
+        tmpflag = np.equal(swir2nir_qa, int('111', 2))
+        if np.greater(swirpoints[swir_unpind[tmpflag], cind['d_i']], 1e-10).any():
+            warnings.warn("Some no-return shots give non-zero SWIR reflectance", RuntimeWarning)
+            swirpoints[swir_unpind[tmpflag], cind['d_i']] = 0.0
 
-            print "Saving dual-wavelength points: "+str(nir_ind.size)
+        if self.man_col < self.tot_col:
+            nir2swir_points = np.hstack(( nirpoints[nir_unpind, 0:3], \
+                                          nirpoints[nir_unpind, cind['d_i']:cind['d_i']+1], \
+                                          nir2swir_amp.reshape((len(nir2swir_amp), 1)), \
+                                          np.zeros((len(nir2swir_amp), 3)), \
+                                          nirpoints[nir_unpind, :][:, 5:10], \
+                                          nirpoints[nir_unpind, cind[self.ind_label[self.man_col]]:cind[self.ind_label[self.tot_col-1]]+1], \
+                                          np.zeros((len(nir2swir_amp), self.tot_col-self.man_col)), \
+                                          nir2swir_qa.reshape((len(nir2swir_qa), 1)) \
+            ))
+            swir2nir_points = np.hstack(( swirpoints[swir_unpind, 0:3], \
+                                          swir2nir_amp.reshape((len(swir2nir_amp), 1)), \
+                                          swirpoints[swir_unpind, cind['d_i']:cind['d_i']+1], \
+                                          np.zeros((len(swir2nir_amp), 3)), \
+                                          swirpoints[swir_unpind, :][:, 5:10], \
+                                          np.zeros((len(swir2nir_amp), self.tot_col-self.man_col)), \
+                                          swirpoints[swir_unpind, cind[self.ind_label[self.man_col]]:cind[self.ind_label[self.tot_col-1]]+1], \
+                                          swir2nir_qa.reshape((len(swir2nir_qa), 1)) \
+            ))
+        else:
+            nir2swir_points = np.hstack(( nirpoints[nir_unpind, 0:3], \
+                                          nirpoints[nir_unpind, cind['d_i']:cind['d_i']+1], \
+                                          nir2swir_amp.reshape((len(nir2swir_amp), 1)), \
+                                          np.zeros((len(nir2swir_amp), 3)), \
+                                          nirpoints[nir_unpind, :][:, 5:10], \
+                                          nir2swir_qa.reshape((len(nir2swir_qa), 1)) \
+            ))
+            swir2nir_points = np.hstack(( swirpoints[swir_unpind, 0:3], \
+                                          swir2nir_amp.reshape((len(swir2nir_amp), 1)), \
+                                          swirpoints[swir_unpind, cind['d_i']:cind['d_i']+1], \
+                                          np.zeros((len(swir2nir_amp), 3)), \
+                                          swirpoints[swir_unpind, :][:, 5:10], \
+                                          swir2nir_qa.reshape((len(swir2nir_qa), 1)) \
+            ))
 
-            np.savetxt(outfile, outpoints, delimiter=',', fmt=fmtstr, \
-                header=headerstr.rstrip(), comments='')            
+        unionoutpoints = np.vstack(( outpoints, nir2swir_points, swir2nir_points ))
+        sortind, num_of_returns, return_num, shotind = \
+            self.updateReturnNum(unionoutpoints[:, [8, 11, 12]].copy())
+        unionoutpoints = unionoutpoints[sortind, :]
+        unionoutpoints[:, 5] = return_num
+        unionoutpoints[:, 6] = num_of_returns
+        unionoutpoints[:, 7] = shotind
+        return unionoutpoints
 
-        else:
-            # spectral points by union
-            nir_unpind = intersectout[6]
-            swir_unpind = intersectout[7]
-            nir_unp_nu_shotnum = intersectout[8]
-            swir_unp_nu_shotnum = intersectout[9]
-            ind = [cind['d_i'], cind['sample'], cind['line']]
-            print "\tMatching more point pairs between NIR and SWIR for union approach"
-            unionout = self.unionPointClouds(nirpoints[np.ix_(nir_unpind, ind)], \
-                                                 swirpoints[np.ix_(swir_unpind, ind)], \
-                                                 ndiimgfile)
-            nir2swir_amp = unionout[0]
-            nir2swir_qa = unionout[1]
-            swir2nir_amp = unionout[2]
-            swir2nir_qa = unionout[3]
-            
-            tmpflag = np.equal(nir2swir_qa, int('111', 2))
-            if np.greater(nirpoints[nir_unpind[tmpflag], cind['d_i']], 1e-10).any():
-                warnings.warn("Some no-return shots give non-zero NIR reflectance", RuntimeWarning)
-                nirpoints[nir_unpind[tmpflag], cind['d_i']] = 0.0
-            tmpflag = np.equal(swir2nir_qa, int('111', 2))
-            if np.greater(swirpoints[swir_unpind[tmpflag], cind['d_i']], 1e-10).any():
-                warnings.warn("Some no-return shots give non-zero SWIR reflectance", RuntimeWarning)
-                swirpoints[swir_unpind[tmpflag], cind['d_i']] = 0.0
-
-            if self.man_col < self.tot_col:
-                nir2swir_points = np.hstack(( nirpoints[nir_unpind, 0:3], \
-                                              nirpoints[nir_unpind, cind['d_i']:cind['d_i']+1], \
-                                              nir2swir_amp.reshape((len(nir2swir_amp), 1)), \
-                                              np.zeros((len(nir2swir_amp), 3)), \
-                                              nirpoints[nir_unpind, :][:, 5:10], \
-                                              nirpoints[nir_unpind, cind[self.ind_label[self.man_col]]:cind[self.ind_label[self.tot_col-1]]+1], \
-                                              np.zeros((len(nir2swir_amp), self.tot_col-self.man_col)), \
-                                              nir2swir_qa.reshape((len(nir2swir_qa), 1)) \
-                ))
-                swir2nir_points = np.hstack(( swirpoints[swir_unpind, 0:3], \
-                                              swir2nir_amp.reshape((len(swir2nir_amp), 1)), \
-                                              swirpoints[swir_unpind, cind['d_i']:cind['d_i']+1], \
-                                              np.zeros((len(swir2nir_amp), 3)), \
-                                              swirpoints[swir_unpind, :][:, 5:10], \
-                                              np.zeros((len(swir2nir_amp), self.tot_col-self.man_col)), \
-                                              swirpoints[swir_unpind, cind[self.ind_label[self.man_col]]:cind[self.ind_label[self.tot_col-1]]+1], \
-                                              swir2nir_qa.reshape((len(swir2nir_qa), 1)) \
-                ))
-            else:
-                nir2swir_points = np.hstack(( nirpoints[nir_unpind, 0:3], \
-                                              nirpoints[nir_unpind, cind['d_i']:cind['d_i']+1], \
-                                              nir2swir_amp.reshape((len(nir2swir_amp), 1)), \
-                                              np.zeros((len(nir2swir_amp), 3)), \
-                                              nirpoints[nir_unpind, :][:, 5:10], \
-                                              nir2swir_qa.reshape((len(nir2swir_qa), 1)) \
-                ))
-                swir2nir_points = np.hstack(( swirpoints[swir_unpind, 0:3], \
-                                              swir2nir_amp.reshape((len(swir2nir_amp), 1)), \
-                                              swirpoints[swir_unpind, cind['d_i']:cind['d_i']+1], \
-                                              np.zeros((len(swir2nir_amp), 3)), \
-                                              swirpoints[swir_unpind, :][:, 5:10], \
-                                              swir2nir_qa.reshape((len(swir2nir_qa), 1)) \
-                ))
-
-            unionoutpoints = np.vstack(( outpoints, nir2swir_points, swir2nir_points ))
-            sortind, num_of_returns, return_num, shotind = \
-                self.updateReturnNum(unionoutpoints[:, [8, 11, 12]].copy())
-            unionoutpoints = unionoutpoints[sortind, :]
-            unionoutpoints[:, 5] = return_num
-            unionoutpoints[:, 6] = num_of_returns
-            unionoutpoints[:, 7] = shotind
-
-            # exclude zero-hit points from rgb generation
-            rgbpoints = np.zeros((unionoutpoints.shape[0], 3))
-            hitmask = unionoutpoints[:, 6].astype(int) > 0
-            # fix extremely large reflectance values
-            bound = np.percentile(unionoutpoints[:, 3:5][hitmask, :], 98, axis=0)
-            bound[bound<self.i_scale] = self.i_scale
-            unionoutpoints[unionoutpoints[:, 3]>bound[0], 3] = bound[0]
-            unionoutpoints[unionoutpoints[:, 4]>bound[1], 4] = bound[1]
-            # generate pseudo-color composite
-            rgbpoints[hitmask, :] = self.colorComposite(np.hstack((unionoutpoints[:, 4:5][hitmask, :], \
-                                                           unionoutpoints[:, 3:4][hitmask, :], \
-                                                           np.zeros_like(unionoutpoints[:, 3:4][hitmask, :]) \
-                                                           )))
-            unionoutpoints = np.hstack((unionoutpoints, rgbpoints))
-            
-            print "Saving dual-wavelength points: "+str(len(unionoutpoints))
+    def cachedIntersectPointClouds(self, nirpoints, swirpoints):
+        """
+        intersectPointClouds on the whole point clouds of self.nirfile and
+        self.swirfile, reusing the pairing cache. The cache key is from the
+        contents of the two files, rdiff_thresh, nrows, ncols and engine.
 
-            np.savetxt(outfile, unionoutpoints, delimiter=',', fmt=fmtstr, \
-                header=headerstr.rstrip(), comments='')
-            
+        Args:
+
+            nirpoints, swirpoints (2D numpy array, [npts, ncols]): all the
+            points loaded from self.nirfile and self.swirfile.
+
+        Returns:
+
+            intersectout (tuple): returns of intersectPointClouds.
+        """
+        cachekey = self.cache.makeKey([self.nirfile, self.swirfile], \
+                                      [float(self.rdiff_thresh), int(self.nrows), \
+                                       int(self.ncols), self.engine])
+        intersectout = self.cache.load(cachekey)
+        if intersectout is not None:
+            print "\tReusing point pairs from cache {0:s}".format(cachekey)
+            return intersectout
+
+        cind = { il:i for i, il in enumerate(self.ind_label) }
+        ind = [cind['range'], cind['sample'], cind['line']]
+        intersectout = self.intersectPointClouds(nirpoints[:,ind], swirpoints[:,ind])
+        self.cache.save(cachekey, intersectout)
+        print "\tSaved point pairs to cache {0:s}".format(cachekey)
+        return intersectout
+
+    def mergePointCloudsParallel(self, nirpoints, swirpoints, nproc, nbands=None):
+        """
+        Parallel version of mergePointClouds. Points of a laser shot are paired
+        and merged independently of other shots, so the scan is partitioned
+        into bands of lines (rows in AT projection) and the bands are merged in
+        a pool of worker processes. Shot numbers and return numbers are from
+        (sample, line) and points in the same shot, so they need no change
+        after merge.
+
+        Args:
+
+            nproc (int): number of worker processes.
+
+            nbands (int): number of bands of lines. If None, 4*nproc for load
+            balance, because point density varies a lot with zenith.
+
+        Returns:
+
+            outpoints (2D numpy array): same as mergePointClouds.
+        """
+        global _parallel_args
+        if nbands is None:
+            nbands = 4*nproc
+        edges = np.unique(np.linspace(1, self.nrows+1, nbands+1).astype(int)).astype(float)
+        # include points out of the range of rows in the first and last bands
+        edges[0] = -np.inf
+        edges[-1] = np.inf
+
+        print "\tMerging points by {0:d} bands of lines in {1:d} processes".format(len(edges)-1, nproc)
+        # workers are forked and inherit the points, no pickling of the input
+        _parallel_args = (self, nirpoints, swirpoints)
+        pool = multiprocessing.Pool(nproc)
+        try:
+            outlist = pool.map(_mergePointCloudsPartition, zip(edges[:-1], edges[1:]))
+        finally:
+            pool.close()
+            pool.join()
+            _parallel_args = None
+
+        outpoints = np.vstack(outlist)
+        # all points of a shot are in one band, a stable sort by shot number
+        # keeps the order of returns.
+        sortind = np.argsort(outpoints[:, 7], kind='mergesort')
+        return outpoints[sortind, :]
+
+    def addColorComposite(self, outpoints, bound=None, colorbound=None):
+        """
+        Clip extremely large reflectance values and append RGB columns of
+        pseudo-color composite to spectral points.
+
+        Args:
+
+            outpoints (2D numpy array): output of mergePointClouds.
+
+            bound (1D numpy array, [2]): upper bounds of NIR and SWIR
+            reflectance. If None, from 98 percentile of hit points.
+
+            colorbound (2D numpy array, [2, 3]): passed to colorComposite.
+
+        Returns:
 
-    def colorComposite(self, specpoints):
+            outpoints (2D numpy array): spectral points with R, G, B columns.
+        """
+        # exclude zero-hit points from rgb generation
+        rgbpoints = np.zeros((outpoints.shape[0], 3))
+        hitmask = outpoints[:, 6].astype(int) > 0
+        # fix extremely large reflectance values
+        if bound is None:
+            bound = np.percentile(outpoints[:, 3:5][hitmask, :], 98, axis=0)
+            bound[bound<self.i_scale] = self.i_scale
+        outpoints[outpoints[:, 3]>bound[0], 3] = bound[0]
+        outpoints[outpoints[:, 4]>bound[1], 4] = bound[1]
+        # generate pseudo-color composite
+        rgbpoints[hitmask, :] = self.colorComposite(np.hstack((outpoints[:, 4:5][hitmask, :], \
+                                                       outpoints[:, 3:4][hitmask, :], \
+                                                       np.zeros_like(outpoints[:, 3:4][hitmask, :]) \
+                                                       )), bound=colorbound)
+        return np.hstack((outpoints, rgbpoints))
+
+    def colorComposite(self, specpoints, bound=None):
         """
         Generate pseudo-color composite from three spectral bands of input
         points.
@@ -337,12 +847,17 @@ class DWELSpectralPoints:
             specpoints (2D numpy array, float): [npts, 3], band_for_R,
             band_for_G, band_for_B
 
+            bound (2D numpy array, float): [2, 3], lower and upper bounds of
+            the three bands for stretch. If None, from 2 and 98 percentiles of
+            specpoints.
+
         Returns:
 
             rgbpoints (2D numpy array, int): [npts, 3], R, G, B from 0 to 255
         """
 
-        bound = np.percentile(specpoints, (2, 98), axis=0)
+        if bound is None:
+            bound = np.percentile(specpoints, (2, 98), axis=0)
         # avoid all zeros in one band
         validbandmask = (bound>1e-10).any(axis=0)
         rgbpoints = np.zeros_like(specpoints, dtype=int)
@@ -372,26 +887,7 @@ class DWELSpectralPoints:
 
             shotind (1D numpy array, int)
         """
-        shotind = (points[:, 1:2]-1)*self.nrows + points[:, 2:3]
-        tmppts = np.hstack((shotind, points[:, 0:1]))
-        ptsview = tmppts.view(dtype=np.dtype([('shotind', tmppts.dtype), ('range', tmppts.dtype)]))
-        sortind = np.argsort(ptsview, order=('shotind', 'range'), axis=0).squeeze()
-        ptsview = ptsview[sortind]
-
-        ushotind, uinvind, ucount = np.unique(shotind.squeeze(), return_inverse=True, return_counts=True)
-        num_of_returns = ucount[uinvind][sortind]
-        return_num = np.zeros(len(ptsview), dtype=int)
-        i = 0
-        while i<len(ptsview):
-            tmpcount = num_of_returns[i]
-            return_num[i:i+tmpcount] = np.arange(tmpcount, dtype=int)+1
-            i += tmpcount
-        tmpflag = np.less(ptsview['range'], 1e-10).squeeze()
-        num_of_returns[tmpflag] = 0
-        return_num[tmpflag] = 0
-
-        return sortind, num_of_returns, return_num, shotind.squeeze()[sortind]
-
+        return dpu.updateReturnNum(points, nrows=self.nrows)
 
     def intersectPointClouds(self, nirpoints, swirpoints):
         """
@@ -410,6 +906,9 @@ class DWELSpectralPoints:
             of NIR points.
 
         """
+        if self.engine == "vectorized":
+            return self.intersectPointCloudsVectorized(nirpoints, swirpoints)
+
         # Check if there are zero-hit points. If yes, change their range values to
         # negative rdiff_thresh so that they cannot be paired with any other point.
         tmpind = np.where(nirpoints[:, 0] < 1e-10)[0]
@@ -638,6 +1137,301 @@ class DWELSpectralPoints:
             nir_unpind, swir_unpind, \
             old_nir_shotind[nir_unpind], old_swir_shotind[swir_unpind]
 
+    def intersectPointCloudsVectorized(self, nirpoints, swirpoints):
+        """
+        Array-based version of intersectPointClouds. Instead of walking shot by
+        shot, all candidate point pairs of all shots are generated at once and
+        paired by the same closest-first rule as closest_points2. Inputs and
+        returns are the same as intersectPointClouds.
+        """
+        print "\tSorting points by laser shot and range"
+        shots = self._sortShots(nirpoints, swirpoints)
+        print "\tSearching point pairs in all laser shots at once"
+        ci, cj, vdiff, single = self._findPairCandidates(shots, self.rdiff_thresh)
+        return self._pairShots(shots, ci, cj)
+
+    def _sortShots(self, nirpoints, swirpoints):
+        """
+        Sort NIR and SWIR points by (shot, range) and locate for each point the
+        segment of points of the same shot at the other wavelength.
+
+        Args:
+
+            nirpoints, swirpoints (2D numpy array, [npts, 3]): range, sample,
+            line. Range of zero-hit points is changed in place to negative
+            rdiff_thresh as in intersectPointClouds.
+
+        Returns:
+
+            shots (dict): sorted ranges and shot indices, sort order, segment
+            bounds at the other wavelength and flags of one-to-one shots.
+        """
+        tmpind = np.where(nirpoints[:, 0] < 1e-10)[0]
+        nirpoints[tmpind, 0] = -2*self.rdiff_thresh
+        tmpind = np.where(swirpoints[:, 0] < 1e-10)[0]
+        swirpoints[tmpind, 0] = -2*self.rdiff_thresh
+
+        # samples and lines starts from 1. calculated 1D indices starts from 1.
+        nir_shotind = (nirpoints[:, 1]-1)*self.nrows + nirpoints[:, 2]
+        swir_shotind = (swirpoints[:, 1]-1)*self.nrows + swirpoints[:, 2]
+
+        # lexsort is stable, ties in range keep the order in the original vector
+        nir_order = np.lexsort((nirpoints[:, 0], nir_shotind))
+        swir_order = np.lexsort((swirpoints[:, 0], swir_shotind))
+        nir_s = nir_shotind[nir_order]
+        swir_s = swir_shotind[swir_order]
+
+        # segment of the same shot at the other wavelength, [lo, hi)
+        nir_lo = np.searchsorted(swir_s, nir_s, side='left')
+        nir_hi = np.searchsorted(swir_s, nir_s, side='right')
+        swir_lo = np.searchsorted(nir_s, swir_s, side='left')
+        swir_hi = np.searchsorted(nir_s, swir_s, side='right')
+        # number of points of the same shot at the same wavelength
+        nir_cnt = np.searchsorted(nir_s, nir_s, side='right') \
+                  - np.searchsorted(nir_s, nir_s, side='left')
+        swir_cnt = np.searchsorted(swir_s, swir_s, side='right') \
+                   - np.searchsorted(swir_s, swir_s, side='left')
+
+        return {'nir_shotind':nir_shotind, 'swir_shotind':swir_shotind, \
+                'nir_order':nir_order, 'swir_order':swir_order, \
+                'nir_rg':nirpoints[nir_order, 0], 'swir_rg':swirpoints[swir_order, 0], \
+                'nir_s':nir_s, 'swir_s':swir_s, \
+                'nir_lo':nir_lo, 'nir_m':nir_hi-nir_lo, \
+                'nir_in':nir_hi>nir_lo, 'swir_in':swir_hi>swir_lo, \
+                'nir_single':np.logical_and(nir_hi-nir_lo==1, nir_cnt==1), \
+                'swir_single':np.logical_and(swir_hi-swir_lo==1, swir_cnt==1)}
+
+    def _findPairCandidates(self, shots, thresh):
+        """
+        Find all NIR-SWIR point pairs from the same shot with range difference
+        no larger than thresh.
+
+        Args:
+
+            shots (dict): output of _sortShots.
+
+        Returns:
+
+            ci, cj (1D numpy array, int): positions of the paired points in the
+            sorted NIR and SWIR points, ordered by the sequence closest_points2
+            would visit them, i.e. ascending range difference.
+
+            vdiff (1D numpy array, float): range difference of the pairs.
+
+            single (1D numpy array, bool): if the pair is from a shot with only
+            one point at both wavelengths.
+        """
+        nir_m = shots['nir_m']
+        ncand = np.sum(nir_m)
+        ci = np.repeat(np.arange(len(nir_m)), nir_m)
+        cj = np.arange(ncand) - np.repeat(np.cumsum(nir_m)-nir_m, nir_m) \
+             + np.repeat(shots['nir_lo'], nir_m)
+
+        nir_rg = shots['nir_rg']
+        swir_rg = shots['swir_rg']
+        vdiff = np.fabs(nir_rg[ci].astype(np.float64) - swir_rg[cj].astype(np.float64))
+        single = shots['nir_single'][ci]
+        tmpflag = self._withinThreshold(shots, ci, cj, vdiff, single, thresh)
+        ci = ci[tmpflag]
+        cj = cj[tmpflag]
+        vdiff = vdiff[tmpflag]
+        single = single[tmpflag]
+
+        # closest pair first, ties by range order of NIR and then SWIR points
+        sortind = np.lexsort((cj, ci, vdiff))
+        return ci[sortind], cj[sortind], vdiff[sortind], single[sortind]
+
+    def _withinThreshold(self, shots, ci, cj, vdiff, single, thresh):
+        """
+        If the range difference of candidate pairs is no larger than thresh.
+        """
+        tmpflag = np.less_equal(vdiff, thresh)
+        # one-to-one shots are compared in the data type of input points as in
+        # intersectPointClouds
+        tmpflag[single] = np.less_equal(np.fabs(shots['nir_rg'][ci[single]]-shots['swir_rg'][cj[single]]), thresh)
+        return tmpflag
+
+    def sweepRangeDiffThreshold(self, thresholds):
+        """
+        Pair points at a list of range difference thresholds in one run. Points
+        are loaded and sorted, and candidate pairs within the largest threshold
+        are found only once. Pairing at each threshold then selects from these
+        candidates. Pairing is always by the vectorized engine.
+
+        Args:
+
+            thresholds (list of float): range difference thresholds.
+
+        Returns:
+
+            summary (numpy record array): one record per threshold,
+
+                rdiff_thresh
+
+                npairs: number of point pairs with hits, i.e. points by
+                intersection
+
+                npairs_multi: number of point pairs with hits from shots with
+                multiple returns at either wavelength
+
+                nir_unpaired, swir_unpaired: number of NIR and SWIR hit points
+                without counterparts
+
+                union_fill: fraction of hit points by union that need
+                synthesized reflectance
+
+            intersectout (list): returns of intersectPointClouds at each
+            threshold.
+        """
+        thresholds = np.sort(np.asarray(thresholds, dtype=float))
+        maxthresh = thresholds[-1]
+
+        print "Loading points"
+        nirpoints = self.loadPoints(self.nirfile)
+        swirpoints = self.loadPoints(self.swirfile)
+        cind = { il:i for i, il in enumerate(self.ind_label) }
+        ind = [cind['range'], cind['sample'], cind['line']]
+
+        # zero-hit points get range of negative largest threshold and
+        # cannot be paired with any hit at any smaller threshold either.
+        rdiff_thresh = self.rdiff_thresh
+        self.rdiff_thresh = maxthresh
+        try:
+            print "\tSorting points by laser shot and range"
+            shots = self._sortShots(nirpoints[:, ind], swirpoints[:, ind])
+        finally:
+            self.rdiff_thresh = rdiff_thresh
+        print "\tSearching candidate point pairs within {0:.3f}".format(maxthresh)
+        ci, cj, vdiff, single = self._findPairCandidates(shots, maxthresh)
+
+        nir_hit = np.greater(nirpoints[:, cind['range']], 1e-10)
+        swir_hit = np.greater(swirpoints[:, cind['range']], 1e-10)
+        summary = np.recarray(len(thresholds), dtype=[('rdiff_thresh', float), \
+                                                      ('npairs', int), ('npairs_multi', int), \
+                                                      ('nir_unpaired', int), ('swir_unpaired', int), \
+                                                      ('union_fill', float)])
+        intersectout = []
+        for i, thresh in enumerate(thresholds):
+            print "\tPairing points at range difference threshold {0:.3f}".format(thresh)
+            tmpflag = self._withinThreshold(shots, ci, cj, vdiff, single, thresh)
+            tmpout = self._pairShots(shots, ci[tmpflag], cj[tmpflag])
+            intersectout.append(tmpout)
+
+            pairflag = tmpout[4] > 0
+            nir_unp = np.sum(nir_hit[tmpout[6]])
+            swir_unp = np.sum(swir_hit[tmpout[7]])
+            summary[i] = (thresh, np.sum(pairflag), np.sum(np.logical_and(pairflag, tmpout[2])), \
+                          nir_unp, swir_unp, \
+                          float(nir_unp+swir_unp)/max(np.sum(pairflag)+nir_unp+swir_unp, 1))
+
+        return summary, intersectout
+
+    def writeSweepSummary(self, summary, outfile):
+        """
+        Write the summary of sweepRangeDiffThreshold to an ASCII file.
+        """
+        headerstr = "{0:s} {1:s}\n".format(self.comments, ",".join(summary.dtype.names)) \
+                    + "{0:s} [DWEL Dual-wavelength Point Pairing at Multiple Range Difference Thresholds]\n".format(self.comments) \
+                    + "{0:s} Run made at: {1:s} using NIR ({2:s}) + SWIR ({3:s})".format(self.comments, time.strftime("%c"), self.nirfile, self.swirfile)
+        np.savetxt(outfile, summary, delimiter=',', fmt=["%.3f", "%d", "%d", "%d", "%d", "%.6f"], \
+                   header=headerstr, comments='')
+
+    def _greedyPairing(self, ci, cj, nnir, nswir):
+        """
+        Select point pairs from candidates in the same way as closest_points2:
+        visit candidates from the closest, take a pair if neither of its
+        points is taken yet.
+
+        A candidate that comes first among all remaining candidates of both its
+        NIR and SWIR point is taken by this rule for sure. Take all of them at
+        once, drop remaining candidates of taken points and repeat. The number
+        of rounds is bounded by the number of returns per shot.
+
+        Returns:
+
+            pairflag (1D numpy array, bool): if a candidate is taken.
+        """
+        pairflag = np.zeros(len(ci), dtype=np.bool_)
+        alive = np.arange(len(ci))
+        nir_used = np.zeros(nnir, dtype=np.bool_)
+        swir_used = np.zeros(nswir, dtype=np.bool_)
+        while len(alive) > 0:
+            tmpci = ci[alive]
+            tmpcj = cj[alive]
+            # first occurrence of each point among alive candidates
+            firstflag = np.zeros(len(alive), dtype=np.bool_)
+            firstflag[np.unique(tmpci, return_index=True)[1]] = True
+            tmpflag = np.zeros(len(alive), dtype=np.bool_)
+            tmpflag[np.unique(tmpcj, return_index=True)[1]] = True
+            firstflag = np.logical_and(firstflag, tmpflag)
+            pairflag[alive[firstflag]] = True
+            nir_used[tmpci[firstflag]] = True
+            swir_used[tmpcj[firstflag]] = True
+            alive = alive[np.logical_not(np.logical_or(nir_used[tmpci], swir_used[tmpcj]))]
+        return pairflag
+
+    def _pairShots(self, shots, ci, cj):
+        """
+        Pair points from candidates and assemble the returns of
+        intersectPointClouds.
+        """
+        nir_in = shots['nir_in']
+        swir_in = shots['swir_in']
+        nir_single = shots['nir_single']
+        swir_single = shots['swir_single']
+        nir_order = shots['nir_order']
+        swir_order = shots['swir_order']
+
+        pairflag = self._greedyPairing(ci, cj, len(nir_in), len(swir_in))
+        # sorted points are in order of (shot, range), so are the pairs sorted
+        # by their NIR points
+        sortind = np.argsort(ci[pairflag], kind='mergesort')
+        nir_pairpos = ci[pairflag][sortind]
+        swir_pairpos = cj[pairflag][sortind]
+        npair = len(nir_pairpos)
+
+        # count returns in each shot
+        pair_s = shots['nir_s'][nir_pairpos]
+        segflag = np.ones(npair, dtype=np.bool_)
+        segflag[1:] = np.not_equal(pair_s[1:], pair_s[:-1])
+        segstart = np.where(segflag)[0]
+        segcount = np.diff(np.hstack((segstart, npair)))
+        all_num_of_returns = np.repeat(segcount, segcount).astype(int)
+        all_return_num = (np.arange(npair) - np.repeat(segstart, segcount) + 1).astype(int)
+        return_type = np.logical_not(nir_single[nir_pairpos])
+        # zero-hit points in one-to-one shots
+        tmpflag = np.logical_and(nir_single[nir_pairpos], \
+                                 np.less(shots['nir_rg'][nir_pairpos], 0))
+        all_num_of_returns[tmpflag] = 0
+        all_return_num[tmpflag] = 0
+
+        nir_alloutind = nir_order[nir_pairpos].astype(int)
+        swir_alloutind = swir_order[swir_pairpos].astype(int)
+        nu_nir_shotind = shots['nir_shotind'][nir_alloutind]
+        if np.sum(np.fabs(nu_nir_shotind-shots['swir_shotind'][swir_alloutind])) > 1e-10:
+            raise RuntimeError("Error: calculated shot number after point cloud merge went wrong!")
+
+        # unpaired points, in the order of intersectPointClouds: points without
+        # common shot, then unpaired points in one-to-one shots and then those
+        # in the other shots
+        nir_paired = np.zeros(len(nir_in), dtype=np.bool_)
+        nir_paired[nir_pairpos] = True
+        swir_paired = np.zeros(len(swir_in), dtype=np.bool_)
+        swir_paired[swir_pairpos] = True
+        nir_unpind = np.hstack((np.sort(nir_order[np.logical_not(nir_in)]), \
+                                nir_order[np.logical_and(nir_single, np.logical_not(nir_paired))], \
+                                nir_order[np.logical_and(np.logical_and(nir_in, np.logical_not(nir_single)), \
+                                                         np.logical_not(nir_paired))])).astype(int)
+        swir_unpind = np.hstack((np.sort(swir_order[np.logical_not(swir_in)]), \
+                                 swir_order[np.logical_and(swir_single, np.logical_not(swir_paired))], \
+                                 swir_order[np.logical_and(np.logical_and(swir_in, np.logical_not(swir_single)), \
+                                                           np.logical_not(swir_paired))])).astype(int)
+
+        return nir_alloutind, swir_alloutind, return_type, \
+            nu_nir_shotind, all_num_of_returns, all_return_num, \
+            nir_unpind, swir_unpind, \
+            shots['nir_shotind'][nir_unpind], shots['swir_shotind'][swir_unpind]
+
     def cp(self, value1, value2, thresh):
         """
         Utility function used by closest_points
@@ -756,54 +1550,399 @@ class DWELSpectralPoints:
 
             swir2nir_qa (1D numpy array, int): QA of points synthesized from SWIR to NIR
         """
+        ndi, mask = self._lookupNDIImage(ndiimgfile, \
+                                         np.hstack((nirpts[:, 2], swirpts[:, 2])).astype(int)-1, \
+                                         np.hstack((nirpts[:, 1], swirpts[:, 1])).astype(int)-1)
+        nnir = len(nirpts)
+        # an extra check
+        tmpflag = np.greater(mask, 0)
+        for pts, flag, name in zip([nirpts, swirpts], [tmpflag[:nnir], tmpflag[nnir:]], ["NIR", "SWIR"]):
+            if not(flag.all()):
+                print "sample/column no.:"
+                print pts[np.invert(flag), 1]
+                print "line/row no.:"
+                print pts[np.invert(flag), 2]
+                raise RuntimeError("These {0:s} points are from invalid shots. Check {0:s} point cloud".format(name))
+
+        # QA of synthesized points by mask values 0 to 3. Row 0, from NIR to
+        # SWIR; row 1, from SWIR to NIR. Mask 1, measured NDI; 2, filled NDI;
+        # others, no-return but valid shots.
+        qatable = np.array([[int('111', 2), int('001', 2), int('101', 2), int('111', 2)], \
+                            [int('111', 2), int('010', 2), int('110', 2), int('111', 2)]])
+        qarow = np.zeros(len(mask), dtype=int)
+        qarow[nnir:] = 1
+        qa = qatable[qarow, np.clip(mask.astype(int), 0, 3)]
+
+        amp = np.zeros_like(ndi)
+        tmpflag = np.not_equal(qa, int('111', 2))
+        tmpflag1 = tmpflag[:nnir]
+        tmpndi = ndi[:nnir][tmpflag1]
+        amp[:nnir][tmpflag1] = (1-tmpndi)/(1+tmpndi)*nirpts[:, 0][tmpflag1]
+        tmpflag2 = tmpflag[nnir:]
+        tmpndi = ndi[nnir:][tmpflag2]
+        amp[nnir:][tmpflag2] = (1+tmpndi)/(1-tmpndi)*swirpts[:, 0][tmpflag2]
+
+        nir2swir_amp = amp[:nnir]
+        nir2swir_qa = qa[:nnir]
+        swir2nir_amp = amp[nnir:]
+        swir2nir_qa = qa[nnir:]
+
+        return nir2swir_amp, nir2swir_qa, swir2nir_amp, swir2nir_qa
+
+    def _lookupNDIImage(self, ndiimgfile, rows, cols):
+        """
+        Look up NDI and mask at given pixels of the gap-filled NDI image. An
+        ENVI image is memory-mapped so that only the looked-up pixels are read,
+        otherwise the image is read by GDAL. The image is opened only once for
+        all the calls.
+
+        Args:
+
+            rows, cols (1D numpy array, int): row and column of pixels, from 0.
+
+        Returns:
+
+            ndi, mask (1D numpy array): NDI and mask at the pixels.
+        """
         ndib = 1
         maskb = 2
 
-        imgds = gdal.Open(ndiimgfile, gdal.GA_ReadOnly)
-        ndiband = imgds.GetRasterBand(ndib)
-        maskband = imgds.GetRasterBand(maskb)
+        if self._ndiimg is None or self._ndiimg[0] != ndiimgfile:
+            self._ndiimg = (ndiimgfile, \
+                            envi.readBand(ndiimgfile, ndib), \
+                            envi.readBand(ndiimgfile, maskb))
+        # one indexed read per band
+        ndi = np.asarray(self._ndiimg[1][rows, cols])
+        mask = np.asarray(self._ndiimg[2][rows, cols])
+        return ndi.astype(ndi.dtype.newbyteorder('=')), mask
 
-        ndi = ndiband.ReadAsArray(0, 0, ndiband.XSize, ndiband.YSize)
-        mask = maskband.ReadAsArray(0, 0, maskband.XSize, maskband.YSize)
 
-        tmpndi = ndi[nirpts[:, 2].astype(int)-1, nirpts[:, 1].astype(int)-1]
-        tmpflag = np.greater(mask[nirpts[:, 2].astype(int)-1, nirpts[:, 1].astype(int)-1], 0)
-        # an extra check
-        if not(tmpflag.all()):
-            print "sample/column no.:"
-            print nirpts[np.invert(tmpflag), 1]
-            print "line/row no.:"
-            print nirpts[np.invert(tmpflag), 2]
-            raise RuntimeError("These NIR points are from invalid shots. Check NIR point cloud")
-        nir2swir_qa = np.zeros_like(tmpndi, dtype=int)
-        tmpflag1 = np.equal(mask[nirpts[:, 2].astype(int)-1, nirpts[:, 1].astype(int)-1], 1)
-        nir2swir_qa[tmpflag1] = int('001', 2)
-        tmpflag2 = np.equal(mask[nirpts[:, 2].astype(int)-1, nirpts[:, 1].astype(int)-1], 2)
-        nir2swir_qa[tmpflag2] = int('101', 2)
-        tmpflag = np.logical_or(tmpflag1, tmpflag2)
-        nir2swir_qa[np.invert(tmpflag)] = int('111', 2)
-        nir2swir_amp = np.zeros_like(tmpndi)
-        nir2swir_amp[tmpflag] = (1-tmpndi[tmpflag])/(1+tmpndi[tmpflag])*nirpts[:, 0][tmpflag]
-        # # prevent synthetic reflectance values to be too large
-        # np.greater(nir2swir_amp, self.i_scale)
-
-        tmpndi = ndi[swirpts[:, 2].astype(int)-1, swirpts[:, 1].astype(int)-1]
-        tmpflag = np.greater(mask[swirpts[:, 2].astype(int)-1, swirpts[:, 1].astype(int)-1], 0)
-        # an extra check
-        if not(tmpflag.all()):
-            print "sample/column no.:"
-            print swirpts[np.invert(tmpflag), 1]
-            print "line/row no.:"
-            print swirpts[np.invert(tmpflag), 2]
-            raise RuntimeError("These SWIR points are from invalid shots. Check SWIR point cloud")
-        swir2nir_qa = np.zeros_like(tmpndi, dtype=int)
-        tmpflag1 = np.equal(mask[swirpts[:, 2].astype(int)-1, swirpts[:, 1].astype(int)-1], 1)
-        swir2nir_qa[tmpflag1] = int('010', 2)
-        tmpflag2 = np.equal(mask[swirpts[:, 2].astype(int)-1, swirpts[:, 1].astype(int)-1], 2)
-        swir2nir_qa[tmpflag2] = int('110', 2)
-        tmpflag = np.logical_or(tmpflag1, tmpflag2)
-        swir2nir_qa[np.invert(tmpflag)] = int('111', 2)
-        swir2nir_amp = np.zeros_like(tmpndi)
-        swir2nir_amp[tmpflag] = (1+tmpndi[tmpflag])/(1-tmpndi[tmpflag])*swirpts[:, 0][tmpflag]
-        
-        return nir2swir_amp, nir2swir_qa, swir2nir_amp, swir2nir_qa
+class DWELPointsChunkReader:
+    """
+    Read an ASCII point cloud file chunk by chunk in the order of a key column,
+    e.g. sample, for stream mode of DWELSpectralPoints. Text lines are parsed in
+    blocks and points beyond the requested key are kept for the next read.
+
+    AUTHORS:
+
+        Zhan Li, zhanli86@bu.edu
+    """
+
+    def __init__(self, ptsfile, usecols, keycol, \
+                     headerlines=0, comments="//", dtype=np.float32, \
+                     blocklines=100000):
+        """
+        Args:
+
+            usecols (tuple of strings): names of columns to read, in lower case.
+
+            keycol (string): name of the column by which points are ordered in
+            the file. Must be in usecols.
+        """
+        self.ptsfile = ptsfile
+        self.comments = comments
+        self.dtype = dtype
+        self.blocklines = blocklines
+
+        self.fobj = open(ptsfile, 'r')
+        for i in range(headerlines):
+            self.fobj.readline()
+        # column names from the first line after header lines, as genfromtxt
+        # with names=True
+        namestr = self.fobj.readline().strip()
+        if namestr.find(comments) == 0:
+            namestr = namestr[len(comments):]
+        names = [ nm.strip().lower() for nm in namestr.split(',') ]
+        self.usecols = [ names.index(nm) for nm in usecols ]
+        self.keyind = list(usecols).index(keycol)
+
+        self.pending = np.zeros((0, len(self.usecols)), dtype=dtype)
+        self.lastkey = None
+        self.eof = False
+
+    def exhausted(self):
+        return self.eof and len(self.pending) == 0
+
+    def close(self):
+        self.fobj.close()
+
+    def _readBlock(self):
+        lines = []
+        for line in self.fobj:
+            if line.lstrip().find(self.comments) == 0:
+                continue
+            lines.append(line)
+            if len(lines) >= self.blocklines:
+                break
+        if len(lines) < self.blocklines:
+            self.eof = True
+        if len(lines) == 0:
+            return self.pending[0:0]
+        block = np.genfromtxt(lines, dtype=self.dtype, usecols=self.usecols, \
+                              delimiter=',', filling_values=np.nan, usemask=False)
+        block = block.reshape(-1, len(self.usecols))
+        keys = block[:, self.keyind]
+        if np.less(np.diff(keys), 0).any() or \
+                (self.lastkey is not None and keys[0] < self.lastkey):
+            raise RuntimeError("Points are not ordered by {0:d}-th column in {1:s}".format(self.usecols[self.keyind], self.ptsfile))
+        self.lastkey = keys[-1]
+        return block
+
+    def readUntil(self, keyend):
+        """
+        Return all the remaining points with key less than keyend.
+        """
+        while not self.eof and (len(self.pending) == 0 or self.pending[-1, self.keyind] < keyend):
+            self.pending = np.vstack((self.pending, self._readBlock()))
+        nout = np.searchsorted(self.pending[:, self.keyind], keyend, side='left')
+        outpoints = self.pending[:nout, :]
+        self.pending = self.pending[nout:, :]
+        return outpoints
+
+
+class DWELBinaryPointsChunkReader:
+    """
+    Read a binary point file chunk by chunk in the order of a key column, the
+    same as DWELPointsChunkReader but from a memory-mapped .npy file.
+
+    AUTHORS:
+
+        Zhan Li, zhanli86@bu.edu
+    """
+
+    def __init__(self, binfile, usecols, keycol, dtype=np.float32, \
+                     blocklines=100000):
+        self.binfile = binfile
+        self.usecols = usecols
+        self.keycol = keycol
+        self.dtype = dtype
+        self.blocklines = blocklines
+
+        self.points = np.load(binfile, mmap_mode='r')
+        self.pos = 0
+        self.lastkey = None
+
+    def exhausted(self):
+        return self.pos >= len(self.points)
+
+    def close(self):
+        self.points = None
+
+    def readUntil(self, keyend):
+        """
+        Return all the remaining points with key less than keyend.
+        """
+        end = self.pos
+        while end < len(self.points):
+            keys = self.points[self.keycol][end:end+self.blocklines]
+            if np.less(np.diff(keys), 0).any() or \
+                    (self.lastkey is not None and keys[0] < self.lastkey):
+                raise RuntimeError("Points are not ordered by {0:s} in {1:s}".format(self.keycol, self.binfile))
+            nout = np.searchsorted(keys, keyend, side='left')
+            if nout > 0:
+                self.lastkey = keys[nout-1]
+            end += nout
+            if nout < len(keys):
+                break
+        outpoints = np.empty((end-self.pos, len(self.usecols)), dtype=self.dtype)
+        for i, nm in enumerate(self.usecols):
+            outpoints[:, i] = self.points[nm][self.pos:end]
+        self.pos = end
+        return outpoints
+
+
+class DWELPointsWriter:
+    """
+    Write points to an ASCII file with per-column formats, the same output as
+    np.savetxt but formatted by blocks of columns with formatPoints. Points can
+    be formatted and written by a background thread so that writing overlaps
+    with the computation of the next points.
+
+    AUTHORS:
+
+        Zhan Li, zhanli86@bu.edu
+    """
+
+    def __init__(self, outfile, fmt, delimiter=',', header=None, \
+                     background=False, blockrows=100000):
+        """
+        Args:
+
+            fmt (list of strings): format of each column.
+
+            header (string): header written before points, without the
+            trailing newline, as np.savetxt with comments=''.
+
+            background (bool): if True, format and write points in a
+            background thread.
+
+            blockrows (int): number of rows formatted at a time.
+        """
+        self.fmt = fmt
+        self.delimiter = delimiter
+        self.blockrows = blockrows
+        self.background = background
+
+        self.fobj = open(outfile, 'w')
+        if header is not None:
+            self.fobj.write(header+'\n')
+
+        self.error = None
+        if background:
+            # hold at most two pending arrays of points in memory
+            self.queue = Queue.Queue(maxsize=2)
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, points):
+        if not self.background:
+            self._writePoints(points)
+            return
+        if self.error is not None:
+            self.close()
+        self.queue.put(points)
+
+    def close(self):
+        if self.background and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.fobj.close()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _writePoints(self, points):
+        for i in range(0, len(points), self.blockrows):
+            self.fobj.write(formatPoints(points[i:i+self.blockrows, :], self.fmt, self.delimiter))
+
+    def _run(self):
+        while True:
+            points = self.queue.get()
+            if points is None:
+                break
+            if self.error is None:
+                try:
+                    self._writePoints(points)
+                except Exception:
+                    self.error = sys.exc_info()
+
+
+class DWELPairingCache:
+    """
+    On-disk cache of the results of point pairing, i.e. the index arrays from
+    intersectPointClouds. An entry is keyed by a hash of the contents of the two
+    input point cloud files and the pairing parameters, so a rerun on the same
+    inputs reuses the pairing, e.g. to export different optional columns or
+    to redo union with another NDI image. The total size of the cache is
+    bounded and the least recently used entries are removed first.
+
+    AUTHORS:
+
+        Zhan Li, zhanli86@bu.edu
+    """
+
+    # bump if the returns of intersectPointClouds change
+    version = 1
+
+    def __init__(self, cachedir, maxbytes=2*1024**3):
+        """
+        Args:
+
+            cachedir (string): folder of cache entries, created if not
+            existing.
+
+            maxbytes (int): upper bound of total size of cache entries in
+            bytes.
+        """
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def makeKey(self, ptsfiles, params, blockbytes=4*1024**2):
+        """
+        Hash of the contents of point cloud files and pairing parameters.
+
+        Args:
+
+            ptsfiles (list of strings): input point cloud files.
+
+            params (list): pairing parameters, converted to strings by repr.
+        """
+        hasher = hashlib.sha1()
+        hasher.update("DWELPairingCache {0:d}\n".format(self.version))
+        for ptsfile in ptsfiles:
+            with open(ptsfile, 'rb') as ptsfobj:
+                block = ptsfobj.read(blockbytes)
+                while len(block) > 0:
+                    hasher.update(block)
+                    block = ptsfobj.read(blockbytes)
+            hasher.update("\n{0:d}\n".format(os.path.getsize(ptsfile)))
+        for par in params:
+            hasher.update(repr(par)+"\n")
+        return hasher.hexdigest()
+
+    def _entryFile(self, key):
+        return os.path.join(self.cachedir, key+".npz")
+
+    def load(self, key):
+        """
+        Load a cache entry.
+
+        Returns:
+
+            arrays (tuple of numpy arrays): the cached arrays in their order
+            when saved, or None if the key is not in the cache.
+        """
+        entryfile = self._entryFile(key)
+        if not os.path.isfile(entryfile):
+            return None
+        try:
+            with np.load(entryfile) as npz:
+                arrays = tuple(npz["arr_{0:d}".format(i)] for i in range(len(npz.files)))
+        except Exception:
+            warnings.warn("Removing unreadable cache entry {0:s}".format(entryfile), RuntimeWarning)
+            os.remove(entryfile)
+            return None
+        # mark the entry as recently used
+        os.utime(entryfile, None)
+        return arrays
+
+    def save(self, key, arrays):
+        """
+        Save arrays as a cache entry and evict least recently used entries if
+        the cache is over its size.
+        """
+        entryfile = self._entryFile(key)
+        # write to a temporary file first so that a partial entry is never read
+        fd, tmpfile = tempfile.mkstemp(suffix=".tmp", dir=self.cachedir)
+        try:
+            with os.fdopen(fd, 'wb') as tmpfobj:
+                np.savez(tmpfobj, *arrays)
+            os.rename(tmpfile, entryfile)
+        except Exception:
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+            raise
+        self.evict(keep=entryfile)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the total size of the cache is
+        not larger than self.maxbytes. The entry file keep is not removed.
+        """
+        entries = []
+        for fname in os.listdir(self.cachedir):
+            if not fname.endswith(".npz"):
+                continue
+            entryfile = os.path.join(self.cachedir, fname)
+            st = os.stat(entryfile)
+            entries.append((st.st_mtime, st.st_size, entryfile))
+        totbytes = sum(ent[1] for ent in entries)
+        for mtime, size, entryfile in sorted(entries):
+            if totbytes <= self.maxbytes:
+                break
+            if entryfile == keep:
+                continue
+            os.remove(entryfile)
+            totbytes -= size
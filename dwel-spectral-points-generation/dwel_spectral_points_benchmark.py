@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+"""
+Benchmark the generation of dual-wavelength spectral point cloud on synthetic
+DWEL scans. Two point clouds at NIR and SWIR and a gap-filled NDI image are
+synthesized with the shot geometry of a DWEL scan in AT projection, then the
+stages of DWELSpectralPoints, loading, intersection, union and writing, are
+timed and the memory use after each stage is reported. Runs with the same
+options and seed work on the same synthetic scan, so the timings can be
+compared between code versions and engines.
+
+USAGE:
+
+    dwel_spectral_points_benchmark.py [-r <int>] [-c <int>] [-f <float>]
+    [--gap <float>] [--mean-returns <float>] [--max-returns <int>]
+    [--jitter <float>] [--single-band <float>] [-R <float>] [--engine <string>]
+    [--binary] [--seed <int>] [--workdir <string>] [--keep] [--report <string>]
+
+OPTIONS:
+
+    -r <int>, --rows <int>
+    number of rows (lines) in the AT projection. [default: 3142]
+
+    -c <int>, --cols <int>
+    number of columns (samples) in the AT projection. [default: 1022]
+
+    -f <float>, --fraction <float>
+    fraction of shots of the AT projection in the synthetic scan, to set the
+    size of the benchmark. [default: 0.1]
+
+    --gap <float>
+    probability of a shot being a zero-hit shot. [default: 0.3]
+
+    --mean-returns <float>
+    mean number of returns of a hit shot. [default: 1.6]
+
+    --max-returns <int>
+    maximum number of returns of a shot. [default: 8]
+
+    --jitter <float>
+    standard deviation of range noise of a point at each wavelength, in
+    meter. [default: 0.15]
+
+    --single-band <float>
+    probability of a return being retrieved at only one of the two
+    wavelengths. [default: 0.15]
+
+    -R <float>, --rdiff <float>
+    range difference threshold to pair points. [default: 0.96]
+
+    --engine <string>
+    engine of point pairing, "loop" or "vectorized". [default: loop]
+
+    --binary
+    convert the synthetic ASCII point clouds to binary point files and load
+    the binary files.
+
+    --seed <int>
+    seed of the random generator. [default: 0]
+
+    --workdir <string>
+    folder of the synthetic files and the output. [default: a temporary
+    folder, removed after the benchmark unless --keep]
+
+    --keep
+    keep the synthetic files and the output.
+
+    --report <string>
+    CSV file to append the timings to, one row per stage.
+
+EXAMPLES:
+
+    python dwel_spectral_points_benchmark.py -f 0.05 --engine vectorized --report bench.csv
+
+AUTHORS:
+
+    Zhan Li, zhanli86@bu.edu
+
+"""
+
+import sys
+import os
+import argparse
+import time
+import tempfile
+import shutil
+import resource
+
+import numpy as np
+
+from dwel_spectral_points import DWELSpectralPoints, DWELPointsWriter, formatPoints, dpu
+
+# columns of the synthetic ASCII point clouds and their print formats
+_synth_columns = ['x', 'y', 'z', 'd_I', 'return_number', 'number_of_returns', \
+                  'shot_number', 'range', 'theta', 'phi', 'sample', 'line', \
+                  'd0', 'fwhm']
+_synth_formats = ['%.3f', '%.3f', '%.3f', '%.3f', '%d', '%d', \
+                  '%d', '%.3f', '%.3f', '%.3f', '%d', '%d', \
+                  '%.3f', '%.3f']
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Benchmark the generation of dual-wavelength spectral point cloud on synthetic DWEL scans")
+
+    p.add_argument("-r", "--rows", dest="nrows", type=int, default=3142, help="Number of rows (lines) in the AT projection. [default: 3142]")
+    p.add_argument("-c", "--cols", dest="ncols", type=int, default=1022, help="Number of columns (samples) in the AT projection. [default: 1022]")
+    p.add_argument("-f", "--fraction", dest="fraction", type=float, default=0.1, help="Fraction of shots of the AT projection in the synthetic scan. [default: 0.1]")
+    p.add_argument("--gap", dest="gap", type=float, default=0.3, help="Probability of a shot being a zero-hit shot. [default: 0.3]")
+    p.add_argument("--mean-returns", dest="mean_returns", type=float, default=1.6, help="Mean number of returns of a hit shot. [default: 1.6]")
+    p.add_argument("--max-returns", dest="max_returns", type=int, default=8, help="Maximum number of returns of a shot. [default: 8]")
+    p.add_argument("--jitter", dest="jitter", type=float, default=0.15, help="Standard deviation of range noise of a point at each wavelength, in meter. [default: 0.15]")
+    p.add_argument("--single-band", dest="single_band", type=float, default=0.15, help="Probability of a return being retrieved at only one of the two wavelengths. [default: 0.15]")
+    p.add_argument("-R", "--rdiff", dest="rdiff_thresh", type=float, default=0.96, help="Range difference threshold to pair points. [default: 0.96]")
+    p.add_argument("--engine", dest="engine", default="loop", choices=["loop", "vectorized"], help="Engine of point pairing. [default: loop]")
+    p.add_argument("--binary", dest="binary", default=False, action="store_true", help="Convert the synthetic ASCII point clouds to binary point files and load the binary files. Default: false")
+    p.add_argument("--seed", dest="seed", type=int, default=0, help="Seed of the random generator. [default: 0]")
+    p.add_argument("--workdir", dest="workdir", default=None, help="Folder of the synthetic files and the output. [default: a temporary folder]")
+    p.add_argument("--keep", dest="keep", default=False, action="store_true", help="Keep the synthetic files and the output. Default: false")
+    p.add_argument("--report", dest="report", default=None, help="CSV file to append the timings to, one row per stage")
+
+    cmdargs = p.parse_args()
+    return cmdargs
+
+def memoryUsage():
+    """
+    Current and peak resident memory of this process in MB, on Linux.
+    """
+    with open("/proc/self/statm", 'r') as fobj:
+        rss = int(fobj.readline().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024.0**2
+    # ru_maxrss is in KB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return rss, peak
+
+def synthesizeScan(nrows=3142, ncols=1022, fraction=0.1, gap=0.3, \
+                       mean_returns=1.6, max_returns=8, jitter=0.15, \
+                       single_band=0.15, i_scale=1000.0, seed=0):
+    """
+    Synthesize NIR and SWIR point clouds of a DWEL scan.
+
+    Shots are drawn from the AT projection at the given fraction. A shot is a
+    zero-hit shot with probability gap and has one zero-range point at both
+    wavelengths, otherwise it has 1 + Poisson(mean_returns-1) returns up to
+    max_returns at random ranges. Each return is retrieved at both wavelengths
+    with range noise of the given jitter, or at only one of them with
+    probability single_band. NIR reflectance is log-normal and SWIR
+    reflectance follows from a per-shot NDI.
+
+    Returns:
+
+        nirpoints, swirpoints (2D numpy array, float): [npts, ncols] with
+        columns in _synth_columns, sorted by sample, line and range.
+
+        ndiimg (3D numpy array, float32): [2, nrows, ncols], NDI and mask of
+        the shots, the gap-filled NDI image for union.
+    """
+    rs = np.random.RandomState(seed)
+
+    # shots in the scan, shot index = (sample-1)*nrows + line
+    shotind = np.where(rs.uniform(size=nrows*ncols) < fraction)[0]
+    nshots = len(shotind)
+    shotndi = np.clip(rs.normal(0.1, 0.15, size=nshots), -0.8, 0.8)
+
+    nret = np.minimum(1 + rs.poisson(max(mean_returns-1.0, 0.0), size=nshots), max_returns)
+    nret[rs.uniform(size=nshots) < gap] = 0
+    hitshot = np.repeat(np.arange(nshots), nret)
+    nhits = len(hitshot)
+    truerange = rs.uniform(0.5, 60.0, size=nhits)
+    nirrho = np.exp(rs.normal(np.log(0.4*i_scale), 0.5, size=nhits))
+    swirrho = nirrho * (1-shotndi[hitshot])/(1+shotndi[hitshot]) \
+              * np.exp(rs.normal(0.0, 0.05, size=nhits))
+
+    # which wavelength retrieves a return, 0: both, 1: NIR only, 2: SWIR only
+    bandflag = np.zeros(nhits, dtype=int)
+    tmpflag = rs.uniform(size=nhits) < single_band
+    bandflag[tmpflag] = rs.randint(1, 3, size=np.sum(tmpflag))
+
+    zeroshot = np.where(nret == 0)[0]
+    bandpoints = []
+    for ib, rho in zip([1, 2], [nirrho, swirrho]):
+        tmpflag = bandflag != 3-ib
+        ptsshot = np.hstack((hitshot[tmpflag], zeroshot))
+        ptsrange = np.hstack((truerange[tmpflag] + rs.normal(0.0, jitter, size=np.sum(tmpflag)), \
+                              np.zeros(len(zeroshot))))
+        ptsrange[:np.sum(tmpflag)] = np.fabs(ptsrange[:np.sum(tmpflag)])
+        ptsrho = np.hstack((rho[tmpflag], np.zeros(len(zeroshot))))
+
+        sample = shotind[ptsshot] // nrows + 1
+        line = shotind[ptsshot] % nrows + 1
+        sortind, num_of_returns, return_num, ptsshotnum = \
+            dpu.updateReturnNum(np.vstack((ptsrange, sample, line)).T, nrows=nrows)
+        ptsrange = ptsrange[sortind]
+        sample = sample[sortind]
+        line = line[sortind]
+        npts = len(ptsrange)
+
+        theta = (line - 0.5) / nrows * 180.0
+        phi = (sample - 0.5) / ncols * 360.0
+        sintheta = np.sin(np.deg2rad(theta))
+        points = np.zeros((npts, len(_synth_columns)))
+        points[:, 0] = ptsrange * sintheta * np.cos(np.deg2rad(phi))
+        points[:, 1] = ptsrange * sintheta * np.sin(np.deg2rad(phi))
+        points[:, 2] = ptsrange * np.cos(np.deg2rad(theta))
+        points[:, 3] = ptsrho[sortind]
+        points[:, 4] = return_num
+        points[:, 5] = num_of_returns
+        points[:, 6] = ptsshotnum
+        points[:, 7] = ptsrange
+        points[:, 8] = theta
+        points[:, 9] = phi
+        points[:, 10] = sample
+        points[:, 11] = line
+        points[:, 12] = points[:, 3] * ptsrange**2 / 50.0
+        points[:, 13] = np.where(ptsrange > 0, rs.uniform(0.5, 1.5, size=npts), 0.0)
+        bandpoints.append(points)
+
+    # mask of NDI image, 0: invalid shot, 1: measured NDI, 2: filled NDI, 3:
+    # no-return but valid shot
+    shotmask = np.zeros(nshots, dtype=int) + 3
+    shotmask[np.unique(hitshot)] = 2
+    shotmask[np.unique(hitshot[bandflag == 0])] = 1
+    ndiimg = np.zeros((2, nrows, ncols), dtype=np.float32)
+    rows = shotind % nrows
+    cols = shotind // nrows
+    ndiimg[0, rows, cols] = shotndi
+    ndiimg[1, rows, cols] = shotmask
+
+    return bandpoints[0], bandpoints[1], ndiimg
+
+def writeSynthPoints(points, outfile, wavelength, blockrows=1000000):
+    """
+    Write synthetic points to an ASCII point cloud file.
+    """
+    with open(outfile, 'w') as outfobj:
+        outfobj.write("// " + ",".join(_synth_columns) + "\n")
+        outfobj.write("// [DWEL Synthetic Point Cloud Data at {0:d} nm]\n".format(wavelength))
+        outfobj.write("// Run made at: {0:s}\n".format(time.strftime("%c")))
+        for i in range(0, len(points), blockrows):
+            outfobj.write(formatPoints(points[i:i+blockrows, :], _synth_formats))
+
+def writeSynthNDIImage(ndiimg, outfile):
+    """
+    Write a synthetic NDI image to an ENVI image file with its header.
+    """
+    ndiimg.astype(np.float32).tofile(outfile)
+    with open(outfile+".hdr", 'w') as hdrfobj:
+        hdrfobj.write("ENVI\n")
+        hdrfobj.write("description = {Synthetic gap-filled NDI image}\n")
+        hdrfobj.write("samples = {0:d}\n".format(ndiimg.shape[2]))
+        hdrfobj.write("lines = {0:d}\n".format(ndiimg.shape[1]))
+        hdrfobj.write("bands = {0:d}\n".format(ndiimg.shape[0]))
+        hdrfobj.write("header offset = 0\n")
+        hdrfobj.write("file type = ENVI Standard\n")
+        hdrfobj.write("data type = 4\n")
+        hdrfobj.write("interleave = bsq\n")
+        hdrfobj.write("byte order = {0:d}\n".format(0 if sys.byteorder == "little" else 1))
+        hdrfobj.write("band names = {NDI, Mask}\n")
+
+def runBenchmark(nirfile, swirfile, ndifile, outfile, nrows, ncols, \
+                     rdiff_thresh, engine="loop", binary=False):
+    """
+    Time the stages of spectral point generation.
+
+    Returns:
+
+        stats (list of tuple): (stage, seconds, rss_mb, peak_mb, npts) of each
+        stage.
+    """
+    stats = []
+    def record(stage, t0, npts):
+        rss, peak = memoryUsage()
+        stats.append((stage, time.time()-t0, rss, peak, npts))
+
+    sp = DWELSpectralPoints(nirfile, swirfile, rdiff_thresh, \
+                            nrows=nrows, ncols=ncols, engine=engine)
+    sp.ndiimgfile = ndifile
+
+    if binary:
+        t0 = time.time()
+        for ptsfile in [nirfile, swirfile]:
+            binfile = os.path.splitext(ptsfile)[0] + ".npy"
+            sp.convertPointsToBinary(ptsfile, binfile)
+        sp.nirfile = os.path.splitext(nirfile)[0] + ".npy"
+        sp.swirfile = os.path.splitext(swirfile)[0] + ".npy"
+        record("convert", t0, 0)
+
+    t0 = time.time()
+    nirpoints = sp.loadPoints(sp.nirfile)
+    swirpoints = sp.loadPoints(sp.swirfile)
+    record("load", t0, len(nirpoints)+len(swirpoints))
+
+    t0 = time.time()
+    sp.union = False
+    outpoints = sp.mergePointClouds(nirpoints, swirpoints)
+    record("intersect", t0, len(outpoints))
+    outpoints = None
+
+    t0 = time.time()
+    sp.union = True
+    outpoints = sp.mergePointClouds(nirpoints, swirpoints)
+    record("union", t0, len(outpoints))
+
+    t0 = time.time()
+    headerstr = sp._outputHeader()
+    fmtstr = sp._outputFormat()
+    outpoints = sp.addColorComposite(outpoints)
+    writer = DWELPointsWriter(outfile, fmtstr, delimiter=',', header=headerstr.rstrip())
+    writer.write(outpoints)
+    writer.close()
+    record("write", t0, len(outpoints))
+
+    return stats
+
+def main(cmdargs):
+    workdir = cmdargs.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="dwel_spectral_points_benchmark_")
+    elif not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    nirfile = os.path.join(workdir, "synth_nir_points.txt")
+    swirfile = os.path.join(workdir, "synth_swir_points.txt")
+    ndifile = os.path.join(workdir, "synth_ndi.img")
+    outfile = os.path.join(workdir, "synth_dual_points.txt")
+
+    print "Synthesizing a DWEL scan of {0:.1f}% of {1:d} x {2:d} shots".format(cmdargs.fraction*100, cmdargs.nrows, cmdargs.ncols)
+    t0 = time.time()
+    nirpoints, swirpoints, ndiimg = synthesizeScan(nrows=cmdargs.nrows, ncols=cmdargs.ncols, \
+                                                   fraction=cmdargs.fraction, gap=cmdargs.gap, \
+                                                   mean_returns=cmdargs.mean_returns, \
+                                                   max_returns=cmdargs.max_returns, \
+                                                   jitter=cmdargs.jitter, \
+                                                   single_band=cmdargs.single_band, \
+                                                   seed=cmdargs.seed)
+    writeSynthPoints(nirpoints, nirfile, 1064)
+    writeSynthPoints(swirpoints, swirfile, 1548)
+    writeSynthNDIImage(ndiimg, ndifile)
+    print "\t{0:d} NIR points, {1:d} SWIR points in {2:.3f} s".format(len(nirpoints), len(swirpoints), time.time()-t0)
+    nirpoints = None
+    swirpoints = None
+    ndiimg = None
+
+    try:
+        stats = runBenchmark(nirfile, swirfile, ndifile, outfile, \
+                             cmdargs.nrows, cmdargs.ncols, cmdargs.rdiff_thresh, \
+                             engine=cmdargs.engine, binary=cmdargs.binary)
+    finally:
+        if not cmdargs.keep:
+            shutil.rmtree(workdir)
+
+    print "Benchmark of {0:s} engine".format(cmdargs.engine)
+    print "\t{0:<10s}{1:>12s}{2:>12s}{3:>12s}{4:>12s}".format("stage", "seconds", "rss_mb", "peak_mb", "points")
+    for stage, sec, rss, peak, npts in stats:
+        print "\t{0:<10s}{1:>12.3f}{2:>12.1f}{3:>12.1f}{4:>12d}".format(stage, sec, rss, peak, npts)
+
+    if cmdargs.report is not None:
+        newreport = not os.path.isfile(cmdargs.report)
+        with open(cmdargs.report, 'a') as rptfobj:
+            if newreport:
+                rptfobj.write("run_time,engine,binary,nrows,ncols,fraction,seed,stage,seconds,rss_mb,peak_mb,points\n")
+            runtime = time.strftime("%Y-%m-%dT%H:%M:%S")
+            for stage, sec, rss, peak, npts in stats:
+                rptfobj.write("{0:s},{1:s},{2:d},{3:d},{4:d},{5:g},{6:d},{7:s},{8:.3f},{9:.1f},{10:.1f},{11:d}\n".format( \
+                    runtime, cmdargs.engine, int(cmdargs.binary), cmdargs.nrows, cmdargs.ncols, \
+                    cmdargs.fraction, cmdargs.seed, stage, sec, rss, peak, npts))
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
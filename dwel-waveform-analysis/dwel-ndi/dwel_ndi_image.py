@@ -5,9 +5,12 @@ Zhan Li, zhanli86@bu.edu
 Created: 20140728 
 """
 
+import sys
+import os
+import argparse
+import multiprocessing
+
 import numpy as np
-from osgeo import gdal
-import struct
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 
@@ -25,6 +28,12 @@ from mpldatacursor import datacursor # a module to create a simple data cursor
 # import sklearn, a python package of machine learning
 from sklearn import mixture
 
+# add dwel-data-utils folder to Python path
+addpath = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), "dwel-data-utils")
+if addpath not in sys.path:
+    sys.path.append(addpath)
+import dwel_envi_raster as envi
+
 def dwel_ndi_image(nir_scan, swir_scan, mask):
     """
     Generate an NDI image from two bands of DWEL scans and a mask file to
@@ -58,6 +67,191 @@ def dwel_ndi_image(nir_scan, swir_scan, mask):
         swir_scan[nonzero_ind]) 
     return {'NDI':ndi, 'NO_DATA':nodata}
 
+def fit_ring_gmm(nir_ancfile, swir_ancfile, outfile, zenith_step=5.0, range_step=5.0, \
+                 max_zenith=117.0, max_range=None, ncomp=2, min_count=200, \
+                 max_samples=20000, nproc=1, seed=0, \
+                 intbandind=2, maskbandind=13, zenithbandind=9, rgbandind=7, \
+                 angle_scale=100.0, rg_scale=100.0):
+    """
+    Fit Gaussian mixtures to NDI of valid shots in bins of zenith ring and
+    range, and write a table of the component parameters and NDI thresholds
+    between the components of each bin. Only shots with returns at both
+    wavelengths are used, as NDI of a shot with a return at one wavelength
+    is exactly 1 or -1 and has no mean range of the two wavelengths.
+
+    Parameters
+    ----------
+    nir_ancfile, swir_ancfile: str
+        pcinfo images of the two wavelengths.
+    outfile: str
+        CSV table, one row per bin, with the zenith and range extents of the
+    bin, number of shots, convergence flag, mean, sigma and weight of each
+    component in ascending order of mean, and the thresholds between
+    neighboring components, NaN if two components do not cross between
+    their means.
+    zenith_step, range_step: float
+        width of zenith rings in degree and of range bins in meter.
+    ncomp: int
+        number of mixture components, at least 2 to have a threshold.
+    min_count: int
+        bins with fewer valid shots are not fitted.
+    max_samples: int
+        at most this number of shots randomly drawn from a bin are fitted.
+    nproc: int
+        number of processes to fit the bins.
+
+    Returns
+    -------
+    table: numpy array
+        the rows written to outfile.
+    """
+    if ncomp < 2:
+        raise RuntimeError("fit_ring_gmm: ncomp is {0:d}, at least 2 components are needed for NDI thresholds".format(ncomp))
+    nir_wfmean = envi.readBand(nir_ancfile, intbandind).astype(np.float_)
+    swir_wfmean = envi.readBand(swir_ancfile, intbandind).astype(np.float_)
+    mask = np.logical_and(envi.readBand(nir_ancfile, maskbandind) != 0, \
+                          envi.readBand(swir_ancfile, maskbandind) != 0)
+    # returns at both wavelengths
+    mask = np.logical_and(mask, np.logical_and(nir_wfmean > 0, swir_wfmean > 0))
+    ndi = dwel_ndi_image(nir_wfmean, swir_wfmean, mask)['NDI']
+    zenith = envi.readBand(nir_ancfile, zenithbandind) / angle_scale
+    # mean range of the shot at the two wavelengths, both with returns in
+    # valid shots
+    rg = (envi.readBand(nir_ancfile, rgbandind).astype(np.float_) \
+          + envi.readBand(swir_ancfile, rgbandind)) / (2.0*rg_scale)
+
+    valid = np.logical_and(mask, np.fabs(ndi) <= 1.0)
+    valid = np.logical_and(valid, zenith < max_zenith)
+    valid = np.logical_and(valid, rg > 0)
+    if max_range is not None:
+        valid = np.logical_and(valid, rg < max_range)
+    ndi = ndi[valid]
+    zenind = np.floor(zenith[valid]/zenith_step).astype(np.int_)
+    rgind = np.floor(rg[valid]/range_step).astype(np.int_)
+    nrgbins = rgind.max()+1 if len(rgind) else 1
+
+    # group shots by bin
+    binkey = zenind*nrgbins + rgind
+    order = np.argsort(binkey, kind='mergesort')
+    ndi = ndi[order]
+    ukey, start, counts = np.unique(binkey[order], return_index=True, return_counts=True)
+    tasks = []
+    rs = np.random.RandomState(seed)
+    for key, i0, n in zip(ukey, start, counts):
+        if n < min_count:
+            continue
+        values = ndi[i0:i0+n]
+        if n > max_samples:
+            values = values[np.sort(rs.choice(n, max_samples, replace=False))]
+        tasks.append((key, values, ncomp, seed))
+    print "\t{0:d} of {1:d} bins have at least {2:d} shots".format(len(tasks), len(ukey), min_count)
+
+    print "\tFitting Gaussian mixtures of {0:d} bins in {1:d} processes".format(len(tasks), nproc)
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            results = dict(pool.imap_unordered(_fit_bin_gmm, tasks))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        results = dict(map(_fit_bin_gmm, tasks))
+
+    table = np.zeros((len(tasks), 6+ncomp*3+ncomp-1))
+    for i, key in enumerate(sorted(results.keys())):
+        zi, ri = divmod(key, nrgbins)
+        means, sigmas, weights, converged = results[key]
+        table[i, 0:6] = [zi*zenith_step, (zi+1)*zenith_step, ri*range_step, (ri+1)*range_step, \
+                         counts[np.searchsorted(ukey, key)], converged]
+        table[i, 6:6+ncomp*3] = np.column_stack((means, sigmas, weights)).ravel()
+        table[i, 6+ncomp*3:] = [gmm_threshold(means[k], sigmas[k], weights[k], \
+                                              means[k+1], sigmas[k+1], weights[k+1]) \
+                                for k in range(ncomp-1)]
+
+    header = ["zenith_min", "zenith_max", "range_min", "range_max", "npixels", "converged"]
+    for k in range(ncomp):
+        header += ["mean_{0:d}".format(k+1), "sigma_{0:d}".format(k+1), "weight_{0:d}".format(k+1)]
+    header += ["threshold_{0:d}".format(k+1) for k in range(ncomp-1)]
+    np.savetxt(outfile, table, fmt="%.6g", delimiter=",", header=",".join(header), comments="")
+    print "\tNDI mixtures of zenith rings and range bins written to {0:s}".format(outfile)
+    return table
+
+def _fit_bin_gmm(args):
+    """
+    Fit a Gaussian mixture to NDI of one bin, in a worker process of
+    fit_ring_gmm. Components are sorted by mean.
+    """
+    key, values, ncomp, seed = args
+    g = mixture.GaussianMixture(n_components=ncomp, covariance_type='full', random_state=seed)
+    g.fit(values[:, np.newaxis])
+    means = g.means_.ravel()
+    order = np.argsort(means)
+    return key, (means[order], np.sqrt(g.covariances_.ravel()[order]), g.weights_[order], g.converged_)
+
+def gmm_threshold(mu1, sig1, w1, mu2, sig2, w2):
+    """
+    NDI between the means of two weighted Gaussian components where the two
+    components have the same density, NaN if there is no such NDI.
+    """
+    # quadratic a*x**2 + b*x + c = 0 from equal log densities
+    a = 0.5/sig2**2 - 0.5/sig1**2
+    b = mu1/sig1**2 - mu2/sig2**2
+    c = 0.5*mu2**2/sig2**2 - 0.5*mu1**2/sig1**2 + np.log(w1/sig1) - np.log(w2/sig2)
+    if np.fabs(a) < 1e-12*max(np.fabs(b), 1.0):
+        roots = np.array([-c/b]) if b != 0 else np.array([])
+    else:
+        roots = np.roots([a, b, c])
+        roots = roots[np.isreal(roots)].real
+    lo, hi = min(mu1, mu2), max(mu1, mu2)
+    roots = roots[np.logical_and(roots >= lo, roots <= hi)]
+    return roots[0] if len(roots) else np.nan
+
+def lookup_ndi_threshold(tablefile, zenith, rg, ithresh=1, default=np.nan):
+    """
+    Look up NDI thresholds of points by their zenith angles and ranges from a
+    table written by fit_ring_gmm.
+
+    Parameters
+    ----------
+    ithresh: int
+        which threshold, 1 for the one between the first and second
+    components, up to the number of components minus 1 in the table.
+    default: float
+        threshold of points out of the fitted bins or of bins without a
+    threshold.
+
+    Returns
+    -------
+    threshold: numpy array
+        NDI threshold of each point.
+    """
+    table = np.genfromtxt(tablefile, delimiter=",", names=True)
+    table = np.atleast_1d(table)
+    name = 'threshold_{0:d}'.format(ithresh)
+    if name not in table.dtype.names:
+        nthresh = len([n for n in table.dtype.names if n.startswith('threshold_')])
+        raise RuntimeError("lookup_ndi_threshold: no {0:s} in {1:s}, which has {2:d} thresholds".format(name, tablefile, nthresh))
+    zenith, rg = np.broadcast_arrays(np.asarray(zenith, dtype=np.float_), np.asarray(rg, dtype=np.float_))
+    threshold = np.zeros(zenith.shape) + default
+    if len(table) == 0:
+        return threshold
+    zenith_step = table['zenith_max'][0] - table['zenith_min'][0]
+    range_step = table['range_max'][0] - table['range_min'][0]
+    zi = np.rint(table['zenith_min']/zenith_step).astype(np.int_)
+    ri = np.rint(table['range_min']/range_step).astype(np.int_)
+    # threshold grid of zenith rings by range bins
+    grid = np.zeros((zi.max()+1, ri.max()+1)) + np.nan
+    grid[zi, ri] = table[name]
+    pzi = np.floor(zenith/zenith_step).astype(np.int_)
+    pri = np.floor(rg/range_step).astype(np.int_)
+    inside = (pzi >= 0) & (pzi < grid.shape[0]) & (pri >= 0) & (pri < grid.shape[1])
+    tmp = grid[pzi[inside], pri[inside]]
+    threshold[inside] = np.where(np.isnan(tmp), default, tmp)
+    return threshold
+
 def __main__():
     # nir_ancfile = "/projectnb/echidna/lidar/DWEL_Processing/HF2014/Hemlock20140609/C/HFHL_20140609_C_1064_cube_nu_basefix_satfix_pfilter_b32r04_wfmax_at_project_extrainfo.img"
     # swir_ancfile = "/projectnb/echidna/lidar/DWEL_Processing/HF2014/Hemlock20140609/C/HFHL_20140609_C_1548_cube_nu_basefix_satfix_pfilter_b32r04_wfmax_at_project_extrainfo.img"
@@ -85,45 +279,14 @@ def __main__():
     min_zenith = 0.0
     max_zenith = 117.0
     
-    # open the ancillary files of two bands
-    nir_ads = gdal.Open(nir_ancfile, gdal.GA_ReadOnly)
-    swir_ads = gdal.Open(swir_ancfile, gdal.GA_ReadOnly)
-    
-    # fetch the waveform mean intensity band
-    nir_wfmean_band = nir_ads.GetRasterBand(intbandind) # the fifth band in the ancillary
-# file is waveform mean.
-    swir_wfmean_band = swir_ads.GetRasterBand(intbandind)
-    # read the waveform mean
-    nir_wfmean = nir_wfmean_band.ReadRaster(0, 0, nir_wfmean_band.XSize,
-        nir_wfmean_band.YSize, nir_wfmean_band.XSize, nir_wfmean_band.YSize,
-        nir_wfmean_band.DataType)
-#    import pdb; pdb.set_trace()
-    nir_wfmean = struct.unpack('i'*nir_wfmean_band.XSize*nir_wfmean_band.YSize,
-        nir_wfmean) # convert the binary string from raster reading to a tuple
-    nir_wfmean = np.asarray(nir_wfmean) # convert python tuple to numpy array
-    nir_wfmean = np.reshape(nir_wfmean, (nir_wfmean_band.YSize,
-        nir_wfmean_band.XSize)) # reshape the array to image dimension
-
-    swir_wfmean = swir_wfmean_band.ReadRaster(0, 0, swir_wfmean_band.XSize,
-        swir_wfmean_band.YSize, swir_wfmean_band.XSize, swir_wfmean_band.YSize,
-        swir_wfmean_band.DataType)
-    swir_wfmean = struct.unpack('i'*swir_wfmean_band.XSize*swir_wfmean_band.YSize,
-        swir_wfmean) # convert the binary string from raster reading to a tuple 
-    swir_wfmean = np.asarray(swir_wfmean) # convert python tuple to numpy array
-    swir_wfmean = np.reshape(swir_wfmean, (swir_wfmean_band.YSize,
-        swir_wfmean_band.XSize)) # reshape the array to image dimension
-
-    # fetch the mask band
-    mask_band = nir_ads.GetRasterBand(maskbandind) # the fourth band in the ancillary file
-# is mask.
+    # read the waveform mean intensity band of the ancillary files of two
+    # bands. The bands are memory-mapped views of the files and converted to
+    # integer arrays.
+    nir_wfmean = envi.readBand(nir_ancfile, intbandind).astype(int)
+    swir_wfmean = envi.readBand(swir_ancfile, intbandind).astype(int)
+
     # read mask
-    mask = mask_band.ReadRaster(0, 0, mask_band.XSize, mask_band.YSize,
-    mask_band.XSize, mask_band.YSize, mask_band.DataType) 
-    mask = struct.unpack('i'*mask_band.XSize*mask_band.YSize, mask) # convert
-# the binary string from raster reading to a tuple 
-    mask = np.asarray(mask) # convert python tuple to numpy array 
-    mask = np.reshape(mask, (mask_band.YSize, mask_band.XSize)) # reshape the
-# array to image dimension
+    mask = envi.readBand(nir_ancfile, maskbandind).astype(int)
 
     # calculate NDI image
     ndi = dwel_ndi_image(nir_wfmean, swir_wfmean, mask) 
@@ -131,16 +294,7 @@ def __main__():
 
     # clip away the casing area from the NDI image
     # read out the zenith angle
-    zenith_band = nir_ads.GetRasterBand(zenithbandind) # the second band in the ancillary file
-# is zenith angles.
-    # read zenith
-    zenith = zenith_band.ReadRaster(0, 0, zenith_band.XSize, zenith_band.YSize,
-        zenith_band.XSize, zenith_band.YSize, zenith_band.DataType) 
-    zenith = struct.unpack('i'*zenith_band.XSize*zenith_band.YSize, zenith) # convert
-# the binary string from raster reading to a tuple 
-    zenith = np.asarray(zenith) # convert python tuple to numpy array 
-    zenith = np.reshape(zenith, (zenith_band.YSize, zenith_band.XSize)) # reshape the
-# array to image dimension
+    zenith = envi.readBand(nir_ancfile, zenithbandind).astype(int)
     zenith = zenith / angle_scale # rescale
     # the zenith angle beyond max_zenith degree is inside the case
     casing_edge_ind = np.zeros(zenith.shape[0])
@@ -245,10 +399,44 @@ def __main__():
     # export the figure to plotly website
     # ndi_hist_url = py.plot_mpl(ndihistfig,
     #     filename=('atwfmax NDI hist ' + site_name), auto_open=False)
-    
-    # close gdal datasets
-    del nir_ads
-    del swir_ads
+
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="NDI image and NDI mixture models of DWEL scans")
+    sp = p.add_subparsers(dest="command")
+
+    sp.add_parser("image", help="NDI image, histogram and thresholding of the scan set in the code")
+
+    pg = sp.add_parser("ring-gmm", help="Fit Gaussian mixtures to NDI in bins of zenith ring and range")
+    pg.add_argument("-n", "--nir", dest="nirfile", required=True, help="DWEL pcinfo file of NIR")
+    pg.add_argument("-s", "--swir", dest="swirfile", required=True, help="DWEL pcinfo file of SWIR")
+    pg.add_argument("-o", "--output", dest="outfile", required=True, help="Output CSV table of mixture parameters and NDI thresholds per bin")
+    pg.add_argument("--zenith-step", dest="zenith_step", type=float, default=5.0, help="Width of zenith rings, degree. Default: 5")
+    pg.add_argument("--range-step", dest="range_step", type=float, default=5.0, help="Width of range bins, meter. Default: 5")
+    pg.add_argument("--max-zenith", dest="max_zenith", type=float, default=117.0, help="Shots beyond this zenith angle are in the casing. Default: 117")
+    pg.add_argument("--max-range", dest="max_range", type=float, default=None, help="Maximum range of shots to fit, meter. Default: no limit")
+    pg.add_argument("-k", "--ncomp", dest="ncomp", type=int, default=2, help="Number of mixture components, at least 2. Default: 2")
+    pg.add_argument("--min-count", dest="min_count", type=int, default=200, help="Minimum number of shots of a bin to fit. Default: 200")
+    pg.add_argument("--max-samples", dest="max_samples", type=int, default=20000, help="Maximum number of shots of a bin to fit, drawn randomly. Default: 20000")
+    pg.add_argument("--nproc", dest="nproc", type=int, default=1, help="Number of processes. Default: 1")
+    pg.add_argument("--seed", dest="seed", type=int, default=0, help="Random seed. Default: 0")
+
+    cmdargs = p.parse_args()
+    if cmdargs.command == "ring-gmm" and cmdargs.ncomp < 2:
+        pg.error("--ncomp must be at least 2 to have NDI thresholds between components")
+    return cmdargs
 
 if __name__ == "__main__":
-    __main__()
+    # without arguments, process the scan set in the code as before
+    if len(sys.argv) == 1:
+        __main__()
+        sys.exit()
+    cmdargs = getCmdArgs()
+    if cmdargs.command == "image":
+        __main__()
+    elif cmdargs.command == "ring-gmm":
+        fit_ring_gmm(cmdargs.nirfile, cmdargs.swirfile, cmdargs.outfile, \
+                     zenith_step=cmdargs.zenith_step, range_step=cmdargs.range_step, \
+                     max_zenith=cmdargs.max_zenith, max_range=cmdargs.max_range, \
+                     ncomp=cmdargs.ncomp, min_count=cmdargs.min_count, \
+                     max_samples=cmdargs.max_samples, nproc=cmdargs.nproc, seed=cmdargs.seed)
@@ -51,3 +51,124 @@ def fit_two_peaks_EM(sample, sigma, weights=False,
 def pdf_model(x, p):
     mu1, sig1, mu2, sig2, pi_1 = p
     return pi_1*norm.pdf(x, mu1, sig1) + (1-pi_1)*norm.pdf(x, mu2, sig2)
+
+def fit_two_peaks_EM_batch(samples, sigmas=None, weights=False,
+                           p0=np.array([0.1,0.2,0.6,0.2,0.5]),
+                           max_iter=300, tolerance=1e-3):
+    """
+    Fit two-peak Gaussian mixtures to many independent 1D samples at once,
+    e.g. NDI of every range bin or zenith ring, with the same EM steps and
+    convergence check as fit_two_peaks_EM. The E and M steps of all the
+    samples are done together, and a sample stops iterating once it
+    converges.
+
+    Args:
+        samples: list of 1D arrays of different sizes, or 2D array [number
+        of samples, size] padded with NaN, e.g. from group_samples.
+        sigmas: uncertainties of the samples in the same layout, used as
+        weights 1/sigma**2 if weights is True.
+        p0: initial parameters [mu1, sig1, mu2, sig2, pi_1], one set for all
+        the samples or 2D array [number of samples, 5].
+
+    Returns:
+        p: 2D array [number of samples, 5], fitted parameters. NaN for an
+        empty sample.
+        converged: boolean array, if the fit of a sample converged.
+        niter: number of iterations of each sample.
+    """
+    x, valid = _pad_samples(samples)
+    nsample = x.shape[0]
+    N = valid.sum(axis=1).astype(np.float_)
+    if not weights: w = valid.astype(np.float_)
+    else:
+        s, _ = _pad_samples(sigmas)
+        if s.shape != x.shape:
+            raise RuntimeError("Sigmas are not in the same layout as samples")
+        w = np.zeros_like(x)
+        w[valid] = 1./(s[valid]**2)
+    nonempty = N > 0
+    w[nonempty] *= (N[nonempty]/w[nonempty].sum(axis=1))[:, np.newaxis] # renormalization so they sum to N
+    x[~valid] = 0.0
+
+    p = np.empty((nsample, 5))
+    p[:] = np.asarray(p0, dtype=np.float_)
+    p[~nonempty] = np.nan
+    converged = np.zeros(nsample, dtype=np.bool_)
+    niter = np.zeros(nsample, dtype=np.int_)
+
+    # samples still iterating and their data
+    active = np.nonzero(nonempty)[0]
+    xa, wa, va, Na, p_new = x[active], w[active], valid[active], N[active], p[active]
+    counter = 0
+    while len(active) > 0:
+        p_old = p_new
+        mu = p_old[:, [0, 2]]
+        sig = p_old[:, [1, 3]]
+        pi_ = np.column_stack((p_old[:, 4], 1-p_old[:, 4]))
+        # E step, responsibility of the two components, [sample, component, point]
+        dens = pi_[:, :, np.newaxis] * _norm_pdf(xa[:, np.newaxis, :], \
+                                                 mu[:, :, np.newaxis], sig[:, :, np.newaxis])
+        pdf = dens.sum(axis=1)
+        pdf[~va] = 1.0
+        gamma = wa[:, np.newaxis, :]*dens/pdf[:, np.newaxis, :]
+        # M step
+        N_ = gamma.sum(axis=2)
+        mu = np.sum(gamma*xa[:, np.newaxis, :], axis=2)/N_
+        sig = np.sqrt(np.sum(gamma*(xa[:, np.newaxis, :]-mu[:, :, np.newaxis])**2, axis=2)/N_)
+        p_new = np.column_stack((mu[:, 0], sig[:, 0], mu[:, 1], sig[:, 1], N_[:, 0]/Na))
+
+        # Convergence check
+        counter += 1
+        max_variation = np.max((p_new-p_old)/p_old, axis=1)
+        conv = max_variation < tolerance
+        stop = conv | (counter >= max_iter)
+        if np.any(stop):
+            p[active[stop]] = p_new[stop]
+            converged[active[stop]] = conv[stop]
+            niter[active[stop]] = counter
+            keep = np.logical_not(stop)
+            active = active[keep]
+            xa, wa, va, Na, p_new = xa[keep], wa[keep], va[keep], Na[keep], p_new[keep]
+    nfail = np.sum(nonempty & np.logical_not(converged))
+    if nfail > 0: print "WARNING: {0:d} of {1:d} samples not converged".format(nfail, nsample)
+    return p, converged, niter
+
+def group_samples(values, labels):
+    """
+    Group values by labels, e.g. range bin or zenith ring indices, into
+    samples for fit_two_peaks_EM_batch.
+
+    Returns:
+        samples: 2D array [number of labels, size of the largest group],
+        padded with NaN.
+        ulabels: the unique labels in the order of rows of samples.
+    """
+    values = np.asarray(values, dtype=np.float_).ravel()
+    labels = np.asarray(labels).ravel()
+    order = np.argsort(labels, kind='mergesort')
+    ulabels, start, counts = np.unique(labels[order], return_index=True, return_counts=True)
+    samples = np.empty((len(ulabels), counts.max() if len(counts) else 0))
+    samples.fill(np.nan)
+    samples[np.repeat(np.arange(len(ulabels)), counts), \
+            np.arange(len(values))-np.repeat(start, counts)] = values[order]
+    return samples, ulabels
+
+def _pad_samples(samples):
+    """
+    Padded 2D array of samples, with padding set to NaN, and the mask of valid
+    values.
+    """
+    if isinstance(samples, np.ndarray) and samples.ndim == 2:
+        x = samples.astype(np.float_)
+        valid = np.logical_not(np.isnan(x))
+    else:
+        sizes = np.array([np.size(s) for s in samples], dtype=np.int_)
+        x = np.empty((len(sizes), sizes.max() if len(sizes) else 0))
+        x.fill(np.nan)
+        valid = np.arange(x.shape[1]) < sizes[:, np.newaxis]
+        if len(sizes) > 0:
+            x[valid] = np.concatenate([np.ravel(s) for s in samples])
+    return x, valid
+
+def _norm_pdf(x, mu, sig):
+    return np.exp(-0.5*((x-mu)/sig)**2)/(np.sqrt(2*np.pi)*sig)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Benchmark the batched two-peak EM in simpleEM against fitting the samples one
+by one with fit_two_peaks_EM, on synthetic NDI samples of many bins.
+
+USAGE:
+
+    python simpleEM_benchmark.py [-b NBINS] [--min-size MIN_SIZE] [--max-size MAX_SIZE]
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from simpleEM import fit_two_peaks_EM, fit_two_peaks_EM_batch
+
+def getCmdArgs():
+    p = argparse.ArgumentParser(description="Benchmark batched two-peak EM fitting of NDI samples")
+
+    p.add_argument("-b", "--nbins", dest="nbins", type=int, default=300, help="Number of bins, i.e. independent samples. Default: 300")
+    p.add_argument("--min-size", dest="min_size", type=int, default=200, help="Minimum number of NDI values in a bin. Default: 200")
+    p.add_argument("--max-size", dest="max_size", type=int, default=5000, help="Maximum number of NDI values in a bin. Default: 5000")
+    p.add_argument("--seed", dest="seed", type=int, default=0, help="Random seed. Default: 0")
+
+    cmdargs = p.parse_args()
+    return cmdargs
+
+def synthSamples(nbins, min_size, max_size, seed=0):
+    """
+    NDI samples of bins, each a mixture of a leaf and a bark peak with random
+    locations, widths and proportions.
+    """
+    rs = np.random.RandomState(seed)
+    samples = []
+    for i in range(nbins):
+        n = rs.randint(min_size, max_size+1)
+        pi_1 = rs.uniform(0.2, 0.8)
+        n1 = rs.binomial(n, pi_1)
+        samples.append(np.hstack((rs.normal(rs.uniform(0.05, 0.2), rs.uniform(0.03, 0.08), n1), \
+                                  rs.normal(rs.uniform(0.45, 0.65), rs.uniform(0.03, 0.08), n-n1))))
+    return samples
+
+def main(cmdargs):
+    samples = synthSamples(cmdargs.nbins, cmdargs.min_size, cmdargs.max_size, seed=cmdargs.seed)
+    print "{0:d} bins, {1:d} NDI values".format(len(samples), np.sum([len(s) for s in samples]))
+
+    t0 = time.time()
+    p_loop = np.array([fit_two_peaks_EM(s, None) for s in samples])
+    t_loop = time.time() - t0
+    print "fit_two_peaks_EM, one by one: {0:.3f} seconds".format(t_loop)
+
+    t0 = time.time()
+    p_batch, converged, niter = fit_two_peaks_EM_batch(samples)
+    t_batch = time.time() - t0
+    print "fit_two_peaks_EM_batch: {0:.3f} seconds, {1:.1f}x, mean iterations {2:.1f}".format(t_batch, t_loop/t_batch, np.mean(niter))
+
+    print "Maximum absolute difference in parameters: {0:.3g}".format(np.nanmax(np.fabs(p_batch-p_loop)))
+
+if __name__ == "__main__":
+    cmdargs = getCmdArgs()
+    main(cmdargs)
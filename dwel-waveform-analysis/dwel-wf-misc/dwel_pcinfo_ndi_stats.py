@@ -12,17 +12,19 @@ import sys
 import os
 
 import numpy as np
-from osgeo import gdal, gdalconst
-import struct
 
 import matplotlib as mpl
 mpl.use('agg')
 import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
 #from mpldatacursor import datacursor # a module to create a simple data cursor
 # widget equivalent to MATLAB's datacursormode.
 
-# register dataset formatl
-gdal.AllRegister()
+# add dwel-data-utils folder to Python path
+addpath = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), "dwel-data-utils")
+if addpath not in sys.path:
+    sys.path.append(addpath)
+import dwel_envi_raster as envi
 
 def dwel_ndi_image(nir_scan, swir_scan, mask):
     """
@@ -57,6 +59,130 @@ def dwel_ndi_image(nir_scan, swir_scan, mask):
         swir_scan[nonzero_ind]) 
     return {'NDI':ndi, 'NO_DATA':np.nan}
 
+def density_2d(x, y, nbins, xrange=None, yrange=None):
+    """
+    Count points in 2D bins of x and y.
+
+    Parameters
+    ----------
+    x, y: numpy array
+        coordinates of points.
+    nbins: tuple
+        number of bins along x and y.
+    xrange, yrange: tuple
+        (min, max) of the bins, default the range of points.
+
+    Returns
+    -------
+    counts: numpy array [nbins[0], nbins[1]]
+        number of points in each bin.
+    xedges, yedges: numpy array
+        bin edges along x and y.
+    """
+    xedges = np.linspace(*(xrange if xrange is not None else (x.min(), x.max())), num=nbins[0]+1)
+    yedges = np.linspace(*(yrange if yrange is not None else (y.min(), y.max())), num=nbins[1]+1)
+    ix = _bin_index(x, xedges)
+    iy = _bin_index(y, yedges)
+    inbin = np.logical_and(ix>=0, iy>=0)
+    counts = np.bincount(ix[inbin]*nbins[1]+iy[inbin], minlength=nbins[0]*nbins[1])
+    return counts.reshape(nbins), xedges, yedges
+
+def binned_stats(x, y, xedges, percentiles=()):
+    """
+    Mean and percentiles of y in each bin of x. Percentiles are linearly
+    interpolated as numpy.percentile.
+
+    Returns
+    -------
+    ymean: numpy array [number of bins]
+        mean of y, NaN for empty bins.
+    ypct: numpy array [number of percentiles, number of bins]
+        percentiles of y, NaN for empty bins.
+    """
+    nbins = len(xedges)-1
+    ix = _bin_index(x, xedges)
+    inbin = ix>=0
+    ix = ix[inbin]
+    y = y[inbin]
+    counts = np.bincount(ix, minlength=nbins)
+    nonempty = counts>0
+    ymean = np.zeros(nbins) + np.nan
+    ymean[nonempty] = np.bincount(ix, weights=y, minlength=nbins)[nonempty] / counts[nonempty]
+
+    # sort y within each bin, then pick the percentiles from bin segments
+    ysorted = y[np.lexsort((y, ix))]
+    start = np.cumsum(counts) - counts
+    ypct = np.zeros((len(percentiles), nbins)) + np.nan
+    for i, q in enumerate(percentiles):
+        pos = start[nonempty] + q/100.0*(counts[nonempty]-1)
+        lo = np.floor(pos).astype(np.int_)
+        hi = np.minimum(lo+1, start[nonempty]+counts[nonempty]-1)
+        ypct[i, nonempty] = ysorted[lo] + (pos-lo)*(ysorted[hi]-ysorted[lo])
+    return ymean, ypct
+
+def _bin_index(v, edges):
+    """
+    Index of the bin of each value, -1 for values out of the bins. The last
+    bin includes the right edge.
+    """
+    ind = np.searchsorted(edges, v, side='right') - 1
+    ind[v==edges[-1]] = len(edges)-2
+    ind[np.logical_or(ind<0, ind>len(edges)-2)] = -1
+    return ind
+
+def plot_xy(x, y, xlabel, ylabel, title, outfile, plotmode='density', nbins=(200, 200), percentiles=None):
+    """
+    Plot y against x, either as a scatter plot of all the points or as an
+    image of point counts in 2D bins, and save the figure. The counts take
+    the same time to render for any number of points.
+
+    Parameters
+    ----------
+    plotmode: str
+        'density' or 'scatter'.
+    nbins: tuple
+        number of bins along x and y of the density image, and the number of
+        bins along x of the curves.
+    percentiles: list
+        if given, overlay the curves of mean and these percentiles of y in bins
+        of x.
+    """
+    valid = np.logical_and(np.isfinite(x), np.isfinite(y))
+    x = x[valid]
+    y = y[valid]
+    if len(x) == 0:
+        print "No valid shots to plot for {0:s}".format(outfile)
+        return
+
+    plt.figure()
+    if plotmode == 'scatter':
+        plt.plot(x, y, '.')
+    elif plotmode == 'density':
+        counts, xedges, yedges = density_2d(x, y, nbins)
+        plt.imshow(np.ma.masked_equal(counts.T, 0), origin='lower', aspect='auto', \
+                   interpolation='nearest', extent=(xedges[0], xedges[-1], yedges[0], yedges[-1]), \
+                   norm=mcolors.LogNorm(), cmap='viridis')
+        cb = plt.colorbar()
+        cb.set_label("number of shots")
+    else:
+        raise RuntimeError("Unknown plot mode: {0:s}".format(plotmode))
+
+    if percentiles is not None:
+        xedges = np.linspace(x.min(), x.max(), nbins[0]+1)
+        xcenters = (xedges[:-1]+xedges[1:])/2.0
+        ymean, ypct = binned_stats(x, y, xedges, percentiles)
+        plt.plot(xcenters, ymean, '-r', label="mean")
+        pctlabel = ", ".join(["{0:g}".format(q) for q in percentiles]) + " percentiles"
+        for i, yq in enumerate(ypct):
+            plt.plot(xcenters, yq, '--k', linewidth=0.8, label=(pctlabel if i==0 else '_nolegend_'))
+        plt.legend(loc='best')
+
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    plt.title(title)
+    plt.savefig(outfile)
+    plt.close()
+
 def main(cmdargs):
     # nir_ancfile = "/projectnb/echidna/lidar/DWEL_Processing/HF2014/Hemlock20140609/C/HFHL_20140609_C_1064_cube_nu_basefix_satfix_pfilter_b32r04_wfmax_at_project_extrainfo.img"
     # swir_ancfile = "/projectnb/echidna/lidar/DWEL_Processing/HF2014/Hemlock20140609/C/HFHL_20140609_C_1548_cube_nu_basefix_satfix_pfilter_b32r04_wfmax_at_project_extrainfo.img"
@@ -92,34 +218,25 @@ def main(cmdargs):
     min_zenith = 0.0
     max_zenith = 115.0
 
-    dual_ads = dict()
-    # open the ancillary files of two bands
-    for f in dual_ancfiles:
-        dual_ads[f] = gdal.Open(dual_ancfiles[f], gdal.GA_ReadOnly)
-
     # read the waveform mean intensity band
     dual_wfmean = dict()
-    for f in dual_ads:
-        wfmean_band = dual_ads[f].GetRasterBand(intbandind)
-        dual_wfmean[f] = wfmean_band.ReadAsArray(0, 0, wfmean_band.XSize, wfmean_band.YSize).astype(np.float_)
+    for f in dual_ancfiles:
+        dual_wfmean[f] = envi.readBand(dual_ancfiles[f], intbandind).astype(np.float_)
 
     # read the mask band
     dual_mask = dict()
-    for f in dual_ads:
-        mask_band = dual_ads[f].GetRasterBand(maskbandind)
-        dual_mask[f] = mask_band.ReadAsArray(0, 0, mask_band.XSize, mask_band.YSize).astype(np.bool_)
+    for f in dual_ancfiles:
+        dual_mask[f] = envi.readBand(dual_ancfiles[f], maskbandind).astype(np.bool_)
 
     # read the band of number of hits
     dual_nhit = dict()
-    for f in dual_ads:
-        nhit_band = dual_ads[f].GetRasterBand(nhitbandind)
-        dual_nhit[f] = nhit_band.ReadAsArray(0, 0, nhit_band.XSize, nhit_band.YSize).astype(np.int_)
+    for f in dual_ancfiles:
+        dual_nhit[f] = envi.readBand(dual_ancfiles[f], nhitbandind).astype(np.int_)
 
     # read the band of mean range
     dual_meanrg = dict()
-    for f in dual_ads:
-        rg_band = dual_ads[f].GetRasterBand(rgbandind)
-        dual_meanrg[f] = rg_band.ReadAsArray(0, 0, rg_band.XSize, rg_band.YSize).astype(np.float_)
+    for f in dual_ancfiles:
+        dual_meanrg[f] = envi.readBand(dual_ancfiles[f], rgbandind).astype(np.float_)
         dual_meanrg[f] = dual_meanrg[f]/100.0
         
     # select nhit==1 shots, i.e. single-return shots, and the difference in the
@@ -133,28 +250,20 @@ def main(cmdargs):
     # calculate NDI image
     ndi = dwel_ndi_image(dual_wfmean['nir'], dual_wfmean['swir'], mask_all) 
     
+    plotopts = {'plotmode':cmdargs.plotmode, 'nbins':(cmdargs.nbins, cmdargs.nbins), \
+                'percentiles':cmdargs.percentiles}
+
     # plot intensity against range
     for f in dual_wfmean:
-        plt.figure()
-        plt.plot(dual_meanrg[f][mask_all].flatten(), dual_wfmean[f][mask_all].flatten(), '.')
-        plt.xlabel(("mean range, meter"))
-        plt.ylabel(("total_d, app refl"))
-        plt.title(("peak intensity of single-return shots from pcinfo image, "+f))
-        plt.savefig(os.path.join(outdir, "single_return_intensity_vs_range_"+f+".png"))
-        plt.clf()
+        plot_xy(dual_meanrg[f][mask_all].flatten(), dual_wfmean[f][mask_all].flatten(), \
+                "mean range, meter", "total_d, app refl", \
+                "peak intensity of single-return shots from pcinfo image, "+f, \
+                os.path.join(outdir, "single_return_intensity_vs_range_"+f+".png"), **plotopts)
 
     # plot ndi against range
-    plt.figure()
-    plt.plot((dual_meanrg['nir'][mask_all]+dual_meanrg['swir'][mask_all]).flatten()/2.0, ndi['NDI'][mask_all].flatten(), '.')
-    plt.xlabel(("mean range, meter"))
-    plt.ylabel(("NDI"))
-    plt.title(("NDI of single-return shots from pcinfo image, "))
-    plt.savefig(os.path.join(outdir, "single_return_ndi_vs_range.png"))
-    plt.clf()
-    
-    # close gdal datasets
-    for f in dual_ads:
-        dual_ads[f] = None
+    plot_xy((dual_meanrg['nir'][mask_all]+dual_meanrg['swir'][mask_all]).flatten()/2.0, ndi['NDI'][mask_all].flatten(), \
+            "mean range, meter", "NDI", "NDI of single-return shots from pcinfo image, ", \
+            os.path.join(outdir, "single_return_ndi_vs_range.png"), **plotopts)
 
 # Command arguments
 class CmdArgs:
@@ -163,8 +272,12 @@ class CmdArgs:
     p.add_option("-n","--nirfile", dest="nirfile", default=None, help="DWEL pcinfo file of NIR")
     p.add_option("-s","--swirfile", dest="swirfile", default=None, help="DWEL pcinfo file of SWIR")
     p.add_option("--outdir", dest="outdir", default=os.getcwd(), help="Directory to store output results")
+    p.add_option("--plot", dest="plotmode", default="density", type="choice", choices=["density", "scatter"], help="Plot counts of shots in 2D bins (density) or every shot (scatter). Default: density")
+    p.add_option("--bins", dest="nbins", default=200, type="int", help="Number of bins along each axis of density plots and of curves. Default: 200")
+    p.add_option("--curves", dest="curves", default=None, help="Overlay curves of mean and the given comma-separated percentiles of y in bins of x, e.g. 10,50,90")
     (options, args) = p.parse_args()
     self.__dict__.update(options.__dict__)
+    self.percentiles = None if self.curves is None else [float(q) for q in self.curves.split(',') if q.strip()]
     
     if (self.nirfile is None) | (self.swirfile is None):
         p.print_help()